@@ -0,0 +1,268 @@
+"""
+Benchmark of the crawl hot path.
+
+The benchmark replays the pages stored in tests/spiders/data through the
+functions called for each fetched page: parsing, link extraction, url
+normalization, fingerprint, seen urls, queues and output store.
+By default redis and mongodb are replaced by the in memory mocks used by
+the tests; with `--backend local` the servers of the configuration
+environment are used (queues and collections named `benchmark-*` are
+deleted at the end).
+
+For each stage it reports calls per second, latency percentiles and the
+memory allocated (python objects and max resident memory).
+Results can be saved and compared with a previous run, to catch
+regressions before deploying:
+
+    python -m benchmarks.bench_crawl --save before.json
+    (apply some changes)
+    python -m benchmarks.bench_crawl --compare before.json
+
+The command must be run from the root directory of the project.
+"""
+import gc
+import os
+import sys
+import copy
+import json
+import time
+import pickle
+import logging
+import argparse
+import resource
+from collections import OrderedDict
+
+import mock
+import mongomock
+from mockredis import mock_strict_redis_client
+
+from spiders.base_spider import BaseSpider
+from spiders.extractor import extract_page
+from core.queue_manager import QueueManager
+from databases.document_store import MongoDBStore
+from utils.config_reader import read_from_file
+from utils.helpers import canonize
+from utils.fingerprint import fingerprint
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "tests", "spiders", "data")
+PAGES_FILE = os.path.join(DATA_DIR, "parse_input")
+HTML_FILE = os.path.join(DATA_DIR, "basegetlinks_input")
+
+PERCENTILES = (50, 90, 99)
+# a stage is reported as a regression if it is slower than this
+# fraction with respect to the compared run
+REGRESSION_THRESHOLD = 0.2
+
+
+class BenchmarkSpider(BaseSpider):
+    name = "benchmark"
+    allowed_domains = []
+    depth = 2
+    # robots.txt would be downloaded from the web
+    robots_compliant = False
+
+
+class Stage(object):
+    """Measures of a single stage."""
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+        self.objects = 0
+        self.rss = 0
+
+    def percentile(self, p):
+        times = sorted(self.times)
+        if not times:
+            return 0.0
+        return times[min(len(times) - 1, int(len(times) * p / 100.0))]
+
+    @property
+    def rate(self):
+        total = sum(self.times)
+        return len(self.times) / total if total else 0.0
+
+    @property
+    def info(self):
+        data = OrderedDict([("calls", len(self.times)),
+                            ("per_sec", round(self.rate, 1))])
+        for p in PERCENTILES:
+            data["p%d_ms" % p] = round(self.percentile(p) * 1000, 3)
+        data["objects"] = self.objects
+        data["rss_kb"] = self.rss
+        return data
+
+
+class Benchmark(object):
+    """Run functions and collect the measures of each stage."""
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = OrderedDict()
+
+    def run(self, name, func, calls):
+        """Call `func(*args)` for each args in calls, `repeat` times."""
+        stage = self.stages.setdefault(name, Stage(name))
+        gc.collect()
+        objects = len(gc.get_objects())
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # INFO: gc is disabled to not measure the collections and to
+        #       count the objects allocated (also the temporary ones)
+        gc.disable()
+        try:
+            for _ in range(self.repeat):
+                for args in calls:
+                    start = time.time()
+                    func(*args)
+                    stage.times.append(time.time() - start)
+        finally:
+            stage.objects += len(gc.get_objects()) - objects
+            gc.enable()
+        stage.rss += resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    @property
+    def info(self):
+        return OrderedDict((n, s.info) for n, s in self.stages.items())
+
+
+def load_pages():
+    """Return the fetched pages (DocumentMetadata) used by test_parse."""
+    pages = []
+    with open(PAGES_FILE, "rb") as f:
+        while True:
+            try:
+                pages.append(pickle.load(f))
+            except EOFError:
+                return pages
+
+
+def load_html():
+    """Return a list of (url, html) used by test_basegetlinks."""
+    with open(HTML_FILE) as f:
+        return [(d["url"], d["raw_html"]) for d in map(json.loads, f)]
+
+
+def queue_config(args):
+    if args.backend == "local":
+        return read_from_file(args.config, args.environment)["crawler"]
+    return {"queues": {"refetching-delay": 14400},
+            "mongodb": {"host": "localhost", "port": 27017, "db": "crawled"},
+            "redis": {"host": "localhost", "port": 6379, "db": 0}}
+
+
+def run(bench, cfg):
+    spider = BenchmarkSpider()
+    spider.set_config()
+    queue = QueueManager(spider.name, spider.restart_delay, cfg)
+    store = MongoDBStore(spider.name, cfg["mongodb"]["host"],
+                         cfg["mongodb"]["port"], cfg["mongodb"]["db"])
+
+    pages = load_pages()
+    html = load_html()
+    extracted = [(extract_page(h), u) for u, h in html]
+    links = [l for p, u in extracted for l in spider.get_links(p, u)]
+
+    bench.run("normalize_url", spider.normalize_url, [(l,) for l in links])
+    bench.run("canonize", canonize, [(l,) for l in links])
+    bench.run("extract_page", extract_page, [(h,) for u, h in html])
+    bench.run("get_tree_dom", spider.get_tree_dom, [(h,) for u, h in html])
+    bench.run("get_links", spider.get_links, extracted)
+    texts = [(p.text,) for p, u in extracted]
+    bench.run("fingerprint", fingerprint, texts)
+    with mock.patch("utils.fingerprint.numpy", None):
+        bench.run("fingerprint_py", fingerprint, texts)
+
+    parsed = []
+
+    def parse(dmeta):
+        parsed.append(spider.parse(dmeta))
+    bench.run("parse", parse, [(copy.deepcopy(p),) for p in pages])
+
+    bench.run("seen.observe", queue.seen.observe, [(m,) for d, m in parsed])
+    bench.run("seen.split_new", queue.seen.split_new,
+              [(m.links,) for d, m in parsed])
+    items = [[((1, l), 1) for l in m.links] for d, m in parsed]
+    bench.run("queue.push_many", queue.normal_store.push_many,
+              [(i,) for i in items])
+    queued = len(queue.normal_store.getall())
+    bench.run("queue.pop", queue.normal_store.pop,
+              [()] * (queued // bench.repeat))
+    bench.run("store.store", store.store, [(d,) for d, m in parsed])
+
+    # everything done for a fetched page, as in Crawler.crawl
+    def crawl(dmeta):
+        data, dmeta = spider.parse(dmeta)
+        queue.add_seen_and_reschedule(dmeta)
+        queue.add_normal_urls(dmeta)
+        store.store(data)
+    bench.run("pages", crawl, [(copy.deepcopy(p),) for p in pages])
+
+    # cleaning
+    for q in (queue.normal_store, queue.priority_store,
+              queue.refetch_store, queue.retry_store):
+        q.clear()
+    queue.seen.store.table.drop()
+    store.db.table.drop()
+
+
+def print_report(info, compare=None):
+    columns = ["calls", "per_sec"] + ["p%d_ms" % p for p in PERCENTILES] + \
+              ["objects", "rss_kb"]
+    print "%-16s" % "stage" + "".join("%12s" % c for c in columns)
+    regressions = []
+    for name, data in info.items():
+        line = "%-16s" % name + "".join("%12s" % data[c] for c in columns)
+        old = (compare or {}).get(name)
+        if old and old["per_sec"]:
+            change = data["per_sec"] / old["per_sec"] - 1
+            line += "  %+.0f%%" % (change * 100)
+            if change < -REGRESSION_THRESHOLD:
+                regressions.append(name)
+                line += " REGRESSION"
+        print line
+    print
+    print "pages/sec: %s" % info["pages"]["per_sec"]
+    return regressions
+
+
+def main(args):
+    # INFO: some test pages contain invalid urls logged as errors
+    logging.basicConfig(level=logging.CRITICAL)
+    bench = Benchmark(args.repeat)
+    cfg = queue_config(args)
+    if args.backend == "local":
+        run(bench, cfg)
+    else:
+        mongo = mongomock.MongoClient()
+        with mock.patch("redis.StrictRedis", mock_strict_redis_client), \
+             mock.patch("pymongo.MongoClient", return_value=mongo):
+            run(bench, cfg)
+
+    info = bench.info
+    compare = None
+    if args.compare:
+        with open(args.compare) as f:
+            compare = json.load(f)
+    regressions = print_report(info, compare)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(info, f, indent=2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="number of times each stage is repeated")
+    parser.add_argument("-b", "--backend", choices=["mock", "local"],
+                        default="mock",
+                        help="use in memory mocks or local redis/mongodb")
+    parser.add_argument("-e", "--environment", default="test",
+                        help="configuration environment for local backend")
+    parser.add_argument("-c", "--config", default="config/config.yml",
+                        help="configuration file for local backend")
+    parser.add_argument("--save", help="save the results in a json file")
+    parser.add_argument("--compare",
+                        help="compare with the results saved in a json file")
+
+    main(parser.parse_args())
@@ -1,11 +1,29 @@
 """Implement a crawler"""
+import copy
 import logging
 import threading
 
 import databases.document_store as ds
+from databases import connections
+from databases.redis_queues import RedisHash
 from utils.signals_handlers import GracefulKiller
 import fetcher.fetcher as fetcher
+import utils.metrics as metrics
+import utils.requests_wrapper as requests_wrapper
 from core.queue_manager import QueueManager
+from core.politeness import DomainThrottle
+from spiders.robots import RobotsCache
+
+
+def batching_store(cfg, output=None):
+    """Return the writer of `output` configured by the output batch, if any."""
+    batch = (cfg.get('output') or {}).get("batch")
+    if batch:
+        return ds.BatchingStore(output,
+                                batch.get("size", 100),
+                                batch.get("delay", 5),
+                                batch.get("queue", 1000),
+                                batch.get("max-bytes", 64 * 1024 * 1024))
 
 
 class Crawler():
@@ -15,68 +33,221 @@ class Crawler():
     One crawler use the configuration of a spider and the global configuration.
     Based on the conf downlads urls and store the content in the appropriate
     collection.
+    The crawlers of a SpiderPool share the output `writer` (BatchingStore)
+    and the `robots_loader` (RobotsLoader).
     """
-    def __init__(self, spider, cfg):
+    def __init__(self, spider, cfg, writer=None, robots_loader=None):
         self.logger = logging.getLogger(spider.name)
         self.sleep = threading.Event()
         self.spider = spider
+        # throttle is used only in concurrent mode (see `start`)
+        self.throttle = None
         redis_config = cfg["redis"]
         mongodb_config = cfg["mongodb"]
+        # queues and stores share the clients (and pools) of the process
+        connections.configure(cfg)
         self.queue = QueueManager(spider.name, spider.restart_delay, cfg)
 
+        # robots.txt rules are shared by all the spiders through redis
+        robots_config = cfg.get("robots", {})
+        spider.robots = RobotsCache(spider.name, spider.headers,
+                                    store=RedisHash("robots",
+                                                    redis_config['host'],
+                                                    redis_config['port'],
+                                                    redis_config['db']),
+                                    ttl=robots_config.get("ttl", 86400),
+                                    error_ttl=robots_config.get("error-ttl", 3600),
+                                    unavailable_ttl=robots_config.get("unavailable-ttl", 600),
+                                    max_domains=robots_config.get("max-domains", 1000),
+                                    loader=robots_loader)
+
         # setup output method
         output = cfg.get('output')
         if output:
             if output.get("type") == "json":
-                self.documentStore = ds.JsonStore(output.get("filename"))
+                self.documentStore = ds.JsonStore(output.get("filename"),
+                                                  output.get("compression"))
             elif output.get("type") == "redis":
                 self.documentStore = ds.RedisStore(spider.name,
                                                    redis_config['host'],
                                                    redis_config['port'],
-                                                   redis_config['db'])
+                                                   redis_config['db'],
+                                                   output.get("compression"))
             elif output.get("type") == "mongodb":
                 self.documentStore = ds.MongoDBStore(spider.name,
                                                      mongodb_config['host'],
                                                      mongodb_config['port'],
-                                                     mongodb_config['db'])
+                                                     mongodb_config['db'],
+                                                     output.get("compression"))
         else:
             self.documentStore = ds.StandardStore()
 
+        # documents are written in background, in batches
+        if writer is not None:
+            self.documentStore = ds.BatchedStore(writer, self.documentStore)
+        else:
+            writer = batching_store(cfg, self.documentStore)
+            if writer is not None:
+                self.documentStore = writer
+        # INFO: with batches the writes are timed by the writer,
+        #       here only the wait for a place in its queue.
+        self.store_stage = "store_queue" if writer is not None else "store"
+
     def start(self):
         """
         Start the crawling phase.
 
         The job continues until a sigterm is cought.
+        If the spider `concurrency` is greater than one, more urls are
+        fetched in parallel and the spider `delay` is applied per domain.
         """
+        self.setup()
+        if self.spider.concurrency > 1:
+            self.start_concurrent(self.spider.concurrency)
+        else:
+            while not GracefulKiller.kill_now:
+                self.sleep.wait(self.step())
+        self.stop()
+
+    def setup(self):
+        """Prepare the queues before crawling."""
         # starting urls end up in priority
         self.queue.init_priority_list(self.spider.start_urls)
         self.queue.add_bootstrap_urls(self.spider.urllist)
 
+    def step(self):
+        """
+        Crawl the next url, if any.
+
+        Return the seconds to wait before the next step (the spider delay).
+        It allows to run many crawlers in a few threads (see SpiderPool).
+        """
+        self.crawl(self.pop())
+        return self.spider.delay
+
+    def stop(self):
+        """Release the resources of the crawler."""
+        # closing the http connections kept alive for this spider
+        requests_wrapper.close_sessions(self.spider.name)
+        self.queue.close()
+        # waiting the documents not written yet
+        self.documentStore.close()
+
+    def start_concurrent(self, workers):
+        """
+        Crawl using a pool of `workers` threads.
+
+        Each worker pops and fetches urls independently. Before fetching,
+        a worker waits its turn on the domain of the url, so each domain
+        sees at most one request every `delay` seconds.
+        """
+        self.throttle = DomainThrottle(self.spider.delay)
+        threads = []
+        for n in range(workers):
+            t = threading.Thread(target=self._worker,
+                                 name="%s-%d" % (self.spider.name, n))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        # INFO: join with timeout, otherwise the main thread
+        #       does not receive signals in python2
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(1)
+
+    def _worker(self):
+        """Crawling loop of a single worker thread."""
+        # INFO: the spider keeps the parsed page during parsing,
+        #       so each worker needs its own copy.
+        spider = copy.copy(self.spider)
+        sleep = threading.Event()
         while not GracefulKiller.kill_now:
-            dmeta = self.queue.pop()
-            dmeta.spider = self.spider.name
-            if dmeta.url:
-                # in case of changing spider filters it is better to recheck
-                nurl, toremove = self.spider.check_and_normalize(dmeta.url)
-                if toremove:
-                    self.queue.remove_seen(dmeta.url)
-                    # INFO: in case of normalization we want to fetch the url
-                    #       but we want to discard other cases.
-                    if nurl == dmeta.url:
-                        continue
-                dmeta.url = nurl
-                dmeta.alternatives = [nurl]
-                dmeta = fetcher.fetch(self.spider.headers, dmeta)
-
-                if dmeta.status == fetcher.Status.ConnectionError:
-                    # CHECK: check if this is still correct
-                    self.queue.add_seen_and_reschedule(dmeta)
-                elif dmeta.response:
-                    r_url = self.spider.normalize_url(dmeta.response.url)
-                    dmeta.alternatives.append(r_url)
-                    document, dmeta = self.spider.parse(dmeta)
-                    self.queue.add_normal_urls(dmeta)
-                    # INFO: in case of status != 200 previous data will not be overwrited
+            try:
+                dmeta = self.pop()
+                if not dmeta.url:
+                    # nothing ready to be fetched
+                    sleep.wait(spider.delay)
+                    continue
+                self.crawl(dmeta, spider)
+            except Exception:
+                # a database error or a broken page must not stop the worker
+                self.logger.exception("%s: crawling error", spider.name)
+                sleep.wait(spider.delay)
+
+    def pop(self):
+        """Return the next url to crawl (see QueueManager.pop)."""
+        with metrics.stage_seconds.time(stage="pop"):
+            return self.queue.pop()
+
+    def collect_metrics(self):
+        """Update the metrics that are read only when exported."""
+        for name, size in self.queue.sizes().items():
+            metrics.queue_size.set(size, queue=name, spider=self.spider.name)
+
+    def crawl(self, dmeta, spider=None):
+        """Fetch, parse and store a single url popped from the queues."""
+        spider = spider or self.spider
+        dmeta.spider = spider.name
+        if not dmeta.url:
+            return
+        if spider.robots_compliant and \
+           spider.get_robots().unavailable(dmeta.url):
+            # robots.txt answered a server error: the url is retried later
+            self.queue.add_retry(dmeta)
+            self.queue.ack(dmeta)
+            return
+        # in case of changing spider filters it is better to recheck
+        nurl, toremove = spider.check_and_normalize(dmeta.url)
+        if toremove:
+            self.queue.remove_seen(dmeta.url)
+            # INFO: in case of normalization we want to fetch the url
+            #       but we want to discard other cases.
+            if nurl == dmeta.url:
+                self.queue.ack(dmeta)
+                return
+        if self.throttle and not self.throttle.wait(spider.get_domain(nurl)):
+            # stopping: the url is fetched after the restart
+            self.queue.push_back(dmeta)
+            self.queue.ack(dmeta)
+            return
+        metrics.pages.inc()
+        dmeta.url = nurl
+        dmeta.alternatives = [nurl]
+        dmeta = fetcher.fetch(spider.headers, dmeta, spider.timeout,
+                              spider.max_content_length, spider.content_types)
+
+        if dmeta.status == fetcher.Status.ConnectionError:
+            # the url is retried later, meanwhile we fetch other urls
+            self.queue.add_retry(dmeta)
+        elif dmeta.status == fetcher.Status.SkipUrl:
+            # not a page (content type, size...): it is recorded in seen,
+            # otherwise it would be fetched again from any page linking it
+            self.queue.add_skipped(dmeta)
+        elif dmeta.response is not None and \
+                dmeta.response.status_code == fetcher.NOT_MODIFIED:
+            # the page is not changed since the last fetch:
+            # nothing to parse or store, only the next refetch changes.
+            self.queue.add_seen_and_reschedule(dmeta)
+        elif dmeta.response:
+            r_url = spider.normalize_url(dmeta.response.url)
+            dmeta.alternatives.append(r_url)
+            with metrics.stage_seconds.time(stage="parse"):
+                document, dmeta = spider.parse(dmeta)
+            duplicate = False
+            if document.status == 200 and not (spider.store_near_duplicates and
+                                                spider.follow_near_duplicates):
+                duplicates = self.queue.find_near_duplicates(dmeta)
+                if duplicates:
+                    duplicate = True
+                    self.logger.info("%s is a near duplicate of %s",
+                                     dmeta.url, duplicates[0])
+            if spider.follow_near_duplicates or not duplicate:
+                self.queue.add_normal_urls(dmeta)
+            if spider.store_near_duplicates or not duplicate:
+                # INFO: in case of status != 200 previous data will not be overwrited
+                with metrics.stage_seconds.time(stage=self.store_stage):
                     self.documentStore.store(document)
-                    self.queue.add_seen_and_reschedule(dmeta)
-            self.sleep.wait(self.spider.delay)
+            self.queue.add_seen_and_reschedule(dmeta)
+        # the url is rescheduled (or dropped): it is safe to forget it
+        self.queue.ack(dmeta)
@@ -23,9 +23,32 @@ class DocumentMetadata(object):
         self.source = Source.unknown
         
         self.dhash = 0
+
+        # number of shingles of the fingerprint (see utils.fingerprint)
+        self.shingles = 0
         
         self.response = None
 
         self.status = None
 
+        self.retries = 0
+
         self.spider = ""
+
+        # cache validators of the last fetched response. Sent back on
+        # refetches to get a 304 when the page is not changed.
+        self.etag = None
+
+        self.last_modified = None
+
+        # fetches and changes of the url, read from seen
+        # (see SeenManager.observe)
+        self.history = None
+
+        # lease of the item popped from the queues (see QueueManager.ack)
+        self.lease = None
+
+    def __setstate__(self, state):
+        # objects pickled by older versions lack the newest fields
+        self.__init__()
+        self.__dict__.update(state)
@@ -0,0 +1,95 @@
+"""Find pages with almost the same content under different urls"""
+from databases import connections
+from utils.fingerprint import hamming_distance
+
+MASK = 0xFFFFFFFFFFFFFFFF
+# pages with less shingles are too short (or empty, with fingerprint 0)
+# to tell if they are near duplicates
+MIN_SHINGLES = 5
+
+
+class NearDuplicateIndex(object):
+    """
+    Index of page fingerprints stored in redis.
+
+    Two fingerprints are near duplicates if they differ in less than
+    `threshold` bits. The 64 bits are split in `threshold` blocks: by the
+    pigeonhole principle two near duplicates have at least one block equal.
+    For each block a table (a set for each block value) contains the
+    indexed pages, so a lookup reads only the pages with an equal block
+    instead of all the fingerprints.
+
+    The last fingerprint of each url is kept in a hash, so the tables
+    are updated when the page changes.
+    Only the first page with a content (the original) is indexed: its
+    near duplicates are not, so the original never becomes a near
+    duplicate of its own copies.
+    """
+    def __init__(self, name, rhost, rport, rdb, threshold):
+        self.name = name
+        self.threshold = threshold
+        self._r = connections.redis_client(rhost, rport, rdb)
+        # (shift, mask) of each block
+        self.blocks = []
+        start = 0
+        for i in range(threshold):
+            size = (64 - start) // (threshold - i)
+            self.blocks.append((start, (1 << size) - 1))
+            start += size
+
+    def _tables(self, fingerprint):
+        fingerprint &= MASK
+        return ["%s:%d:%x" % (self.name, n, (fingerprint >> shift) & mask)
+                for n, (shift, mask) in enumerate(self.blocks)]
+
+    def add(self, key, fingerprint, exclude=()):
+        """
+        Index a page and return the keys of its near duplicates.
+
+        key         -- the canonized url of the page
+        fingerprint -- the fingerprint of the page
+        exclude     -- keys that are not duplicates (e.g. alternatives)
+        """
+        member = "%d %s" % (fingerprint, key)
+        tables = self._tables(fingerprint)
+        pipe = self._r.pipeline()
+        pipe.hget(self.name, key)
+        for t in tables:
+            pipe.smembers(t)
+        result = pipe.execute()
+        old_member, candidates = result[0], set().union(*result[1:])
+
+        duplicates = set()
+        for c in candidates:
+            fp, c_key = c.split(" ", 1)
+            if c_key != key and c_key not in exclude and \
+               hamming_distance(fingerprint, int(fp)) < self.threshold:
+                duplicates.add(c_key)
+
+        if duplicates:
+            # a copy: it is removed from the index, if it was there
+            if old_member:
+                self._remove(key, old_member)
+        elif old_member != member:
+            pipe = self._r.pipeline()
+            if old_member:
+                for t in self._tables(int(old_member.split(" ", 1)[0])):
+                    pipe.srem(t, old_member)
+            for t in tables:
+                pipe.sadd(t, member)
+            pipe.hset(self.name, key, member)
+            pipe.execute()
+        return sorted(duplicates)
+
+    def _remove(self, key, member):
+        pipe = self._r.pipeline()
+        for t in self._tables(int(member.split(" ", 1)[0])):
+            pipe.srem(t, member)
+        pipe.hdel(self.name, key)
+        pipe.execute()
+
+    def delete(self, key):
+        """Remove a page from the index."""
+        old_member = self._r.hget(self.name, key)
+        if old_member:
+            self._remove(key, old_member)
@@ -0,0 +1,57 @@
+"""Implement per domain politeness between concurrent fetches"""
+import time
+import threading
+
+from utils.signals_handlers import GracefulKiller
+
+# when the number of tracked domains grows over this limit
+# the domains without pending slots are forgotten
+MAX_TRACKED_DOMAINS = 10000
+# max seconds between two checks of the exit signal while waiting
+MAX_SLEEP = 1
+
+
+class DomainThrottle(object):
+    """
+    Keep track of the next time each domain can be fetched.
+
+    Workers reserve a slot on the domain they are going to fetch and
+    wait until that slot comes. Slots of the same domain are `delay`
+    seconds apart, while different domains do not interfere each other.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, domain, now=None):
+        """Reserve the next free slot of the domain. Return seconds to wait."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if len(self._next_slot) > MAX_TRACKED_DOMAINS:
+                self._forget(now)
+            slot = max(now, self._next_slot.get(domain, 0))
+            self._next_slot[domain] = slot + self.delay
+        return slot - now
+
+    def wait(self, domain):
+        """
+        Block the caller until it is polite to fetch the domain.
+
+        Return False if the crawler is stopped meanwhile: the url should
+        not be fetched.
+        """
+        deadline = time.time() + self.reserve(domain)
+        sleep = threading.Event()
+        while not GracefulKiller.kill_now:
+            to_wait = deadline - time.time()
+            if to_wait <= 0:
+                return True
+            sleep.wait(min(to_wait, MAX_SLEEP))
+        return False
+
+    def _forget(self, now):
+        for domain, slot in self._next_slot.items():
+            if slot <= now:
+                del self._next_slot[domain]
@@ -1,12 +1,25 @@
 """Implement how different queues and datastores work together"""
 import time
 import logging
+from urlparse import urlparse
+from collections import OrderedDict
 
-from databases.redis_queues import RedisPriorityQueue
+from databases.redis_queues import RedisPriorityQueue, RedisHostQueue, RedisLeases
 from schedulers.base_scheduler import BaseRefetchingStrategy
 from schedulers.news_scheduler import NewsRefetchingStrategy
-from core.seen_manager import SeenManager
+from schedulers.change_rate_scheduler import ChangeRateRefetchingStrategy
+from core.seen_manager import SeenManager, SIMILARITY_THRESHOLD
+from core.near_duplicates import NearDuplicateIndex, MIN_SHINGLES
 from core.metadata import DocumentMetadata, Source
+from fetcher.fetcher import NOT_MODIFIED, Status
+from utils.helpers import canonize
+import utils.metrics as metrics
+
+# seconds between two searches of expired leases
+REAP_INTERVAL = 60
+# hosts whose consecutive failures are remembered (the least recent
+# failing are forgotten first)
+MAX_FAILING_HOSTS = 10000
 
 
 class QueueManager():
@@ -16,6 +29,14 @@ class QueueManager():
         self.start_delay = start_delay
         refetching_delay = cfg['queues']['refetching-delay']
 
+        # retries of failed fetches. The delay is doubled for each
+        # consecutive failure on the same host.
+        self.max_retries = cfg['queues'].get('max-retries', 5)
+        self.retry_delay = cfg['queues'].get('retry-delay', 60)
+        self.max_retry_delay = cfg['queues'].get('max-retry-delay', 3600)
+        # host -> (consecutive failures, time of the last failure)
+        self.host_failures = OrderedDict()
+
         self.refetching_strategy = None
         strategy = cfg['queues'].get('refetching-strategy')
         if not strategy or strategy == 'base':
@@ -24,36 +45,118 @@ class QueueManager():
         elif strategy == 'news':
             self.refetching_strategy = NewsRefetchingStrategy(self.start_delay,
                                                               refetching_delay)
+        elif strategy == 'change-rate':
+            # the budget is shared out among the urls in the refetch queue
+            self.refetching_strategy = ChangeRateRefetchingStrategy(
+                self.start_delay, refetching_delay,
+                cfg['queues'].get('refetch-budget'),
+                lambda: len(self.refetch_store))
         else:
-            raise NotImplementedError("refetching strategy can be either `news` or `base`")
+            raise NotImplementedError("refetching strategy can be either "
+                                      "`news`, `base` or `change-rate`")
 
         redis_config = cfg["redis"]
         mongodb_config = cfg["mongodb"]
-        self.normal_store = RedisPriorityQueue(queue + "-normal",
+        # the redis keys of a spider share the hash tag {queue}, so they
+        # are in the same slot of a redis cluster: the scripts of the
+        # queues touch keys of the same spider that are not in KEYS
+        # (the host queues, the queues of the leases).
+        keys = "{%s}" % queue
+        # frontier of the new urls: a single queue ordered by depth or
+        # a queue for each host (hosts take turns every host-delay seconds)
+        frontier = cfg['queues'].get('frontier', 'depth')
+        if frontier == 'depth':
+            self.normal_store = RedisPriorityQueue(keys + "-normal",
+                                                   redis_config['host'],
+                                                   redis_config['port'],
+                                                   redis_config['db'])
+        elif frontier == 'host':
+            self.normal_store = RedisHostQueue(keys + "-normal",
                                                redis_config['host'],
                                                redis_config['port'],
-                                               redis_config['db'])
-        self.priority_store = RedisPriorityQueue(queue + "-priority",
+                                               redis_config['db'],
+                                               cfg['queues'].get('host-delay', 20),
+                                               lambda item: urlparse(item[1]).netloc)
+        else:
+            raise NotImplementedError("frontier can be either `depth` or `host`")
+        self.priority_store = RedisPriorityQueue(keys + "-priority",
                                                  redis_config['host'],
                                                  redis_config['port'],
                                                  redis_config['db'])
-        self.refetch_store = RedisPriorityQueue(queue + "-refetch",
+        self.refetch_store = RedisPriorityQueue(keys + "-refetch",
                                                 redis_config['host'],
                                                 redis_config['port'],
                                                 redis_config['db'])
+        self.retry_store = RedisPriorityQueue(keys + "-retry",
+                                              redis_config['host'],
+                                              redis_config['port'],
+                                              redis_config['db'])
+        seen_filter = cfg.get('seen-filter')
+        if seen_filter is not None and cfg['queues'].get('lease-timeout'):
+            # INFO: the filter is kept by each process. With many crawlers
+            #       the urls seen by the others would look new.
+            self.logger.warning("seen-filter disabled: it cannot be used "
+                                "with lease-timeout")
+            seen_filter = None
         self.seen = SeenManager(queue + "-hash",
                                 mongodb_config['host'],
                                 mongodb_config['port'],
-                                mongodb_config['db'])
+                                mongodb_config['db'],
+                                seen_filter)
+        self.duplicates = NearDuplicateIndex(keys + "-duplicates",
+                                             redis_config['host'],
+                                             redis_config['port'],
+                                             redis_config['db'],
+                                             SIMILARITY_THRESHOLD)
+        # with lease-timeout the popped urls are leased instead of removed:
+        # if a crawler dies before processing them, they are popped again
+        # by another crawler after lease-timeout seconds.
+        self.lease_timeout = cfg['queues'].get('lease-timeout')
+        self.leases = None
+        self._next_reap = 0
+        if self.lease_timeout:
+            self.leases = RedisLeases(keys + "-inflight",
+                                      redis_config['host'],
+                                      redis_config['port'],
+                                      redis_config['db'])
         if self.realtime:
             self.realtime_queue = RedisPriorityQueue('realtime',
                                                      redis_config['host'],
                                                      redis_config['port'],
                                                      redis_config['db'])
 
+    def sizes(self):
+        """Return the number of urls in each queue."""
+        return {"priority": len(self.priority_store),
+                "normal": len(self.normal_store),
+                "refetch": len(self.refetch_store),
+                "retry": len(self.retry_store)}
+
+    def close(self):
+        """Save the state that is kept in memory."""
+        self.seen.close()
+
     def remove_seen(self, url):
         """Remove previously seen url"""
         self.seen.delete(url)
+        self.duplicates.delete(canonize(url))
+
+    def find_near_duplicates(self, doc_meta):
+        """
+        Return the urls of the pages with almost the same content.
+
+        The page is indexed as well, so it will be found by the next
+        near duplicates. Alternatives of the page are not duplicates.
+        Pages with too little text are neither looked up nor indexed:
+        all the empty pages would be near duplicates of each other.
+        """
+        key = canonize(doc_meta.url)
+        if doc_meta.dhash == 0 or doc_meta.shingles < MIN_SHINGLES:
+            # the page can have been indexed with another content
+            self.duplicates.delete(key)
+            return []
+        alternatives = [canonize(a) for a in doc_meta.alternatives if a]
+        return self.duplicates.add(key, doc_meta.dhash, alternatives)
 
     def add_seen_and_reschedule(self, doc_meta):
         """
@@ -62,28 +165,121 @@ class QueueManager():
         Given the metadata passed, the next refetch is computed and
         the url is added to the correct list.
         """
-        is_new = self.seen.is_new(doc_meta.url)
-        is_changed = self.seen.is_changed(doc_meta.url, doc_meta.dhash)
-        
+        if doc_meta.response is not None:
+            # the host answered. Next failures start again from retry-delay
+            self.host_failures.pop(urlparse(doc_meta.url).netloc, None)
+
+        if doc_meta.response is not None and \
+           doc_meta.response.status_code == NOT_MODIFIED:
+            # the page was not downloaded: the seen entry is still valid
+            is_new, is_changed = False, False
+            with metrics.stage_seconds.time(stage="seen"):
+                self.seen.observe_not_modified(doc_meta)
+        else:
+            # INFO: errors are not changes of the page. Counting them
+            #       would inflate the change rate of the flaky hosts.
+            #       Urls never requested (robots.txt unavailable) have no
+            #       response and are not fetches either.
+            fetched = doc_meta.status in (None, Status.Success) and \
+                doc_meta.response is not None and \
+                doc_meta.response.status_code == 200
+            with metrics.stage_seconds.time(stage="seen"):
+                is_new, is_changed, _ = self.seen.observe(doc_meta, fetched)
+
         if self.realtime and (is_new or is_changed):
             self.realtime_queue.push({"url": doc_meta.url, "name": doc_meta.spider}, int(time.time()))
 
-        self.seen.add(doc_meta)
+        self._reschedule(doc_meta, is_new, is_changed)
+
+    def add_skipped(self, doc_meta):
+        """
+        Add to seen an url that was skipped by the fetcher.
+
+        Nothing was downloaded, so the stored data of the url is kept.
+        The url is rescheduled as any other (priority urls stay in the
+        priority list).
+        """
+        with metrics.stage_seconds.time(stage="seen"):
+            is_new, _, _ = self.seen.observe(doc_meta, fetched=False)
+        self._reschedule(doc_meta, is_new, False)
+
+    def _reschedule(self, doc_meta, is_new, is_changed):
+        """Push the url in the priority or refetch list, if needed."""
         expire, next_delay = self.refetching_strategy.compute(doc_meta, is_new, is_changed)
 
-        if doc_meta.source == Source.priority:
-            self.priority_store.push((expire, doc_meta.url, next_delay, doc_meta.depth), expire)
-        elif next_delay:
-            self.refetch_store.push((expire, doc_meta.url, next_delay, doc_meta.depth), expire)
+        # validators are kept in the queues, so refetches are conditional
+        # without reading the seen entry
+        data = (expire, doc_meta.url, next_delay, doc_meta.depth,
+                doc_meta.etag, doc_meta.last_modified)
+        with metrics.stage_seconds.time(stage="queue"):
+            if doc_meta.source == Source.priority:
+                self.priority_store.push(data, expire)
+            elif next_delay:
+                self.refetch_store.push(data, expire)
         
-    def add_normal_urls(self, dm):
-        """Add urls to normal list. Usefull, usually, after extracting urls from a page"""
-        for i in dm.links:
-            if self.seen.is_new(i):
-                data = (dm.depth + 1, i)
-                self.normal_store.push(data, dm.depth + 1)
+    def add_retry(self, doc_meta):
+        """
+        Schedule a new attempt for an url that failed to be fetched.
+
+        The url is retried later without blocking the crawler. The delay
+        grows exponentially with the failures of its host.
+        After `max-retries` attempts the url follows the normal workflow.
+        """
+        doc_meta.retries += 1
+        if doc_meta.retries > self.max_retries:
+            if self.seen.is_new(doc_meta.url):
+                self.add_seen_and_reschedule(doc_meta)
             else:
-                self.seen.incr_n(i)
+                # nothing was downloaded: the fingerprint stored is kept,
+                # otherwise the next fetch would find the page changed
+                self._reschedule(doc_meta, False, False)
+            return
+
+        failures = self._host_failed(urlparse(doc_meta.url).netloc)
+        retry_delay = min(self.retry_delay * 2 ** (failures - 1),
+                          self.max_retry_delay)
+        self._push_retry(doc_meta, int(time.time()) + retry_delay)
+
+    def push_back(self, doc_meta):
+        """Put back an url popped but not fetched (e.g. at shutdown)."""
+        self._push_retry(doc_meta, int(time.time()))
+
+    def _push_retry(self, doc_meta, expire):
+        self.retry_store.push((expire, doc_meta.url, doc_meta.delay,
+                               doc_meta.depth, doc_meta.source,
+                               doc_meta.retries, doc_meta.etag,
+                               doc_meta.last_modified), expire)
+
+    def _host_failed(self, host):
+        """
+        Count a failure of the host and return its consecutive failures.
+
+        Failures older than twice max-retry-delay are forgotten: the urls
+        of the host would have been retried meanwhile.
+        """
+        now = time.time()
+        failures, last = self.host_failures.pop(host, (0, now))
+        if now - last > self.max_retry_delay * 2:
+            failures = 0
+        self.host_failures[host] = (failures + 1, now)
+        if len(self.host_failures) > MAX_FAILING_HOSTS:
+            self.host_failures.popitem(last=False)
+        return failures + 1
+
+    def add_normal_urls(self, dm):
+        """
+        Add urls to normal list. Usefull, usually, after extracting urls from a page
+
+        New urls are pushed to the normal list and the counters of already
+        seen urls are increased. The number of round trips does not depend
+        on the number of links.
+        """
+        with metrics.stage_seconds.time(stage="seen"):
+            new, seen = self.seen.split_new(dm.links)
+            self.seen.incr_n_many(seen)
+        depth = dm.depth + 1
+        with metrics.stage_seconds.time(stage="queue"):
+            self.normal_store.push_many([((depth, i), depth) for i in new])
 
     def add_bootstrap_urls(self, json_objs):
         """
@@ -103,26 +299,81 @@ class QueueManager():
                 self.normal_store.push(data, data[0])
 
     def init_priority_list(self, urls):
-        """Add urls to priority list. This happens at any startup"""
-        self.priority_store.clear()
-        for u in urls:
-            expire, depth = 1, 0
-            data = (expire, u, self.start_delay, depth)
-            self.priority_store.push(data, expire)
+        """
+        Add urls to priority list. This happens at any startup
+
+        Many crawlers of the same spider can start: urls already queued
+        or leased are not added again, and the urls no longer in the
+        list are removed.
+        """
+        expire, depth = 1, 0
+        self.priority_store.sync([((expire, u, self.start_delay, depth), expire)
+                                  for u in urls], 1, self.leases)
             
+    @staticmethod
+    def _set_validators(document_metadata, validators):
+        """Set etag and last_modified (items pushed by old versions lack them)"""
+        if len(validators) == 2:
+            document_metadata.etag, document_metadata.last_modified = validators
+
+    def _pop(self, store, document_metadata, current_time=0):
+        """Pop an item from the store, leased if leases are enabled."""
+        if self.leases is None:
+            return store.pop(current_time)
+        expire = int(time.time()) + self.lease_timeout
+        result = store.pop_leased(self.leases, expire, current_time)
+        if result:
+            item, document_metadata.lease = result
+            return item
+
+    def ack(self, doc_meta):
+        """
+        Confirm the document popped is processed, so it is not popped again.
+
+        It is called after the document is rescheduled (if needed).
+        """
+        if doc_meta.lease:
+            self.leases.ack(doc_meta.lease)
+            doc_meta.lease = None
+
+    def reap_leases(self):
+        """Put back in the queues the urls whose lease is expired."""
+        reaped = self.leases.reap(int(time.time()))
+        if reaped:
+            self.logger.warning("%d expired leases back in the queues", reaped)
+        return reaped
+
     def pop(self):
-        """Return the next document to fetch"""
+        """
+        Return the next document to fetch
+
+        If leases are enabled the document must be acknowledged with `ack`.
+        """
         document_metadata = DocumentMetadata()
-        item = self.priority_store.pop(int(time.time()))
+        if self.leases is not None and time.time() >= self._next_reap:
+            self._next_reap = time.time() + REAP_INTERVAL
+            self.reap_leases()
+        item = self._pop(self.priority_store, document_metadata, int(time.time()))
         if item:
-            logging.debug("Get priority:" + str(item[1]))
+            self.logger.debug("Get priority: %s", item[1])
             document_metadata.url = item[1]
             document_metadata.depth = item[3]
             document_metadata.delay = item[2]
             document_metadata.source = Source.priority
-        else:
+            self._set_validators(document_metadata, item[4:])
+        if not item:
+            item = self._pop(self.retry_store, document_metadata, int(time.time()))
+            if item:
+                self.logger.debug("Get retry: %s", item[1])
+                document_metadata.url = item[1]
+                document_metadata.delay = item[2]
+                document_metadata.depth = item[3]
+                document_metadata.source = item[4]
+                document_metadata.retries = item[5]
+                self._set_validators(document_metadata, item[6:])
+        if not item:
             while not item:
-                item = self.normal_store.pop()
+                item = self._pop(self.normal_store, document_metadata)
                 if not item:
                     break
                 # the following check is needed because urls are stored in seen
@@ -130,24 +381,27 @@ class QueueManager():
                 # so we can have multiple identical url in normal list.
                 # and we do not want to have multiple same urls in refetching list
                 if not self.seen.is_new(item[1]):
+                    self.ack(document_metadata)
                     item = None
             if item:
                 # In case of network error I repush url on normal queue
                 # just to not loose them. So it is possible we have
                 # something already seen here.
                 # It is not a problem to refetch this cases
-                logging.debug("Get normal:" + str(item[1]))
+                self.logger.debug("Get normal: %s", item[1])
                 document_metadata.url = item[1]
                 document_metadata.depth = item[0]
                 document_metadata.delay = 0
                 document_metadata.source = Source.normal
             else:
-                item = self.refetch_store.pop(int(time.time()))
+                item = self._pop(self.refetch_store, document_metadata,
+                                 int(time.time()))
                 if item:
-                    logging.debug("Get Refetch:" + str(item[1]))
+                    self.logger.debug("Get Refetch: %s", item[1])
                     document_metadata.url = item[1]
                     document_metadata.depth = item[3]
                     document_metadata.delay = item[2]
                     document_metadata.source = Source.refetch
+                    self._set_validators(document_metadata, item[4:])
 
         return document_metadata
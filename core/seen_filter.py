@@ -0,0 +1,157 @@
+"""Implement an in memory filter of the seen urls"""
+import os
+import json
+import math
+import struct
+import hashlib
+import logging
+import threading
+
+# counters saturate at this value and are never decreased afterwards
+MAX_COUNTER = 255
+
+
+class CountingBloomFilter(object):
+    """
+    Probabilistic set of strings supporting deletes.
+
+    A key not in the filter is surely not in the set, while a key in the
+    filter is in the set with probability 1 - error_rate (when the filter
+    holds less than `capacity` keys).
+    Each position keeps a counter instead of a bit, so keys can be removed.
+    Removing a key never added can cause false negatives: only remove keys
+    that were added before.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+                                       math.log(2))))
+        self.counters = bytearray(self.size)
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        counters = self.counters
+        return all(counters[p] for p in self._positions(key))
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            for p in positions:
+                if self.counters[p] < MAX_COUNTER:
+                    self.counters[p] += 1
+
+    def remove(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            if not all(self.counters[p] for p in positions):
+                return
+            for p in positions:
+                if self.counters[p] < MAX_COUNTER:
+                    self.counters[p] -= 1
+
+    def save(self, filename, **info):
+        """Write the filter on a file. `info` is stored with it."""
+        info.update({"size": self.size, "hashes": self.hashes})
+        tmp = filename + ".tmp"
+        with self._lock:
+            with open(tmp, "wb") as fd:
+                fd.write(json.dumps(info) + "\n")
+                fd.write(self.counters)
+        os.rename(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a filter from a file. Return the filter and its info."""
+        with open(filename, "rb") as fd:
+            info = json.loads(fd.readline())
+            counters = bytearray(fd.read())
+        bf = cls.__new__(cls)
+        bf.size = info.pop("size")
+        bf.hashes = info.pop("hashes")
+        bf.counters = counters
+        bf._lock = threading.Lock()
+        if len(counters) != bf.size:
+            raise ValueError("corrupted filter file: %s" % filename)
+        return bf, info
+
+
+class SeenFilter(object):
+    """
+    Keep a CountingBloomFilter in sync with a seen store.
+
+    The filter is loaded from the snapshot saved by the last clean close
+    (see `snapshot`), otherwise it is built reading all the keys of the
+    store. The snapshot is deleted once loaded: if the process does not
+    close cleanly, the keys added afterwards would be missing from it.
+    """
+    def __init__(self, name, store, cfg):
+        self.logger = logging.getLogger(name)
+        self.store = store
+        self.capacity = cfg.get("capacity", 1000000)
+        self.error_rate = cfg.get("error-rate", 0.01)
+        self.filename = None
+        if cfg.get("snapshot-path"):
+            self.filename = os.path.join(cfg["snapshot-path"],
+                                         name + ".filter")
+        self.filter = self._load() or self._build()
+
+    def _load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return None
+        try:
+            bf, info = CountingBloomFilter.load(self.filename)
+            # INFO: a snapshot is valid only until the filter changes,
+            #       the next one is saved by `snapshot` at close.
+            os.remove(self.filename)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning("seen filter snapshot not loaded: %s", e)
+            return None
+        # the store can be changed by other processes meanwhile
+        if info.get("keys") != len(self.store):
+            self.logger.info("seen filter snapshot outdated. Rebuilding")
+            return None
+        return bf
+
+    def _build(self):
+        bf = CountingBloomFilter(self.capacity, self.error_rate)
+        keys = 0
+        for key in self.store.keys():
+            bf.add(key)
+            keys += 1
+        if keys > self.capacity:
+            self.logger.warning("seen filter: %d keys over capacity %d. "
+                                "Increase the capacity to keep it effective",
+                                keys, self.capacity)
+        return bf
+
+    def __contains__(self, key):
+        return key in self.filter
+
+    def add(self, key):
+        """Add a key. Call it before writing the key on the store."""
+        self.filter.add(key)
+
+    def remove(self, key):
+        """Remove a key. Call it after deleting the key from the store."""
+        self.filter.remove(key)
+
+    def snapshot(self):
+        """
+        Save the filter on disk (if a snapshot-path is configured).
+
+        Call it at close, when no key is added anymore.
+        """
+        if not self.filename:
+            return
+        try:
+            self.filter.save(self.filename, keys=len(self.store))
+        except (IOError, OSError) as e:
+            # the filter is built again at the next start
+            self.logger.warning("seen filter snapshot not saved: %s", e)
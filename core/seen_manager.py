@@ -1,13 +1,16 @@
 """ Manage the urls seen during drawling"""
+import time
 from sets import Set
+from collections import Counter
 
 from bs4 import BeautifulSoup
-from simhash import hamming_distance
 
 from databases.redis_queues import RedisPageHash
 from databases.mongodb_datastore import MongoDBPageHash
 from core.metadata import DocumentMetadata
+from core.seen_filter import SeenFilter
 from utils.helpers import canonize
+from utils.fingerprint import hamming_distance
 
 # TODO: this can be parametrized
 # hash similarity is used to modify refetch strategy
@@ -23,51 +26,180 @@ class SeenManager():
     The idea is to store the pages and all eventual alternatives.
     We want to store also some metadata usefull to compute the next
     fetching date.
+
+    If `filter_config` is given, an in memory filter answers locally
+    for the urls never seen, and the store is queried only for the others.
     """
-    def __init__(self, hashname, rhost, rport, rdb):
+    def __init__(self, hashname, rhost, rport, rdb, filter_config=None):
         # INFO: I was using redis here before, bu was too big.
         # self.store = RedisPageHash(hashname, rhost, rport, rdb)
         self.store = MongoDBPageHash(hashname, rhost, rport, rdb)
+        self.filter = None
+        if filter_config is not None:
+            self.filter = SeenFilter(hashname, self.store, filter_config)
+
+    def _maybe_seen(self, key):
+        """Return False if the canonized url is surely not in the store."""
+        return self.filter is None or key in self.filter
 
     def add(self, dmeta):
         """ Add a url and its alternatives into seen"""
+        self.observe(dmeta)
+
+    def observe(self, dmeta, fetched=True):
+        """
+        Add a fetched url into seen and compare it with the stored data.
+
+        The stored entry is read once and the url with all its
+        alternatives is written with a single bulk write, together with
+        the cache validators of the response (etag and last_modified)
+        and the history of the page (see `_history`), set also in `dmeta`.
+        If the page was not `fetched` (an error or no response) the
+        entry of a url already seen is left as it is, and a new url is
+        stored without history: its hash is not the page one.
+        Return three values:
+        is_new       -- True if the url is seen for the first time
+        is_changed   -- True if the page changed since the last time
+        alternatives -- the alternatives stored before this call
+        """
         assert(isinstance(dmeta, DocumentMetadata))
 
-        # I want to merge previous aternatives with current
-        prev_entry = self.get(canonize(dmeta.url))
-        prev_alt = []
+        key = canonize(dmeta.url)
+        prev_entry = None
+        if self._maybe_seen(key):
+            prev_entry = self.store.get(key)
+
+        is_new, is_changed, prev_alt = True, True, []
         if prev_entry:
-            prev_alt = prev_entry.get("alternatives")
+            is_new = False
+            dist = hamming_distance(dmeta.dhash, prev_entry["page_hash"])
+            is_changed = dist >= SIMILARITY_THRESHOLD
+            # I want to merge previous aternatives with current
+            prev_alt = prev_entry.get("alternatives") or []
+            if not fetched:
+                dmeta.history = prev_entry.get("history")
+                return False, False, prev_alt
 
         canonized = [canonize(a) for a in dmeta.alternatives if a]
         canonized = list(set(canonized + prev_alt))
-        for n in canonized:
-            self.store.add(n, dmeta.dhash, alternatives=canonized)
+        if self.filter is not None:
+            # INFO: only the keys not stored yet, otherwise the counters
+            #       grow at each refetch until they saturate
+            stored = set(prev_alt)
+            if prev_entry:
+                stored.add(key)
+            for n in canonized:
+                if n not in stored:
+                    self.filter.add(n)
+        validators = {}
+        if dmeta.etag:
+            validators["etag"] = dmeta.etag
+        if dmeta.last_modified:
+            validators["last_modified"] = dmeta.last_modified
+        dmeta.history = None
+        if fetched:
+            dmeta.history = self._history(prev_entry, is_changed)
+        self.store.add_many(canonized, dmeta.dhash, alternatives=canonized,
+                            validators=validators, history=dmeta.history)
+        return is_new, is_changed, prev_alt
+
+    @staticmethod
+    def _history(prev_entry, is_changed):
+        """
+        Return the history of a page updated with the current fetch.
+
+        fetches     -- times the page was fetched
+        changes     -- fetches that found the page changed
+        first_fetch -- time of the first fetch
+        last_fetch  -- time of the last fetch
+        last_change -- time of the last fetch that found a change
+        """
+        now = int(time.time())
+        prev = prev_entry and prev_entry.get("history")
+        if not prev:
+            # new pages (or stored by older versions) start counting now
+            return {"fetches": 1, "changes": 0, "first_fetch": now,
+                    "last_fetch": now, "last_change": now}
+        history = dict(prev, fetches=prev["fetches"] + 1, last_fetch=now)
+        if is_changed:
+            history["changes"] = prev["changes"] + 1
+            history["last_change"] = now
+        return history
+
+    def observe_not_modified(self, dmeta):
+        """
+        Count a fetch that found the page not modified (http 304).
+
+        Only the history of the url is updated, the alternatives get it
+        back with the next `observe`.
+        """
+        key = canonize(dmeta.url)
+        if self._maybe_seen(key):
+            dmeta.history = self.store.add_fetch(key, int(time.time()))
 
     def delete(self, url):
         """Delete a url and its alternatives."""
-        if canonize(url) in self.store:
-            data = self.store.get(canonize(url))
+        key = canonize(url)
+        if self._maybe_seen(key) and key in self.store:
+            data = self.store.get(key)
             for alt in data["alternatives"]:
                 self.store.delete(alt)
+                if self.filter is not None:
+                    self.filter.remove(alt)
 
     def incr_n(self, url):
         """Increment the `count` data associated to an url and its alternatives."""
-        if canonize(url) in self.store:
-            data = self.store.get(canonize(url))
+        key = canonize(url)
+        if self._maybe_seen(key) and key in self.store:
+            data = self.store.get(key)
             for alt in data["alternatives"]:
                 self.store.incr_n(alt)
 
+    def split_new(self, urls):
+        """
+        Split urls between new and already seen ones using a single query.
+
+        Return a couple:
+        new  -- list of urls seen for the first time
+        seen -- list with the stored data of each url already seen
+        """
+        canonized = [canonize(u) for u in urls]
+        to_check = set(c for c in canonized if self._maybe_seen(c))
+        stored = {}
+        if to_check:
+            stored = self.store.get_many(to_check)
+        new, seen = [], []
+        for url, c in zip(urls, canonized):
+            if c in stored:
+                seen.append(stored[c])
+            else:
+                new.append(url)
+        return new, seen
+
+    def incr_n_many(self, entries):
+        """
+        Increment the `count` of many seen entries and their alternatives.
+
+        This is the bulk version of `incr_n`, taking the data returned by
+        `split_new`. All the counters are updated with one write.
+        """
+        counts = Counter()
+        for data in entries:
+            counts.update(data.get("alternatives") or [data["_id"]])
+        self.store.incr_many(counts)
+
     def is_new(self, url):
         """Return true if the url is seen for the first time."""
-        if canonize(url) in self.store:
+        key = canonize(url)
+        if self._maybe_seen(key) and key in self.store:
             return False
         return True
 
     def is_changed(self, url, page_hash):
         """Return true if the url has changed since the last time."""
-        if canonize(url) in self.store:
-            data = self.store.get(canonize(url))
+        key = canonize(url)
+        if self._maybe_seen(key) and key in self.store:
+            data = self.store.get(key)
             dist = hamming_distance(page_hash, data["page_hash"])
             if dist < SIMILARITY_THRESHOLD:
                 return False
@@ -80,4 +212,11 @@ class SeenManager():
         The data we store in seen is a counter since the last time we fetched it and
         the list of alternatives.
         """
-        return self.store.get(canonize(url))
+        key = canonize(url)
+        if self._maybe_seen(key):
+            return self.store.get(key)
+
+    def close(self):
+        """Save the state of the filter, if any."""
+        if self.filter is not None:
+            self.filter.snapshot()
@@ -0,0 +1,117 @@
+"""Run many crawlers in the same process"""
+import time
+import heapq
+import logging
+import threading
+
+from core.crawler import Crawler, batching_store
+from spiders.robots import RobotsLoader
+import utils.requests_wrapper as requests_wrapper
+from utils.signals_handlers import GracefulKiller
+
+# max seconds between two checks of the exit signal
+MAX_SLEEP = 1
+# threads stepping the crawlers of a pool
+THREADS = 4
+
+
+class SpiderPool(object):
+    """
+    Crawl with many spiders in a few threads.
+
+    Crawlers are kept in a heap by the time their next fetch is due.
+    Each of the `threads` threads steps the first one (see Crawler.step)
+    or sleeps until the next is due. A crawler is out of the heap while
+    it is stepped, so it is never stepped by two threads at once, and a
+    slow host delays only its own spider.
+    Spiders spend most of the time waiting their delay, so a process
+    can serve many of them: memory and connections depend on the number
+    of processes, not on the number of spiders.
+
+    Each step fetches one url, so the `concurrency` of the spiders is
+    not used.
+    """
+    def __init__(self, crawlers, threads=THREADS):
+        self.crawlers = crawlers
+        self.threads = threads
+        # output writer shared by the crawlers, closed after them
+        self.writer = None
+        self.logger = logging.getLogger("spider-pool")
+        self._heap = []
+        self._ready = threading.Condition()
+
+    @classmethod
+    def create(cls, spiders, cfg, name, threads=THREADS):
+        """
+        Return a pool of crawlers for `spiders` sharing their resources.
+
+        cfg is the crawler configuration. The crawlers share the output
+        writer, the robots.txt loader and the http sessions, so the
+        memory and the threads of the process do not grow with the
+        spiders. The seen filter is not used: each spider would need
+        its own.
+        """
+        if cfg.get('seen-filter') is not None:
+            logging.getLogger("spider-pool").info(
+                "seen-filter disabled with many spiders per process")
+            cfg = dict(cfg)
+            del cfg['seen-filter']
+        requests_wrapper.share_sessions()
+        writer = batching_store(cfg)
+        loader = RobotsLoader(name + "-robots")
+        pool = cls([Crawler(s, cfg, writer, loader) for s in spiders],
+                   threads)
+        pool.writer = writer
+        return pool
+
+    def start(self):
+        """Crawl until a sigterm is cought."""
+        for i, crawler in enumerate(self.crawlers):
+            crawler.setup()
+            heapq.heappush(self._heap, (0, i))
+        try:
+            threads = []
+            for n in range(min(self.threads, len(self.crawlers))):
+                t = threading.Thread(target=self._loop,
+                                     name="spider-pool-%d" % n)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            # INFO: join with timeout, otherwise the main thread
+            #       does not receive signals in python2
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(1)
+        finally:
+            for crawler in self.crawlers:
+                crawler.stop()
+            if self.writer is not None:
+                self.writer.close()
+
+    def _loop(self):
+        while not GracefulKiller.kill_now:
+            self.run_once()
+
+    def run_once(self):
+        """Step the crawler due first, or wait for it."""
+        with self._ready:
+            if not self._heap:
+                # all the crawlers are stepped by the other threads
+                self._ready.wait(MAX_SLEEP)
+                return
+            due, i = self._heap[0]
+            to_wait = due - time.time()
+            if to_wait > 0:
+                self._ready.wait(min(to_wait, MAX_SLEEP))
+                return
+            heapq.heappop(self._heap)
+        crawler = self.crawlers[i]
+        try:
+            delay = crawler.step()
+        except Exception:
+            # a broken spider must not stop the others
+            self.logger.exception("%s: crawling error", crawler.spider.name)
+            delay = crawler.spider.delay
+        with self._ready:
+            heapq.heappush(self._heap, (time.time() + delay, i))
+            self._ready.notify()
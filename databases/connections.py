@@ -0,0 +1,88 @@
+"""
+Clients shared by all the queues and stores of a process.
+
+A client (and its connection pool) is created for each endpoint the
+first time it is requested, and reused afterwards. The options of the
+pools are read from the redis and mongodb sections of the configuration
+(see `configure`).
+"""
+import os
+import threading
+
+import redis
+import pymongo
+from redis.connection import PythonParser
+
+_redis_options = {}
+_mongodb_options = {}
+
+_clients = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def configure(cfg):
+    """
+    Set the options of the clients created afterwards.
+
+    redis   -- max-connections, socket-keepalive, hiredis
+    mongodb -- max-pool-size, socket-keepalive
+    """
+    redis_config = cfg.get("redis", {})
+    _redis_options.clear()
+    if redis_config.get("max-connections"):
+        _redis_options["max_connections"] = redis_config["max-connections"]
+    if "socket-keepalive" in redis_config:
+        _redis_options["socket_keepalive"] = redis_config["socket-keepalive"]
+    # INFO: the hiredis parser is used by default if the package is installed
+    if redis_config.get("hiredis") is False:
+        _redis_options["parser_class"] = PythonParser
+
+    mongodb_config = cfg.get("mongodb", {})
+    _mongodb_options.clear()
+    if mongodb_config.get("max-pool-size"):
+        _mongodb_options["maxPoolSize"] = mongodb_config["max-pool-size"]
+    if "socket-keepalive" in mongodb_config:
+        _mongodb_options["socketKeepAlive"] = mongodb_config["socket-keepalive"]
+
+
+def _get(key, create):
+    global _pid
+    with _lock:
+        # INFO: clients are not shared with the forked processes
+        if _pid != os.getpid():
+            _clients.clear()
+            _pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = create()
+    return client
+
+
+def _redis_client(host, port, db):
+    options = dict(_redis_options)
+    if "max_connections" in options:
+        # workers wait for a free connection instead of failing
+        pool = redis.BlockingConnectionPool(host=host, port=port, db=db,
+                                            **options)
+    else:
+        pool = redis.ConnectionPool(host=host, port=port, db=db, **options)
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def redis_client(host, port, db):
+    """Return the redis client of the endpoint."""
+    return _get(("redis", host, port, db),
+                lambda: _redis_client(host, port, db))
+
+
+def mongodb_client(host, port):
+    """Return the mongodb client of the endpoint."""
+    return _get(("mongodb", host, port),
+                lambda: pymongo.MongoClient(host, port, **_mongodb_options))
+
+
+def reset():
+    """Forget the clients: the next requests create new ones."""
+    with _lock:
+        _clients.clear()
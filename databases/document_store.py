@@ -1,9 +1,28 @@
 """Implement different ways to store the output data"""
 import json
+import time
+import Queue
+import logging
+import threading
+from collections import OrderedDict
+
+from bson.binary import Binary
 
 from redis_queues import RedisHash
 from mongodb_datastore import MongoDB
+from spiders.document import check_codec
 from utils.helpers import canonize
+import utils.metrics as metrics
+
+# number of (fetched_time, status, fetch_id) kept in the history of a document
+HISTORY_SIZE = 10
+# seconds between two reports of the BatchingStore stats
+STATS_INTERVAL = 300
+# seconds before retrying a batch not written, doubled at each failure
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+# attempts to write a batch after close, before giving up
+CLOSE_RETRIES = 3
 
 
 class StandardStore():
@@ -11,49 +30,90 @@ class StandardStore():
     def store(self, data):
         print data.info
 
+    def store_many(self, docs):
+        """Store a list of documents."""
+        for data in docs:
+            self.store(data)
+
     def delete(self, data):
         # is not possible to delete from stdin or a file
         pass
 
+    def close(self):
+        pass
+
 
 class JsonStore(StandardStore):
-    """Output to JSON file."""
-    def __init__(self, filename):
+    """
+    Output to JSON file.
+
+    If `compression` is given, raw_html is compressed with it and
+    base64 encoded. Document decompresses it when it is used.
+    """
+    def __init__(self, filename, compression=None):
+        if compression:
+            check_codec(compression)
+        self.compression = compression
         self.fd = open(filename, "w")
 
     def store(self, data):
-        self.fd.write(json.dumps(data.info) + "\n")
+        if self.compression:
+            info = data.compressed_info(self.compression, text=True)
+        else:
+            info = data.info
+        self.fd.write(json.dumps(info) + "\n")
 
     def close(self):
         self.fd.close()
 
 
 class HashStore(StandardStore):
-    """This is a base class to output on databases"""
+    """
+    This is a base class to output on databases
+
+    If `compression` is set, raw_html is compressed with it (see
+    Document.compressed_info).
+    """
+    compression = None
+
     def __init__(self):
         ''' This class is a stub'''
         self.db = None
         raise NotImplementedError("This class is a stub. Use a subclass")
 
+    def get_info(self, data):
+        """Return the data to store."""
+        if self.compression:
+            return data.compressed_info(self.compression, text=True)
+        return data.info
+
     def store(self, data):
         '''
         this function store new data into an hash.
         In case the status is not 200, the data will not be overwritten
         the history maintain anyway the last 10 status and dates.
+        The update is done by the database with a single write, without
+        reading the old data. Storing twice the same data has no effect.
         '''
-        data_old = self.db.get(canonize(data.url))
-        if data.status == 200 or not data_old:
-            data.history = [(data.fetched_time, data.status)]
-            if data_old:
-                data.history += data_old["history"][:9]
-            to_store = data.info
-        else:
-            data_old["history"] = [(data.fetched_time, data.status)] + data_old["history"][:9]
-            to_store = data_old
+        self.db.update_history(*self._update(data), size=HISTORY_SIZE)
 
+    def store_many(self, docs):
+        """Store a list of documents with a single write."""
+        self.db.update_history_many([self._update(d) for d in docs],
+                                    HISTORY_SIZE)
+
+    def _update(self, data):
+        """Return the arguments of update_history for a document."""
+        to_store = self.get_info(data)
         to_store.pop("fetched_time", None)
         to_store.pop("status", None)
-        self.db.add(canonize(data.url), to_store)
+        to_store.pop("history", None)
+        # INFO: fetched_time has minute precision: fetch_id tells apart
+        #       two fetches in the same minute
+        entry = [data.fetched_time, data.status]
+        if data.fetch_id:
+            entry.append(data.fetch_id)
+        return (canonize(data.url), entry, to_store, data.status == 200)
 
     def delete(self, data):
         self.db.delete(canonize(data.url))
@@ -61,11 +121,219 @@ class HashStore(StandardStore):
 
 class RedisStore(HashStore):
     """Output to Redis."""
-    def __init__(self, name, host, port, db):
+    def __init__(self, name, host, port, db, compression=None):
+        if compression:
+            check_codec(compression)
+        self.compression = compression
         self.db = RedisHash(name + "-output", host, port, db)
 
 
 class MongoDBStore(HashStore):
     """Output to Mongodb."""
-    def __init__(self, name, host, port, db):
+    def __init__(self, name, host, port, db, compression=None):
+        if compression:
+            check_codec(compression)
+        self.compression = compression
         self.db = MongoDB(name + "-output", host, port, db)
+
+    def get_info(self, data):
+        """Return the data to store. Compressed data is stored as binary."""
+        if self.compression:
+            info = data.compressed_info(self.compression)
+            info["raw_html"] = Binary(info["raw_html"])
+            return info
+        info = data.info
+        # INFO: the update merges the fields: the codec of a page stored
+        #       compressed before must be overwritten too
+        info["raw_html_codec"] = None
+        return info
+
+
+class BatchingStore(object):
+    """
+    Write the documents of another store in background, in batches.
+
+    `store` puts the document in a queue and returns immediately, unless
+    `max_queue` documents or `max_bytes` bytes of raw_html are already
+    waiting: then it blocks until the writer catches up.
+    A writer thread stores the documents with a single `store_many` when
+    `batch_size` documents are waiting or `max_delay` seconds after the
+    first one. `close` stores the remaining documents.
+    A batch that fails is retried (waiting RETRY_DELAY seconds, then
+    twice as much, up to MAX_RETRY_DELAY), so while the database is
+    down the queue fills up and the crawler waits. After `close` the
+    batch is given up after CLOSE_RETRIES attempts.
+    INFO: the crawler updates seen (and realtime) when a document is
+          queued, not when it is written. Documents still queued when
+          the process is killed are lost, and realtime consumers can
+          see an url up to `max_delay` seconds before its document.
+    The stats are logged every STATS_INTERVAL seconds and at close.
+    The duration of each batch write (stage "store") and its size are
+    recorded in the metrics too.
+    The writer can be shared by the stores of many spiders (see
+    BatchedStore): `store` and `delete` take the store of the document.
+    """
+    def __init__(self, output, batch_size=100, max_delay=5, max_queue=1000,
+                 max_bytes=64 * 1024 * 1024):
+        self.logger = logging.getLogger("output")
+        self.output = output
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.queue = Queue.Queue(max_queue)
+        self.queued_bytes = 0
+        self._space = threading.Condition()
+        self._last_report = time.time()
+        self.documents = 0
+        self.batches = 0
+        self.errors = 0
+        self.lost = 0
+        self._closing = False
+        self._retry = threading.Event()
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+        self._writer = threading.Thread(target=self._write,
+                                        name="output-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    @staticmethod
+    def _size(item):
+        return getattr(item[1], "size", 0)
+
+    def store(self, data, output=None):
+        item = (output or self.output, data)
+        size = self._size(item)
+        with self._space:
+            # INFO: a document bigger than max_bytes waits an empty queue
+            while self.queued_bytes and \
+                  self.queued_bytes + size > self.max_bytes:
+                self._space.wait()
+            self.queued_bytes += size
+        self.queue.put(item)
+
+    def delete(self, data, output=None):
+        # INFO: waiting the writes already queued, they could store
+        #       the document again.
+        self.flush()
+        (output or self.output).delete(data)
+
+    def flush(self):
+        """Wait until all the queued documents are stored."""
+        self.queue.join()
+
+    def close(self):
+        """Store the queued documents and stop the writer."""
+        self._closing = True
+        # a batch waiting to be retried is retried now
+        self._retry.set()
+        self.queue.put(None)
+        self._writer.join()
+        self.logger.info("output stats: %s", self.stats)
+        if self.output is not None:
+            self.output.close()
+
+    @property
+    def stats(self):
+        """Return the counters of the writer."""
+        return {
+            "documents": self.documents,
+            "batches": self.batches,
+            "errors": self.errors,
+            "lost": self.lost,
+            "queued": self.queue.qsize(),
+            "queued_bytes": self.queued_bytes,
+            "avg_batch_size": self.documents / float(self.batches or 1),
+            "avg_flush_time": self.flush_time / (self.batches or 1),
+            "max_flush_time": self.max_flush_time,
+        }
+
+    def _write(self):
+        stop = False
+        while not stop:
+            batch = []
+            item = self.queue.get()
+            deadline = time.time() + self.max_delay
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+                timeout = deadline - time.time()
+                if len(batch) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+            if batch:
+                self._flush(batch)
+                with self._space:
+                    self.queued_bytes -= sum(self._size(d) for d in batch)
+                    self._space.notify_all()
+            if time.time() - self._last_report > STATS_INTERVAL:
+                self._last_report = time.time()
+                self.logger.info("output stats: %s", self.stats)
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+
+    def _flush(self, batch):
+        # a single write for the documents of each store
+        outputs = OrderedDict()
+        for output, data in batch:
+            outputs.setdefault(output, []).append(data)
+        for output, docs in outputs.items():
+            self._store(output, docs)
+
+    def _store(self, output, batch):
+        delay, attempts = RETRY_DELAY, 0
+        while True:
+            start = time.time()
+            try:
+                output.store_many(batch)
+                break
+            except Exception as e:
+                self.errors += 1
+                attempts += 1
+                if self._closing and attempts >= CLOSE_RETRIES:
+                    self.lost += len(batch)
+                    self.logger.error("%d documents not stored: %s",
+                                      len(batch), e)
+                    return
+                self.logger.warning("%d documents not stored, retrying "
+                                    "in %ds: %s", len(batch), delay, e)
+                if not self._closing:
+                    self._retry.wait(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        elapsed = time.time() - start
+        metrics.stage_seconds.observe(elapsed, stage="store")
+        metrics.store_batch_size.observe(len(batch))
+        self.documents += len(batch)
+        self.batches += 1
+        self.flush_time += elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+        self.logger.debug("stored %d documents in %.3fs", len(batch), elapsed)
+
+
+class BatchedStore(object):
+    """
+    A store written by a BatchingStore shared with other stores.
+
+    The spiders of a process share one writer thread and one queue (see
+    SpiderPool), so they do not need a buffer each: the documents of a
+    spider are written to its own store. The writer is closed by its
+    owner.
+    """
+    def __init__(self, writer, output):
+        self.writer = writer
+        self.output = output
+
+    def store(self, data):
+        self.writer.store(data, self.output)
+
+    def delete(self, data):
+        self.writer.delete(data, self.output)
+
+    def close(self):
+        self.writer.flush()
+        self.output.close()
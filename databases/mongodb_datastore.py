@@ -1,14 +1,20 @@
 """ Implementation of different clients for MongoDB"""
 import logging
-import pymongo
-from pymongo.errors import DocumentTooLarge
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument
+from pymongo.errors import DocumentTooLarge, DuplicateKeyError
+from pymongo.errors import BulkWriteError
+
+from databases import connections
+
+# error code of mongodb for duplicate keys
+DUPLICATE_KEY = 11000
 
 
 class MongoDB(object):
     """ Client to easily use mongodb. """
     def __init__(self, name, host, port, db):
         self.logger = logging.getLogger(name)
-        client = pymongo.MongoClient(host, port)
+        client = connections.mongodb_client(host, port)
         db = client[db]
         self.table = db[name]
 
@@ -16,17 +22,71 @@ class MongoDB(object):
         try:
             self.table.replace_one({"_id": url}, data, upsert=True)
         except DocumentTooLarge:
-            self.logger.warning("Document too large: Skip Document: %s" % url)
+            self.logger.warning("Document too large: Skip Document: %s", url)
 
     def getall(self):
         return self.table.find({})
 
+    def _history_update(self, key, entry, data, overwrite, size):
+        update = {
+            "$push": {"history": {"$each": [entry], "$position": 0,
+                                  "$slice": size}},
+            "$set" if overwrite else "$setOnInsert": data,
+        }
+        return {"_id": key, "history": {"$ne": entry}}, update
+
+    def update_history(self, key, entry, data, overwrite, size):
+        """
+        Add `entry` on top of the history of `key` with a single write.
+
+        Only the last `size` entries of the history are kept.
+        `data` is written if `overwrite` is True or if the key is new.
+        The update is skipped if `entry` is already in the history,
+        so writing twice the same entry has no effect.
+        """
+        spec, update = self._history_update(key, entry, data, overwrite, size)
+        try:
+            self.table.update_one(spec, update, upsert=True)
+        except DuplicateKeyError:
+            # the key exists and the entry is already in the history
+            pass
+        except DocumentTooLarge:
+            self.logger.warning("Document too large: Skip Document: %s", key)
+
+    def update_history_many(self, updates, size):
+        """
+        Same as `update_history` for a list of (key, entry, data, overwrite)
+        with a single bulk write.
+        """
+        if not updates:
+            return
+        try:
+            self.table.bulk_write(
+                [UpdateOne(*self._history_update(k, e, d, o, size), upsert=True)
+                 for k, e, d, o in updates], ordered=False)
+        except BulkWriteError as e:
+            # duplicate keys are entries already in the history
+            errors = [err for err in e.details["writeErrors"]
+                      if err["code"] != DUPLICATE_KEY]
+            if errors:
+                self.logger.error("%d documents not stored: %s",
+                                  len(errors), errors[0]["errmsg"])
+        except DocumentTooLarge:
+            # finding the documents too large
+            for key, entry, data, overwrite in updates:
+                self.update_history(key, entry, data, overwrite, size)
+
     def delete(self, key):
         self.table.delete_one({"_id": key})
 
     def get(self, key):
         return self.table.find_one({"_id": key})
 
+    def get_many(self, keys):
+        """Return a dict with the data of the existing keys (one query)."""
+        return dict((d["_id"], d)
+                    for d in self.table.find({"_id": {"$in": list(keys)}}))
+
 
 class MongoDBPageHash(MongoDB):
     """ Mongodb database with an increasing counter. """
@@ -41,6 +101,11 @@ class MongoDBPageHash(MongoDB):
     def __len__(self):
         return self.table.count()
 
+    def keys(self):
+        """Iterate over all the keys, without reading the data."""
+        for d in self.table.find({}, {"_id": 1}):
+            yield d["_id"]
+
     def add(self, key, page_hash, count=1, alternatives=None):
         value = {"page_hash": page_hash, "count": count}
         if alternatives:
@@ -49,5 +114,44 @@ class MongoDBPageHash(MongoDB):
         # --> will replace the document if any or insert new
         self.table.replace_one({"_id": key}, value, upsert=True)
 
+    def add_many(self, keys, page_hash, count=1, alternatives=None,
+                 validators=None, history=None):
+        """
+        Same as `add` for many keys, with a single bulk write.
+
+        `validators` (dict) are the http cache validators of the page.
+        `history` (dict) are the statistics of the fetches of the page.
+        """
+        value = {"page_hash": page_hash, "count": count}
+        if alternatives:
+            value["alternatives"] = alternatives
+        if validators:
+            value.update(validators)
+        if history:
+            value["history"] = history
+        if keys:
+            self.table.bulk_write([ReplaceOne({"_id": k}, value, upsert=True)
+                                   for k in keys])
+
     def incr_n(self, key, n=1):
         self.table.update_one({"_id": key}, {"$inc": {"count": n}})
+
+    def add_fetch(self, key, fetch_time):
+        """
+        Count a fetch of an unchanged page in its history.
+
+        Return the updated history (None without a history).
+        """
+        data = self.table.find_one_and_update(
+            {"_id": key, "history": {"$exists": True}},
+            {"$inc": {"history.fetches": 1},
+             "$set": {"history.last_fetch": fetch_time}},
+            return_document=ReturnDocument.AFTER)
+        if data:
+            return data["history"]
+
+    def incr_many(self, counts):
+        """Increment the counters of many keys (dict key -> n) at once."""
+        if counts:
+            self.table.bulk_write([UpdateOne({"_id": k}, {"$inc": {"count": n}})
+                                   for k, n in counts.items()])
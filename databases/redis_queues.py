@@ -1,37 +1,226 @@
 """Implentation of different clients for Redis"""
 import json
-import redis
+import time
 import logging
 
+from databases import connections
+
+
+# Pop atomically up to ARGV[2] items with score <= ARGV[1].
+# Items are removed in the same script, so concurrent workers
+# never get the same item and never need to retry.
+POP_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                         'LIMIT', 0, ARGV[2])
+for _, item in ipairs(items) do
+    redis.call('ZREM', KEYS[1], item)
+end
+return items
+"""
+
+
+# Add history entries on top of the history of documents in the hash
+# KEYS[1], keeping ARGV[1] entries. The other arguments are groups of
+# four: key, entry, data (without history) and overwrite.
+# The data replaces the stored one if overwrite is 1 or if the document
+# is new. Entries already in the history are skipped.
+# INFO: documents are not decoded since lua numbers cannot hold 64 bit
+#       integers (the page hash). Only the history is decoded: it is
+#       kept as the last field of the document.
+HISTORY_SCRIPT = """
+local function split_history(doc)
+    local s, e, history = string.find(doc, ',%s*"history":%s*(%b[])')
+    if not s then
+        s, e, history = string.find(doc, '"history":%s*(%b[]),?%s*')
+    end
+    if not s then
+        return doc, '[]'
+    end
+    return string.sub(doc, 1, s - 1) .. string.sub(doc, e + 1), history
+end
+
+local function update(key, entry, data, overwrite)
+    local history = {entry}
+    local old = redis.call('HGET', KEYS[1], key)
+    if old then
+        local old_data, old_history = split_history(old)
+        for _, e in ipairs(cjson.decode(old_history)) do
+            if e[1] == entry[1] and e[2] == entry[2] and e[3] == entry[3] then
+                return 0
+            end
+            if #history < tonumber(ARGV[1]) then
+                table.insert(history, e)
+            end
+        end
+        if not overwrite then
+            data = old_data
+        end
+    end
+    local body = string.match(data, '^(.-)%s*}%s*$')
+    if string.match(body, '^%s*{%s*$') then
+        data = body .. '"history":' .. cjson.encode(history) .. '}'
+    else
+        data = body .. ',"history":' .. cjson.encode(history) .. '}'
+    end
+    redis.call('HSET', KEYS[1], key, data)
+    return 1
+end
+
+local updated = 0
+for i = 2, #ARGV, 4 do
+    updated = updated + update(ARGV[i], cjson.decode(ARGV[i + 1]),
+                               ARGV[i + 2], tonumber(ARGV[i + 3]) == 1)
+end
+return updated
+"""
+
+
+# Same as POP_SCRIPT for a single item, leased until ARGV[2]: the item
+# is moved to the set of leases KEYS[2] with what is needed to put it
+# back (see REAP_SCRIPT). Return the item and the lease.
+LEASE_POP_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                         'WITHSCORES', 'LIMIT', 0, 1)
+if #items == 0 then
+    return false
+end
+redis.call('ZREM', KEYS[1], items[1])
+local lease = cjson.encode({KEYS[1], items[2], items[1]})
+redis.call('ZADD', KEYS[2], ARGV[2], lease)
+return {items[1], lease}
+"""
+
+# Put back in their queues the items of the leases in KEYS[1] expired
+# at ARGV[1]. Leases of host queues contain also the ready set and the
+# host, that is ready again if it was removed meanwhile.
+# INFO: the queues are not in KEYS, on a redis cluster they must be in
+#       the slot of KEYS[1] (same hash tag).
+REAP_SCRIPT = """
+local leases = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, lease in ipairs(leases) do
+    local l = cjson.decode(lease)
+    redis.call('ZADD', l[1], l[2], l[3])
+    if l[4] and not redis.call('ZSCORE', l[4], l[5]) then
+        redis.call('ZADD', l[4], ARGV[1], l[5])
+    end
+    redis.call('ZREM', KEYS[1], lease)
+end
+return #leases
+"""
+
+# Make the queue KEYS[1] hold one item for each key given. The key of an
+# item is its field ARGV[1]; the other arguments are groups of three:
+# key, score and item. Items with other keys (or repeated) are removed,
+# the missing ones are pushed unless they are leased in KEYS[2].
+# Return the number of items pushed.
+SYNC_SCRIPT = """
+local field = tonumber(ARGV[1])
+local wanted, present = {}, {}
+for i = 2, #ARGV, 3 do
+    wanted[ARGV[i]] = true
+end
+for _, item in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    local key = cjson.decode(item)[field]
+    if wanted[key] and not present[key] then
+        present[key] = true
+    else
+        redis.call('ZREM', KEYS[1], item)
+    end
+end
+if KEYS[2] then
+    for _, lease in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+        local l = cjson.decode(lease)
+        if l[1] == KEYS[1] then
+            present[cjson.decode(l[3])[field]] = true
+        end
+    end
+end
+local pushed = 0
+for i = 2, #ARGV, 3 do
+    if not present[ARGV[i]] then
+        present[ARGV[i]] = true
+        redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i + 2])
+        pushed = pushed + 1
+    end
+end
+return pushed
+"""
+
 
 class RedisPriorityQueue(object):
     """Implement a priority queue with redis."""
     def __init__(self, queue, rhost, rport, rdb):
         self.queue = queue
         self.logger = logging.getLogger(queue)
-        self._r = redis.StrictRedis(host=rhost, port=rport, db=rdb)
+        self._r = connections.redis_client(rhost, rport, rdb)
+        self._pop_script = self._r.register_script(POP_SCRIPT)
+        self._lease_pop_script = self._r.register_script(LEASE_POP_SCRIPT)
+        self._sync_script = self._r.register_script(SYNC_SCRIPT)
+
+    def __len__(self):
+        return self._r.zcard(self.queue)
 
     def push(self, item, priority):
         return self._r.zadd(self.queue, priority, json.dumps(item))
 
+    def push_many(self, items):
+        """Push a list of (item, priority) couples with a single ZADD."""
+        if not items:
+            return 0
+        args = []
+        for item, priority in items:
+            args += [priority, json.dumps(item)]
+        return self._r.zadd(self.queue, *args)
+
     def pop(self, current_time=0):
-        try:
-            _item = self._r.zrange(self.queue, 0, 0)[0]  # INFO: index error if empty
-            json_obj = json.loads(_item)
-            time_to_fetch = True
-            if current_time and json_obj[0] > current_time:
-                time_to_fetch = False
-
-            if time_to_fetch:
-                if self._r.zrem(self.queue, _item) == 1:
-                    return json_obj
-                else:
-                    # concurrency problem
-                    self.logger.debug("concurrent pop on redis priority queue: %s. Retrying..." % (self.queue,))
-                    return self.pop(current_time)
-        except IndexError:
-            # Queue is empty
-            self.logger.debug("queue: %s is empty" % (self.queue,))
+        """
+        Pop the item with the lowest priority.
+
+        If current_time is specified, the item is returned only if
+        its priority (expire time) is not greater than current_time.
+        """
+        items = self.pop_many(1, current_time)
+        if items:
+            return items[0]
+        # Queue is empty or no item is ready
+        self.logger.debug("queue: %s is empty", self.queue)
+
+    def pop_many(self, n, current_time=0):
+        """Pop up to n items in a single call. See `pop`."""
+        max_priority = current_time or "+inf"
+        items = self._pop_script(keys=[self.queue], args=[max_priority, n])
+        return [json.loads(i) for i in items]
+
+    def pop_leased(self, leases, expire, current_time=0):
+        """
+        Same as `pop`, but the item is kept in `leases` (RedisLeases) until
+        `expire`. Return a couple (item, lease), or None.
+        """
+        max_priority = current_time or "+inf"
+        result = self._lease_pop_script(keys=[self.queue, leases.name],
+                                        args=[max_priority, expire])
+        if result:
+            return json.loads(result[0]), result[1]
+
+    def sync(self, items, field, leases=None):
+        """
+        Make the queue hold the items of a list of (item, priority), atomically.
+
+        Items are identified by their `field` (index): the items already
+        queued or leased in `leases` (RedisLeases) are not pushed again,
+        while the queued items not in the list are removed.
+        Return the number of items pushed.
+        """
+        args = [field + 1]
+        for item, priority in items:
+            key = item[field]
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            args += [key, priority, json.dumps(item)]
+        keys = [self.queue]
+        if leases is not None:
+            keys.append(leases.name)
+        return self._sync_script(keys=keys, args=args)
 
     def getall(self):
         all_json_values = []
@@ -47,11 +236,175 @@ class RedisPriorityQueue(object):
         self._r.delete(self.queue)
 
 
+# Per host queues (see RedisHostQueue). KEYS[1] is the ready set of
+# hosts, ARGV[1] the prefix of the host queues and ARGV[2] the time.
+# INFO: the host queues are not in KEYS, on a redis cluster they must
+#       be in the slot of KEYS[1] (same hash tag, e.g. {spider}-normal).
+# Push: the other arguments are groups of three: host, priority, item.
+# A new host is ready immediately, a known host keeps its time.
+HOST_PUSH_SCRIPT = """
+local added = 0
+for i = 3, #ARGV, 3 do
+    added = added + redis.call('ZADD', ARGV[1] .. ARGV[i], ARGV[i + 1],
+                               ARGV[i + 2])
+    if not redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[i])
+    end
+end
+return added
+"""
+
+# Pop the item with the lowest priority of the host ready first
+# (its time is not greater than ARGV[2]). The host is ready again
+# after ARGV[3] seconds. Hosts without items are removed.
+# If KEYS[2] is given the item is leased until ARGV[4] (see
+# LEASE_POP_SCRIPT) and the lease is returned with the item.
+HOST_POP_SCRIPT = """
+while true do
+    local hosts = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[2],
+                             'LIMIT', 0, 1)
+    if #hosts == 0 then
+        return false
+    end
+    local queue = ARGV[1] .. hosts[1]
+    local items = redis.call('ZRANGE', queue, 0, 0)
+    if #items > 0 then
+        local lease
+        if KEYS[2] then
+            lease = cjson.encode({queue, redis.call('ZSCORE', queue, items[1]),
+                                  items[1], KEYS[1], hosts[1]})
+            redis.call('ZADD', KEYS[2], ARGV[4], lease)
+        end
+        redis.call('ZREM', queue, items[1])
+        redis.call('ZADD', KEYS[1], tonumber(ARGV[2]) + tonumber(ARGV[3]),
+                   hosts[1])
+        return {items[1], lease}
+    end
+    redis.call('ZREM', KEYS[1], hosts[1])
+end
+"""
+
+
+class RedisHostQueue(object):
+    """
+    Implement a priority queue for each host, with redis.
+
+    The hosts are kept in a sorted set (`queue`-ready) by the time they
+    can be fetched again. `pop` takes the item with the lowest priority
+    among the ones of the host ready first, and that host is not ready
+    for the next `delay` seconds. So a host with many urls does not
+    stop the other hosts: hosts take turns.
+
+    The interface is the same of RedisPriorityQueue. `host` is a function
+    returning the host of an item.
+    """
+    def __init__(self, queue, rhost, rport, rdb, delay, host):
+        self.queue = queue
+        self.delay = delay
+        self.host = host
+        self.ready = queue + "-ready"
+        self.prefix = queue + ":"
+        self.logger = logging.getLogger(queue)
+        self._r = connections.redis_client(rhost, rport, rdb)
+        self._push_script = self._r.register_script(HOST_PUSH_SCRIPT)
+        self._pop_script = self._r.register_script(HOST_POP_SCRIPT)
+
+    def __len__(self):
+        pipe = self._r.pipeline()
+        for h in self.hosts():
+            pipe.zcard(self.prefix + h)
+        return sum(pipe.execute())
+
+    def _host(self, item):
+        host = self.host(item)
+        if isinstance(host, unicode):
+            host = host.encode("utf-8")
+        return host
+
+    def push(self, item, priority):
+        return self.push_many([(item, priority)])
+
+    def push_many(self, items):
+        """Push a list of (item, priority) couples with a single call."""
+        if not items:
+            return 0
+        args = [self.prefix, int(time.time())]
+        for item, priority in items:
+            args += [self._host(item), priority, json.dumps(item)]
+        return self._push_script(keys=[self.ready], args=args)
+
+    def pop(self, current_time=0):
+        """
+        Pop the next item of the host ready first.
+
+        Return None if no host is ready at current_time (default now).
+        """
+        result = self._pop_script(keys=[self.ready],
+                                  args=[self.prefix,
+                                        current_time or int(time.time()),
+                                        self.delay])
+        if result:
+            return json.loads(result[0])
+        self.logger.debug("queue: %s has no host ready", self.queue)
+
+    def pop_leased(self, leases, expire, current_time=0):
+        """Same as RedisPriorityQueue.pop_leased."""
+        result = self._pop_script(keys=[self.ready, leases.name],
+                                  args=[self.prefix,
+                                        current_time or int(time.time()),
+                                        self.delay, expire])
+        if result:
+            return json.loads(result[0]), result[1]
+
+    def hosts(self):
+        return self._r.zrange(self.ready, 0, -1)
+
+    def getall(self):
+        all_json_values = []
+        for h in self.hosts():
+            all_json_values += [json.loads(v) for v in
+                                self._r.zrange(self.prefix + h, 0, -1)]
+        return all_json_values
+
+    def delete(self, item):
+        self._r.zrem(self.prefix + self._host(item), json.dumps(item))
+
+    def clear(self):
+        keys = [self.prefix + h for h in self.hosts()]
+        self._r.delete(self.ready, *keys)
+
+
+class RedisLeases(object):
+    """
+    Items popped from the queues and not processed yet.
+
+    Each lease expires at a given time. If it is not acknowledged
+    before (e.g. the worker died while fetching), `reap` puts the item
+    back in its queue and another worker will pop it.
+    """
+    def __init__(self, name, rhost, rport, rdb):
+        self.name = name
+        self._r = connections.redis_client(rhost, rport, rdb)
+        self._reap_script = self._r.register_script(REAP_SCRIPT)
+
+    def __len__(self):
+        return self._r.zcard(self.name)
+
+    def ack(self, lease):
+        """Remove a lease: its item has been processed."""
+        return self._r.zrem(self.name, lease)
+
+    def reap(self, current_time=0):
+        """Put back in their queues the expired items. Return how many."""
+        return self._reap_script(keys=[self.name],
+                                 args=[current_time or int(time.time())])
+
+
 class RedisNormalQueue(object):
     """Implement a FIFO queue with redis."""
     def __init__(self, queue, rhost, rport, rdb):
         self.queue = queue
-        self._r = redis.StrictRedis(host=rhost, port=rport, db=rdb)
+        self._r = connections.redis_client(rhost, rport, rdb)
 
     def push(self, item):
         json_obj = json.dumps(item)
@@ -67,7 +420,8 @@ class RedisHash(object):
     """Implement an hash map with redis."""
     def __init__(self, hashname, rhost, rport, rdb):
         self.hash = hashname
-        self._r = redis.StrictRedis(host=rhost, port=rport, db=rdb)
+        self._r = connections.redis_client(rhost, rport, rdb)
+        self._history_script = self._r.register_script(HISTORY_SCRIPT)
 
     def __contains__(self, key):
         return self._r.hexists(self.hash, key)
@@ -86,6 +440,20 @@ class RedisHash(object):
     def getall(self):
         return self._r.hgetall(self.hash)
 
+    def update_history(self, key, entry, data, overwrite, size):
+        """Same as MongoDB.update_history, with a single script call."""
+        self.update_history_many([(key, entry, data, overwrite)], size)
+
+    def update_history_many(self, updates, size):
+        """Same as MongoDB.update_history_many, with a single script call."""
+        args = [size]
+        for key, entry, data, overwrite in updates:
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            args += [key, json.dumps(entry), json.dumps(data), int(overwrite)]
+        if updates:
+            self._history_script(keys=[self.hash], args=args)
+
     def delete(self, key):
         self._r.hdel(self.hash, key)
 
@@ -1,54 +1,157 @@
 """Implementation of a url fetcher function"""
+import time
 import logging
 import requests
-import threading
 
+import utils.metrics as metrics
 import utils.requests_wrapper as requests_wrapper
 
-# in case of ConnectionError we retry a specified number of times
-MAX_RETRIES = 5
+# server answers that are worth retrying later.
+# (the retry is scheduled by the QueueManager)
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# answer to a conditional request when the page is not changed
+NOT_MODIFIED = 304
+
+# bytes read at once from the body of a response
+CHUNK_SIZE = 64 * 1024
 
 
 class Status():
     ''' Define some interal error codes.'''
     Success = 0
+    # the url can be retried later (network error or unavailable server)
     ConnectionError = 200
     SkipUrl = 300
     GenericError = 100
 
+    names = {Success: "success", ConnectionError: "connection_error",
+             SkipUrl: "skip_url", GenericError: "generic_error"}
+
+
+def conditional_headers(doc_metadata):
+    """Return the headers to revalidate the last fetched response, if any."""
+    headers = {}
+    if doc_metadata.etag:
+        headers["If-None-Match"] = doc_metadata.etag
+    if doc_metadata.last_modified:
+        headers["If-Modified-Since"] = doc_metadata.last_modified
+    return headers
+
+
+def update_validators(doc_metadata):
+    """
+    Keep the cache validators of the response.
+
+    A 304 answer may omit them: in that case the old ones are still valid.
+    """
+    response = doc_metadata.response
+    if response.status_code == NOT_MODIFIED:
+        doc_metadata.etag = response.headers.get("ETag", doc_metadata.etag)
+        doc_metadata.last_modified = response.headers.get(
+            "Last-Modified", doc_metadata.last_modified)
+    elif response.status_code == 200:
+        doc_metadata.etag = response.headers.get("ETag")
+        doc_metadata.last_modified = response.headers.get("Last-Modified")
+
+
+def accepted_type(response, content_types):
+    """Return True if the content type of the response is in `content_types`."""
+    content_type = response.headers.get("Content-Type")
+    if not content_types or not content_type:
+        return True
+    return content_type.split(";")[0].strip().lower() in content_types
 
-def fetch(headers, doc_metadata, wait_on_fail=600):
+
+def read_body(response, max_size):
+    """
+    Read the body of a streamed response in chunks.
+
+    Return False, without reading the rest of the body, as soon as it
+    is bigger than `max_size` (bytes, 0 means no limit).
+    """
+    length = response.headers.get("Content-Length")
+    if max_size and length and length.isdigit() and int(length) > max_size:
+        return False
+    chunks, size = [], 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        size += len(chunk)
+        if max_size and size > max_size:
+            return False
+        chunks.append(chunk)
+    metrics.downloaded_bytes.inc(size)
+    # INFO: this is what requests does when the body is read at once,
+    #       so response.content works as usual.
+    response._content = "".join(chunks)
+    response._content_consumed = True
+    return True
+
+
+def fetch(headers, doc_metadata, timeout=None, max_size=0, content_types=()):
     '''
     Fetch the url specified on doc_metadata. Return updated metadata.
 
+    The function does not retry or wait in case of failures. The status
+    ConnectionError tells the caller the url can be retried later.
+    If the metadata contain the validators of a previous response the
+    request is conditional: a 304 response means the page is not changed.
+
+    The body is downloaded only if the content type is accepted and the
+    size is below max_size, otherwise the status is SkipUrl.
+
     Keyword arguments:
-    headers      --  (dict) used to modify requests heders.
-    doc_metadata -- (DocumentMetadata) cointains doc metadata (url etc.)
-    wait_on_fail -- (int) seconds to wait before retrying in case
-                    of ConnectionError
+    headers       --  (dict) used to modify requests heders.
+    doc_metadata  -- (DocumentMetadata) cointains doc metadata (url etc.)
+    timeout       -- (connect, read) timeouts in seconds
+    max_size      -- maximum size of the body in bytes (0 means no limit)
+    content_types -- accepted content types (empty means all)
     '''
-    fail_counter = 0
-    sleep = threading.Event()
-    while not doc_metadata.response and MAX_RETRIES > fail_counter:
-        try:
-            doc_metadata.response = requests_wrapper.requests_retry_session(headers) \
-                                                    .get(doc_metadata.url)
-            doc_metadata.status = Status.Success
-            return doc_metadata
-        except (requests.exceptions.TooManyRedirects,
-                requests.exceptions.HTTPError,
-                requests.exceptions.Timeout,
-                requests.exceptions.InvalidSchema) as e:
-            logging.warning("%s - Skip URL" % str(e))
-            doc_metadata.status = Status.SkipUrl
-            return doc_metadata
-        except requests.ConnectionError as e:
-            logging.error("%s  - Fail (%d of %d)\n" % (str(e), fail_counter, MAX_RETRIES))
-            sleep.wait(wait_on_fail * fail_counter)
-            fail_counter += 1
+    start = time.time()
+    try:
+        session = requests_wrapper.get_session(doc_metadata.spider, headers)
+        response = session.get(doc_metadata.url,
+                               headers=conditional_headers(doc_metadata),
+                               stream=True, timeout=timeout)
+        metrics.responses.inc(code=response.status_code)
+        doc_metadata.response = response
+        doc_metadata.status = Status.Success
+        update_validators(doc_metadata)
+        if response.status_code in RETRY_STATUSES:
+            logging.warning("%s - Server error %d (attempt %d)",
+                            doc_metadata.url, response.status_code,
+                            doc_metadata.retries)
             doc_metadata.status = Status.ConnectionError
-        except Exception as e:
-            logging.error("Generic server error. %s - " % str(e))
-            doc_metadata.status = Status.GenericError
-            return doc_metadata
+            response.close()
+        elif not accepted_type(response, content_types):
+            logging.info("%s - Skip content type %s",
+                         doc_metadata.url, response.headers["Content-Type"])
+            doc_metadata.status = Status.SkipUrl
+        elif not read_body(response, max_size):
+            logging.info("%s - Skip content bigger than %d bytes",
+                         doc_metadata.url, max_size)
+            doc_metadata.status = Status.SkipUrl
+        if doc_metadata.status == Status.SkipUrl:
+            # the connection is closed without reading the rest of the body
+            response.close()
+            doc_metadata.response = None
+    except requests.exceptions.Timeout as e:
+        # INFO: ConnectTimeout and ReadTimeout. Slow or dead hosts are
+        #       retried later like the other network errors.
+        logging.error("%s - Timeout (attempt %d)", e, doc_metadata.retries)
+        doc_metadata.status = Status.ConnectionError
+    except (requests.exceptions.TooManyRedirects,
+            requests.exceptions.HTTPError,
+            requests.exceptions.InvalidSchema) as e:
+        logging.warning("%s - Skip URL", e)
+        doc_metadata.status = Status.SkipUrl
+    except (requests.ConnectionError,
+            requests.exceptions.ChunkedEncodingError) as e:
+        logging.error("%s - Fail (attempt %d)", e, doc_metadata.retries)
+        doc_metadata.status = Status.ConnectionError
+    except Exception as e:
+        logging.error("Generic server error. %s - ", e)
+        doc_metadata.status = Status.GenericError
+    metrics.stage_seconds.observe(time.time() - start, stage="fetch")
+    if doc_metadata.status != Status.Success:
+        metrics.fetch_errors.inc(status=Status.names[doc_metadata.status])
     return doc_metadata
@@ -0,0 +1,175 @@
+'''Strategy learning how often each url changes'''
+import math
+import time
+import bisect
+import random
+
+from core.metadata import Source
+from schedulers.base_scheduler import BaseRefetchingStrategy, HOUR
+
+DAY = HOUR * 24
+# bounds of the refetching delay computed from the change rate
+MIN_DELAY = HOUR
+MAX_DELAY = DAY * 30
+# fetches needed before trusting the estimated change rate
+MIN_FETCHES = 3
+# change rates kept in memory to share out the budget
+SAMPLE_SIZE = 500
+# urls rescheduled between two computations of the budget multiplier
+# (before, it is computed after 1, 2, 4, 8... urls)
+ALLOCATE_EVERY = 200
+
+# g(x) = 1 - (1 + x) * e^-x on a log scale grid, inverted by `_solve`
+_GRID = [10 ** (-4 + i * 0.0025) for i in range(2200)]
+_G = [1 - (1 + x) * math.exp(-x) for x in _GRID]
+
+
+def change_rate(history):
+    """
+    Estimate the changes per second of a page from its history.
+
+    Changes are modeled as a poisson process. A fetch tells only if the
+    page changed since the previous one, not how many times, so the
+    estimator of Cho and Garcia-Molina is used:
+        rate = -n / T * log((n - X + 0.5) / (n + 0.5))
+    where n is the number of intervals between fetches, X the intervals
+    with a change and T the time spanned.
+    Return None if the page was not fetched enough times.
+    """
+    n = history["fetches"] - 1
+    elapsed = history["last_fetch"] - history["first_fetch"]
+    if n < MIN_FETCHES - 1 or elapsed <= 0:
+        return None
+    changes = min(history["changes"], n)
+    return -n / float(elapsed) * math.log((n - changes + 0.5) / (n + 0.5))
+
+
+def _solve(y):
+    """Return x such that 1 - (1 + x) * e^-x = y (0 < y < 1)."""
+    if y <= _G[0]:
+        # g(x) ~ x^2 / 2 for small x
+        return math.sqrt(2 * y)
+    i = bisect.bisect_left(_G, y)
+    if i >= len(_G):
+        return _GRID[-1]
+    x0, x1, g0, g1 = _GRID[i - 1], _GRID[i], _G[i - 1], _G[i]
+    return x0 + (x1 - x0) * (y - g0) / (g1 - g0)
+
+
+def optimal_frequency(rate, multiplier):
+    """
+    Return the fetches per second that maximize the freshness of a page.
+
+    A page changing `rate` times per second and fetched f times per
+    second is fresh for a fraction F = f / rate * (1 - e^(-rate / f)) of
+    the time. Sharing a budget among many pages, the total freshness is
+    maximum when dF/df is the same `multiplier` for all the pages
+    fetched. Pages changing too often to be kept fresh are not worth
+    any fetch (0 is returned), as the pages that never change.
+    """
+    y = multiplier * rate
+    if rate <= 0 or y >= 1:
+        return 0
+    return rate / _solve(y)
+
+
+def _delay(frequency):
+    """Refetching delay of a frequency, within MIN_DELAY and MAX_DELAY."""
+    if frequency <= 1.0 / MAX_DELAY:
+        return MAX_DELAY
+    return int(max(1 / frequency, MIN_DELAY))
+
+
+class ChangeRateRefetchingStrategy(BaseRefetchingStrategy):
+    '''
+    Strategy learning the change rate of each url
+    mechanism:
+      - priority urls are refetched any start_delay seconds
+      - the seen entry of an url keeps how many times it was fetched
+        and how many times it changed (see SeenManager.observe). Fetches
+        that got an error are not counted.
+        Until the url is fetched MIN_FETCHES times the base strategy is
+        used.
+      - then the change rate is estimated and the delay is chosen to
+        maximize the expected freshness of all the urls, given `budget`
+        refetches per day for the spider. Urls that never change are
+        refetched after MAX_DELAY and the saved fetches go to the urls
+        that change more often.
+      - without a budget urls are refetched once per expected change.
+
+    The budget is shared out using the change rates of the urls
+    rescheduled recently, as a sample of all the urls to refetch
+    (`scheduled` returns their number).
+    '''
+    def __init__(self, start_delay, refetching_delay, budget=None,
+                 scheduled=None):
+        BaseRefetchingStrategy.__init__(self, start_delay, refetching_delay)
+        self.budget = budget
+        self.scheduled = scheduled
+        self.rates = []
+        self.multiplier = None
+        self._computed = 0
+
+    def _add_rate(self, rate):
+        # reservoir sampling: a random sample of the rates seen so far
+        self._computed += 1
+        if len(self.rates) < SAMPLE_SIZE:
+            self.rates.append(rate)
+        else:
+            i = random.randrange(self._computed)
+            if i < SAMPLE_SIZE:
+                self.rates[i] = rate
+
+    def fetches_per_day(self, multiplier, n_urls):
+        """Refetches per day of `n_urls` urls with the given multiplier."""
+        total = sum(1.0 / _delay(optimal_frequency(r, multiplier))
+                    for r in self.rates)
+        return total / len(self.rates) * n_urls * DAY
+
+    def allocate(self):
+        """
+        Compute the multiplier that spends the budget.
+
+        The fetches decrease as the multiplier increases, so it is
+        found by bisection (on a log scale).
+        """
+        n_urls = self.scheduled() if self.scheduled else len(self.rates)
+        lo, hi = -6.0, 12.0
+        for _ in range(40):
+            mid = (lo + hi) / 2
+            if self.fetches_per_day(10 ** mid, n_urls) > self.budget:
+                lo = mid
+            else:
+                hi = mid
+        self.multiplier = 10 ** hi
+        return self.multiplier
+
+    def compute(self, doc_meta, is_new, is_changed):
+        """
+        Heuristic to determine next refetch
+
+        Return a couple:
+        expire     -- the next date we want to refetch(epoch)
+        next_delay -- the current delay used
+        """
+        rate = None
+        if doc_meta.source != Source.priority and not is_new and \
+           doc_meta.history:
+            rate = change_rate(doc_meta.history)
+        if rate is None:
+            return BaseRefetchingStrategy.compute(self, doc_meta, is_new,
+                                                  is_changed)
+
+        self._add_rate(rate)
+        if not self.budget:
+            next_delay = _delay(rate)
+        else:
+            # the sample is small at the beginning: allocate more often
+            n = self._computed
+            if n % ALLOCATE_EVERY == 0 or \
+               (n < ALLOCATE_EVERY and n & (n - 1) == 0):
+                self.allocate()
+            next_delay = _delay(optimal_frequency(rate, self.multiplier))
+
+        expire = int(time.time()) + next_delay
+        return expire, next_delay
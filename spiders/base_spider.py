@@ -6,17 +6,19 @@ download from a web source.
 """
 import re
 import json
+import uuid
 import logging
 import datetime
-import robotparser
 
 from sets import Set
-from simhash import fingerprint
 from bs4 import BeautifulSoup
 from urlparse import urlparse, urlunparse, parse_qs, urldefrag, urljoin
 from urllib import urlencode
 
 from spiders.document import Document
+from spiders.extractor import Page, extract_page
+from spiders.robots import RobotsCache
+from utils.fingerprint import simhash, shingles, tokenize
 
 
 class BaseSpider(object):
@@ -25,6 +27,11 @@ class BaseSpider(object):
     # It is highly recommended to not change the values here but on the new derived classes ##
     ###########################################################################################
     # empty allowed_domains means all domains allowed (be carefull)
+    # a domain starting with "*." allows all its subdomains, while
+    # a domain starting with "." allows the domain and all its subdomains.
+    # Example:
+    #    allowed_domains = ['.domain.com']
+    #    allows domain.com, www.domain.com, sport.domain.com ...
     allowed_domains = []
 
     # list of pages to not crawl. regex permitted
@@ -48,9 +55,42 @@ class BaseSpider(object):
     # read the robots during crawling
     robots_compliant = True
 
+    # extract links, metadata and text with a single lxml pass.
+    # The BeautifulSoup tree (self.root) is built only if it is used,
+    # e.g. by the parse function of a derived spider.
+    single_pass_parse = True
+
+    # number of consecutive words hashed together to compute the page
+    # fingerprint. The fingerprint is used to detect if a page changed:
+    # with bigger values also small changes are detected.
+    shingle_size = 3
+
+    # near duplicates are pages with almost the same content of a page
+    # with a different url (e.g. syndicated or mirrored articles).
+    # Set one of these to False to not store them, or to not follow
+    # their links. With both True near duplicates are not searched.
+    store_near_duplicates = True
+    follow_near_duplicates = True
+
     # delay between to fetch two page in the current spider (seconds)
     delay = 20
 
+    # number of urls fetched in parallel. With more than one the delay above
+    # is applied to each domain instead of the whole spider.
+    # It is usefull only for spiders with many allowed_domains.
+    concurrency = 1
+
+    # (connect, read) timeouts of each request (seconds)
+    timeout = (10, 60)
+
+    # only responses with one of these content types are downloaded.
+    # The others (images, pdf...) are skipped before reading the body.
+    # An empty list accepts all the types.
+    content_types = ["text/html", "application/xhtml+xml"]
+
+    # responses bigger than this are skipped (bytes). 0 means no limit
+    max_content_length = 5 * 1024 * 1024
+
     # parameters to normalize urls.
     # Example:
     #    normalize_params = ['ref']
@@ -75,20 +115,102 @@ class BaseSpider(object):
     # you shouldn't change the following
     #####################################
 
-    robotparser_cache = {}
+    # robots.txt rules (see get_robots)
+    robots = None
     urllist = []
 
+    # filters compiled from allowed_domains and exclude_pages
+    # (see compile_filters)
+    _exclude_re = None
+    _domains = None
+    _domain_suffixes = None
+
+    # content of the page being parsed and its BeautifulSoup tree
+    _content = None
+    _root = None
+
+    @property
+    def root(self):
+        """BeautifulSoup tree of the page being parsed."""
+        if self._root is None and self._content is not None:
+            self._root = self.get_tree_dom(self._content)
+        return self._root
+
+    @root.setter
+    def root(self, value):
+        self._root = value
+
     def get_canonical(self, root):
         """Retrieve eventually the canonical url."""
         if self.use_canonical:
-            canonical = root.find('link', {"rel": "canonical"}, href=True)
-            if canonical:
-                url = canonical.get("href")
+            if isinstance(root, Page):
+                url = root.canonical
+            else:
+                canonical = root.find('link', {"rel": "canonical"}, href=True)
+                url = canonical.get("href") if canonical else None
+            if url:
                 url = self.normalize_url(url)
                 return url
 
+    def compile_filters(self):
+        """
+        Compile exclude_pages and allowed_domains.
+
+        exclude_pages are joined in a single regex and allowed_domains
+        become sets, so checking a url does not loop over the rules.
+        Filters are compiled at the first use: call this function again
+        if the rules are changed afterwards.
+        """
+        self._exclude_re = None
+        if self.exclude_pages:
+            self._exclude_re = re.compile(
+                "|".join("(?:%s)" % ex for ex in self.exclude_pages))
+
+        domains, suffixes = set(), set()
+        for ad in self.allowed_domains:
+            if ad.startswith("*."):
+                suffixes.add(ad[1:])
+            elif ad.startswith("."):
+                domains.add(ad[1:])
+                suffixes.add(ad)
+            else:
+                domains.add(ad)
+        self._domains = frozenset(domains)
+        self._domain_suffixes = frozenset(suffixes)
+
+    def is_excluded(self, url):
+        """Return True if the url matches one of the exclude_pages."""
+        if self._domains is None:
+            self.compile_filters()
+        return bool(self._exclude_re and self._exclude_re.match(url))
+
+    def is_allowed_domain(self, domain):
+        """Return True if the domain is allowed by allowed_domains."""
+        if self._domains is None:
+            self.compile_filters()
+        if not self._domains and not self._domain_suffixes:
+            return True
+        if domain in self._domains:
+            return True
+        if self._domain_suffixes:
+            # checking the parent domains: www.a.com -> .a.com, .com
+            dot = domain.find(".")
+            while dot != -1:
+                if domain[dot:] in self._domain_suffixes:
+                    return True
+                dot = domain.find(".", dot + 1)
+        return False
+
+    def get_robots(self):
+        """Return the cache of the robots.txt rules used by the spider."""
+        if self.robots is None:
+            self.robots = RobotsCache(getattr(self, "name", "spider"),
+                                      self.headers)
+        return self.robots
+
     def set_config(self):
         """Configure the spider before using it."""
+        self.compile_filters()
         if self.urllist_filename:
             try:
                 fd = open(self.urllist_filename, "r")
@@ -99,7 +221,7 @@ class BaseSpider(object):
                     #       Removing not alowed domains and removing
                     #       starting_urls because they are already
                     #       in the system.
-                    if self.get_domain(url) in self.allowed_domains \
+                    if self.is_allowed_domain(self.get_domain(url)) \
                        and url not in self.start_urls:
                         self.urllist.append(json_obj)
             except Exception as e:
@@ -124,7 +246,7 @@ class BaseSpider(object):
         try:
             u = u._replace(query=urlencode(query, True))
         except Exception as e:
-            logging.error("error replacing query in url %s" % (e,))
+            logging.error("error replacing query in url %s", e)
 
         normalized = urldefrag(urlunparse(u))[0]
         # INFO: not removing trailing slash to avoid too many redirections
@@ -146,16 +268,22 @@ class BaseSpider(object):
         bool    -- specifies if we need to remove original url from seen
                    (maybe because rules are changed)
         """
-        if any([True for ex in self.exclude_pages if re.match(ex, url)]):
-            logging.warning("skip URL because page excluded: {}".format(url))
+        if self.is_excluded(url):
+            logging.warning("skip URL because page excluded: %s", url)
             return url, True
         domain = self.get_domain(url)
-        if all([ad != domain for ad in self.allowed_domains]):
-            logging.warning(" DOMAIN ({}) discarded: {}".format(domain, url))
+        if not self.is_allowed_domain(domain):
+            logging.warning(" DOMAIN (%s) discarded: %s", domain, url)
+            return url, True
+        # INFO: links are checked against robots.txt when they are found,
+        #       but the rules can be unknown (or expired) at that time.
+        #       Missing rules are loaded in background for the next urls.
+        if self.robots_compliant and not self.get_robots().allowed(url):
+            logging.warning("URL disallowed by robots.txt: %s", url)
             return url, True
         nurl = self.normalize_url(url)
         if nurl != url:
-            logging.warning("URL normlized: {} to {}".format(url, nurl))
+            logging.warning("URL normlized: %s to %s", url, nurl)
             return nurl, True
         return url, False
     
@@ -168,18 +296,39 @@ class BaseSpider(object):
         if root is not None:
             attributes = ["name", "property", "http-equiv"]
             for attr in attributes:
+                if isinstance(root, Page):
+                    if (attr, name) in root.meta:
+                        return root.meta[(attr, name)]
+                    continue
                 data = root.find("meta", {attr: name})
                 if data:
                     return data.get("content")
 
-    def get_links(self, soup, base_url):
-        """Extract the urls from a parsed html."""
-        base = soup.find("base", href=True)
-        if base:
-            base_url = urljoin(base_url, base.get("href"))
+    def get_text(self, root):
+        """Return all the text of a parsed html."""
+        if isinstance(root, Page):
+            return root.text
+        return root.get_text()
 
-        all_links = [urljoin(base_url, i.get('href').strip())
-                     for i in soup.find_all('a', href=True)]
+    def get_links(self, soup, base_url):
+        """Extract the urls from a parsed html (a Page or a BeautifulSoup)."""
+        if isinstance(soup, Page):
+            base_href = soup.base
+            hrefs = [href for href, _ in soup.anchors]
+            nofollow_hrefs = [href for href, rel in soup.anchors
+                              if "nofollow" in rel.split()]
+        else:
+            base = soup.find("base", href=True)
+            base_href = base.get("href") if base else None
+            hrefs = [i.get('href') for i in soup.find_all('a', href=True)]
+            nofollow_hrefs = [
+                i.get('href')
+                for i in soup.find_all('a', {"rel": "nofollow"}, href=True)]
+
+        if base_href:
+            base_url = urljoin(base_url, base_href)
+
+        all_links = [urljoin(base_url, href.strip()) for href in hrefs]
 
         # I remove urls starting with "/"
         # For debugging purpose I use a long version of the following:
@@ -187,15 +336,14 @@ class BaseSpider(object):
         links = []
         for l in all_links:
             if l.startswith("/"):
-                logging.debug("skipping url starting with '/'.base: %s link: %s"
-                              % (base_url, l))
+                logging.debug("skipping url starting with '/'.base: %s link: %s",
+                              base_url, l)
             else:
                 links.append(l)
 
         if self.nofollow_compliant is True:
             nofollow = Set(
-                [urljoin(base_url, i.get('href'))
-                 for i in soup.find_all('a', {"rel": "nofollow"}, href=True)]
+                [urljoin(base_url, href) for href in nofollow_hrefs]
             )
             links = [l for l in links if l not in nofollow]
 
@@ -203,33 +351,17 @@ class BaseSpider(object):
         domains = Set()
         for l in links:
             domain = self.get_domain(l)
-            if len(self.allowed_domains) == 0 or domain in self.allowed_domains:
+            if self.is_allowed_domain(domain):
                 norm_l = self.normalize_url(l)
-                if [True for ex in self.exclude_pages if re.match(ex, norm_l)]:
+                if self.is_excluded(norm_l):
                     continue
-                rb = None
                 domains.add(domain)
-                if self.robots_compliant:
-                    rb = self.robotparser_cache.get(domain)
-   
-                    if rb is None:
-                        rb = robotparser.RobotFileParser()
-                        # TODO: fix this
-                        rb.set_url("http://" + domain + "/robots.txt")
-                        rb.read()
-                        self.robotparser_cache[domain] = rb
-
-                # INFO: this try-catch is here because sometimes
-                #       can_fatch returns unicode problems. It seemd
-                #       to be a bug of the library though.
-                ################################################################
-                try:
-                    # TODO: ho messo l'* perche' non so  lo user-agent qui per ora
-                    if not rb or rb.can_fetch("*", norm_l):
-                        allowed_links.add(norm_l)
-
-                except KeyError:
-                    pass
+                # INFO: robots.txt are downloaded in background.
+                #       Links of domains not loaded yet are allowed.
+                if self.robots_compliant and \
+                   not self.get_robots().allowed(norm_l):
+                    continue
+                allowed_links.add(norm_l)
 
         return list(allowed_links)
 
@@ -237,30 +369,35 @@ class BaseSpider(object):
         """Return a Document and the Metadata containing the date extracted from the page."""
         # import pickle
         # pickle.dump(dmeta, open("save.p", "a"))
-        self.root = self.get_tree_dom(dmeta.response.content)
+        if not dmeta.response.encoding:
+            dmeta.response.encoding = self.default_encoding
+        self._content = dmeta.response.content
+        self._root = None
+        if self.single_pass_parse:
+            page = extract_page(dmeta.response.content)
+        else:
+            page = self.root
         data = Document()
 
         # INFO: using the response url as a primary url
         nurl = self.normalize_url(dmeta.response.url)
         data.url = nurl
-        if not dmeta.response.encoding:
-            dmeta.response.encoding = self.default_encoding
         data.raw_html = dmeta.response.content.decode(dmeta.response.encoding, "ignore")
         data.fetched_time = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")
         data.status = dmeta.response.status_code
+        data.fetch_id = uuid.uuid4().hex
 
-        text = self.root.get_text().lower()
-        cleaned_text = re.split(r'[^\w]+', text)
-        doc_hash = fingerprint(map(hash, cleaned_text))
-        data.dhash = doc_hash
+        features = shingles(tokenize(self.get_text(page)), self.shingle_size)
+        data.dhash = simhash(features)
         data.domain = self.get_domain(nurl)
 
         # INFO: updating meta info
         dmeta.url = nurl
         dmeta.dhash = data.dhash
-        canonical = self.get_canonical(self.root)
+        dmeta.shingles = len(features)
+        canonical = self.get_canonical(page)
         if canonical:
             dmeta.alternatives.append(canonical)
         if dmeta.depth < self.depth:
-            dmeta.links = self.get_links(self.root, nurl)
+            dmeta.links = self.get_links(page, nurl)
         return data, dmeta
@@ -1,11 +1,38 @@
 """Implements datatypes to describe the document content"""
+import zlib
+import base64
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codecs to compress the raw_html: name -> (compress, decompress)
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (lambda d: zstandard.ZstdCompressor().compress(d),
+                      lambda d: zstandard.ZstdDecompressor().decompress(d))
+
+# suffix of the codec name when the compressed data is base64 encoded
+BASE64 = "+base64"
+
+
+def check_codec(codec):
+    """Raise ValueError if the codec is not available."""
+    if codec.replace(BASE64, "") not in CODECS:
+        raise ValueError("compression %s not available. Use one of: %s"
+                         % (codec, ", ".join(sorted(CODECS))))
 
 
 class Document(object):
     """Document data."""
     def __init__(self, entries={}):
         self.url = entries.get("url", "")
-        self.raw_html = entries.get("raw_html", "")
+        # INFO: raw_html can be compressed, it is decompressed only when used
+        self._raw_html = entries.get("raw_html", "")
+        self.raw_html_codec = entries.get("raw_html_codec")
         self.blocked = entries.get("blocked", False)
         self.history = entries.get("history", [])
         try:
@@ -16,11 +43,59 @@ class Document(object):
             self.fetched_time = entries.get("fetched_time", "")
             self.status = entries.get("status", 0)
 
+        # identifies the fetch, so storing twice the same document is
+        # harmless while two fetches in the same minute are both stored
+        self.fetch_id = entries.get("fetch_id")
+
         self.dhash = entries.get("hash", 0)
         self.domain = entries.get("domain", "")
         self.comments = entries.get("comments", 0)
         self.social = entries.get("social", {})
 
+    @property
+    def raw_html(self):
+        if self.raw_html_codec:
+            codec = self.raw_html_codec
+            data = self._raw_html
+            if codec.endswith(BASE64):
+                codec = codec[:-len(BASE64)]
+                data = base64.b64decode(data)
+            self._raw_html = CODECS[codec][1](data).decode("utf-8")
+            self.raw_html_codec = None
+        return self._raw_html
+
+    @raw_html.setter
+    def raw_html(self, value):
+        self._raw_html = value
+        self.raw_html_codec = None
+
+    @property
+    def size(self):
+        """Bytes of raw_html kept in memory (compressed or not)."""
+        return len(self._raw_html or "")
+
+    def compressed_info(self, codec, text=False):
+        """
+        Return the same dict of `info` with a compressed raw_html.
+
+        The codec is stored in `raw_html_codec`, so Document can read it.
+        If `text` is True the compressed data is base64 encoded (for the
+        stores that cannot hold binary data, like json).
+        """
+        tag = codec + BASE64 if text else codec
+        if self.raw_html_codec == tag:
+            # never decompressed: the data is already in the right format
+            raw_html = self._raw_html
+        else:
+            check_codec(codec)
+            raw_html = CODECS[codec][0](self.raw_html.encode("utf-8"))
+            if text:
+                raw_html = base64.b64encode(raw_html)
+        data = self.info
+        data["raw_html"] = raw_html
+        data["raw_html_codec"] = tag
+        return data
+
     @property
     def info(self):
         """Return a dict with all the information."""
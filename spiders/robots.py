@@ -0,0 +1,199 @@
+"""Implement a cache of the robots.txt rules"""
+import time
+import Queue
+import logging
+import threading
+import robotparser
+
+from collections import OrderedDict
+from urlparse import urlparse
+
+import utils.requests_wrapper as requests_wrapper
+
+# seconds after which the rules of a domain are downloaded again
+ROBOTS_TTL = 86400
+# seconds after which we retry a domain whose robots.txt was unreachable
+ERROR_TTL = 3600
+# seconds a domain is disallowed after a server error (5xx) on robots.txt
+UNAVAILABLE_TTL = 600
+# max number of domains kept in memory
+MAX_DOMAINS = 1000
+# timeout (seconds) for downloading robots.txt
+TIMEOUT = 10
+
+
+class RobotsLoader(object):
+    """
+    Background thread downloading robots.txt for one or more RobotsCache.
+
+    Each cache has its own loader by default. Many spiders in the same
+    process can share one loader, so they do not need a thread each.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def schedule(self, cache, scheme, domain):
+        """Make `cache` load the rules of a domain in background."""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work,
+                                                name=self.name)
+                self._worker.daemon = True
+                self._worker.start()
+        self._queue.put((cache, scheme, domain))
+
+    def _work(self):
+        while True:
+            cache, scheme, domain = self._queue.get()
+            try:
+                cache.load(scheme, domain)
+            except Exception as e:
+                cache.logger.error("robots.txt of %s not loaded: %s",
+                                   domain, e)
+            finally:
+                cache.loaded(domain)
+
+
+class RobotsCache(object):
+    """
+    Keep the robots.txt rules of the domains met by a spider.
+
+    Rules are downloaded by a background thread, so checking a url never
+    waits for the network: urls of domains not loaded yet are allowed.
+    The most recently used MAX_DOMAINS domains are kept in memory; if a
+    store (RedisHash) is given, rules are also shared with the other
+    processes through it.
+    Unreachable robots.txt (network errors) are remembered for ERROR_TTL
+    seconds, so they are not requested for every link. A server error
+    (5xx) disallows the whole domain for UNAVAILABLE_TTL seconds: the
+    urls of the domain should be fetched later (see `unavailable`).
+    The rules are downloaded by `loader` (RobotsLoader), if given.
+    """
+    def __init__(self, name, headers={}, store=None, ttl=ROBOTS_TTL,
+                 error_ttl=ERROR_TTL, max_domains=MAX_DOMAINS,
+                 unavailable_ttl=UNAVAILABLE_TTL, loader=None):
+        self.logger = logging.getLogger(name)
+        self.name = name
+        self.headers = headers
+        self.user_agent = headers.get("User-Agent", "*")
+        self.store = store
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.unavailable_ttl = unavailable_ttl
+        self.max_domains = max_domains
+        self._rules = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.loader = loader or RobotsLoader(name + "-robots")
+
+    def allowed(self, url, fetch=True):
+        """
+        Return False only if the robots.txt of the url disallows it.
+
+        If the rules of the domain are missing or expired and `fetch` is
+        True, they are requested in background.
+        """
+        u = urlparse(url)
+        rules = self._get(u.netloc)
+        if rules is None:
+            if fetch:
+                self._schedule(u.scheme or "http", u.netloc)
+            return True
+        # INFO: this try-catch is here because sometimes
+        #       can_fatch returns unicode problems. It seemd
+        #       to be a bug of the library though.
+        try:
+            return rules.can_fetch(self.user_agent, url)
+        except KeyError:
+            return False
+
+    def unavailable(self, url):
+        """
+        Return True if the robots.txt of the url answered a server error.
+
+        The url is disallowed only temporarily: it should be retried
+        instead of discarded.
+        """
+        rules = self._get(urlparse(url).netloc)
+        return getattr(rules, "unavailable", False)
+
+    def _get(self, domain):
+        with self._lock:
+            entry = self._rules.pop(domain, None)
+            if entry is None:
+                return None
+            rules, expire = entry
+            if expire < time.time():
+                return None
+            # most recently used domains are at the end
+            self._rules[domain] = entry
+            return rules
+
+    def _put(self, domain, rules, expire):
+        with self._lock:
+            self._rules.pop(domain, None)
+            self._rules[domain] = (rules, expire)
+            while len(self._rules) > self.max_domains:
+                self._rules.popitem(last=False)
+
+    def _schedule(self, scheme, domain):
+        with self._lock:
+            if domain in self._pending:
+                return
+            self._pending.add(domain)
+        self.loader.schedule(self, scheme, domain)
+
+    def loaded(self, domain):
+        """Called by the loader when the rules of a domain are loaded."""
+        with self._lock:
+            self._pending.discard(domain)
+
+    def load(self, scheme, domain):
+        """Load the rules of a domain from the store or from the web."""
+        data = None
+        if self.store is not None:
+            data = self.store.get(domain)
+        if not data or data["expire"] < time.time():
+            status, body = self._download(scheme + "://" + domain +
+                                          "/robots.txt")
+            ttl = self.ttl
+            if status is None:
+                ttl = self.error_ttl
+            elif status >= 500:
+                ttl = self.unavailable_ttl
+            data = {"status": status, "body": body,
+                    "expire": int(time.time()) + ttl}
+            if self.store is not None:
+                self.store.add(domain, data)
+
+        rules = robotparser.RobotFileParser()
+        if data["status"] in (401, 403):
+            rules.disallow_all = True
+        elif data["status"] >= 500:
+            # server error: everything is disallowed until it expires
+            rules.disallow_all = True
+            rules.unavailable = True
+        elif data["status"] == 200:
+            body = data["body"]
+            if isinstance(body, unicode):
+                body = body.encode("utf-8")
+            rules.parse(body.splitlines())
+        else:
+            # missing or unreachable robots.txt
+            rules.allow_all = True
+        rules.modified()
+        self._put(domain, rules, data["expire"])
+        return rules
+
+    def _download(self, url):
+        """Return status code and content of the url (None on errors)."""
+        session = requests_wrapper.get_session(self.name, self.headers)
+        try:
+            response = session.get(url, timeout=TIMEOUT)
+            return response.status_code, response.text
+        except Exception as e:
+            self.logger.warning("robots.txt unreachable %s: %s", url, e)
+            return None, ""
@@ -10,6 +10,10 @@ Afterwards loads all the spiders in the `spiders` directory.
 The task will spawn one process for each spider and it will start
 the crawling.
 Each spider is compleatly independent.
+
+With --workers the spiders are shared by a fixed number of processes:
+each process crawls with many spiders, fetching for the spider whose
+next fetch is due (see SpiderPool), with --threads threads.
 """
 import signal
 import logging
@@ -17,15 +21,31 @@ import argparse
 import multiprocessing
 
 from core.crawler import Crawler
+from core.spider_pool import SpiderPool, THREADS
+import utils.metrics as metrics
 from utils.class_loader import spiders_loader
 from utils.config_reader import read_from_file
 from utils.signals_handlers import GracefulKiller
 from utils.logger_manager import log_listener, logger_configurer
 
 
-def run_spider(cfg, s):
+def run_spider(cfg, s, n):
     crawl = Crawler(s, cfg['crawler'])
+    # each spider process exposes its own metrics
+    metrics.registry.add_collector(crawl.collect_metrics)
+    metrics.start(cfg['crawler'].get('metrics'), s.name, n)
     crawl.start()
+    # sending the last log records (atexit is not called in child processes)
+    logging.shutdown()
+
+
+def run_pool(cfg, spiders, n, threads):
+    pool = SpiderPool.create(spiders, cfg['crawler'], "worker-%d" % n, threads)
+    for crawl in pool.crawlers:
+        metrics.registry.add_collector(crawl.collect_metrics)
+    metrics.start(cfg['crawler'].get('metrics'), "worker-%d" % n, n)
+    pool.start()
+    logging.shutdown()
 
 
 def main(args):
@@ -42,7 +62,7 @@ def main(args):
                                        args=(queue, setting['logging']['path']))
     listener.start()
 
-    logger_configurer(queue)
+    log_handler = logger_configurer(queue, setting['logging'])
     logger = logging.getLogger("main")
     logger.info("Crawleb starting...")
 
@@ -54,18 +74,29 @@ def main(args):
 
     spiders = spiders_loader(args.spiders)
 
-    # starting one process for each spider
     processes = []
-
     for s in spiders:
         s.set_config()
-        p = multiprocessing.Process(target=run_spider, args=(setting, s,))
-        p.start()
-        processes.append(p)
+
+    if args.workers:
+        # spiders are distributed among the workers
+        for n in range(min(args.workers, len(spiders))):
+            p = multiprocessing.Process(target=run_pool,
+                                        args=(setting, spiders[n::args.workers], n,
+                                              args.threads))
+            p.start()
+            processes.append(p)
+    else:
+        # starting one process for each spider
+        for n, s in enumerate(spiders):
+            p = multiprocessing.Process(target=run_spider, args=(setting, s, n))
+            p.start()
+            processes.append(p)
 
     for p in processes:
         p.join()
 
+    log_handler.flush()
     queue.put_nowait(None)
     listener.join()
 
@@ -76,5 +107,13 @@ if __name__ == "__main__":
                         help="select the configuration environment")
     parser.add_argument("-s", "--spiders", nargs='+', default=None,
                         help="specify a list of spiders to use. Default all")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="number of processes shared by the spiders "
+                             "(e.g. the number of cores). "
+                             "Default one process for each spider")
+    parser.add_argument("-t", "--threads", type=int, default=THREADS,
+                        help="threads of each worker process, fetching "
+                             "for different spiders at once. Default %d"
+                             % THREADS)
 
     main(parser.parse_args())
@@ -0,0 +1,149 @@
+import mock
+import unittest
+import threading
+import mongomock
+from mockredis import mock_strict_redis_client
+
+import fetcher.fetcher as fetcher
+from core.metadata import DocumentMetadata
+from core.crawler import Crawler
+from core.spider_pool import SpiderPool
+from spiders.base_spider import BaseSpider
+from tests.test_base import BaseTestClass
+from utils.signals_handlers import GracefulKiller
+
+REDISMONGOCONF = {
+    'host': 'localhost',
+    'port': 42,
+    'db': 'test',
+}
+CONFIGURATION = {
+    'queues': {'refetching-delay': 3},
+    "realtime": False,
+    "redis": REDISMONGOCONF,
+    "mongodb": REDISMONGOCONF
+}
+
+PAGE = '<html><body><p>%s</p><a href="/file.pdf">file</a></body></html>'
+
+
+class TestSpider(BaseSpider):
+    name = "test-crawler"
+    allowed_domains = []
+    depth = 2
+    robots_compliant = False
+
+
+def fake_fetch(headers, dmeta, *args):
+    """Pages link the same pdf, that is skipped (content type)."""
+    if dmeta.url.endswith(".pdf"):
+        dmeta.status = fetcher.Status.SkipUrl
+        return dmeta
+    dmeta.status = fetcher.Status.Success
+    dmeta.response = mock.Mock(url=dmeta.url, status_code=200,
+                               encoding="utf-8", headers={},
+                               content=PAGE % dmeta.url)
+    return dmeta
+
+
+class TestCrawler(BaseTestClass):
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    @mock.patch('pymongo.MongoClient')
+    def setUp(self, mc):
+        super(TestCrawler, self).setUp()
+        mc.return_value = mongomock.MongoClient()
+        spider = TestSpider()
+        spider.set_config()
+        self.crawler = Crawler(spider, CONFIGURATION)
+        self.crawler.documentStore = mock.Mock()
+
+    def fetched(self, fetch, url):
+        return [c[0][1].url for c in fetch.call_args_list].count(url)
+
+    @mock.patch("fetcher.fetcher.fetch", side_effect=fake_fetch)
+    def test_skipped_url(self, fetch):
+        pdf = "http://www.randomurl1.it/file.pdf"
+        self.crawler.queue.init_priority_list(["http://www.randomurl1.it/a"])
+        self.crawler.crawl(self.crawler.pop())
+        dmeta = self.crawler.pop()
+        self.assertEqual(dmeta.url, pdf)
+        self.crawler.crawl(dmeta)
+
+        # another page links the same pdf: it is not fetched again
+        self.crawler.crawl(DocumentMetadata("http://www.randomurl1.it/b"))
+        self.assertFalse(self.crawler.pop().url)
+        self.assertEqual(self.fetched(fetch, pdf), 1)
+        self.assertFalse(self.crawler.queue.seen.is_new(pdf))
+
+    @mock.patch("fetcher.fetcher.fetch", side_effect=fake_fetch)
+    def test_skipped_priority_url(self, fetch):
+        pdf = "http://www.randomurl1.it/file.pdf"
+        self.crawler.queue.init_priority_list([pdf])
+        self.crawler.crawl(self.crawler.pop())
+        self.assertEqual(self.fetched(fetch, pdf), 1)
+        # a skipped start url is still refetched later
+        self.assertEqual(len(self.crawler.queue.priority_store), 1)
+
+    def test_worker_errors(self):
+        self.crawler.spider.delay = 0
+        self.crawler.logger = mock.Mock()
+
+        def crawl(dmeta, spider):
+            if crawl.calls == 2:
+                GracefulKiller.kill_now = True
+            crawl.calls += 1
+            if crawl.calls == 1:
+                raise ValueError("parsing error")
+        crawl.calls = 0
+        self.crawler.pop = mock.Mock(
+            return_value=DocumentMetadata("http://www.randomurl1.it"))
+        self.crawler.crawl = crawl
+        self.addCleanup(setattr, GracefulKiller, "kill_now", False)
+        # the error is logged and the worker continues
+        self.crawler._worker()
+        self.assertEqual(crawl.calls, 3)
+        self.assertEqual(self.crawler.logger.exception.call_count, 1)
+
+    @mock.patch("fetcher.fetcher.fetch", side_effect=fake_fetch)
+    def test_stopped_while_throttled(self, fetch):
+        url = "http://www.randomurl1.it/a"
+        self.crawler.throttle = mock.Mock()
+        self.crawler.throttle.wait.return_value = False
+        self.crawler.crawl(DocumentMetadata(url))
+        # not fetched, it is back in the queues
+        self.assertFalse(fetch.called)
+        self.assertEqual(self.crawler.pop().url, url)
+
+
+class TestSpiderPoolResources(BaseTestClass):
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    @mock.patch('pymongo.MongoClient')
+    @mock.patch('utils.requests_wrapper._shared', 0)
+    def test_shared_resources(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        cfg = dict(CONFIGURATION,
+                   **{"seen-filter": {"capacity": 1000000},
+                      "output": {"type": "mongodb",
+                                 "batch": {"size": 10}}})
+        spiders = []
+        for i in range(20):
+            spider = TestSpider()
+            spider.name = "test-crawler-%d" % i
+            spider.set_config()
+            spiders.append(spider)
+
+        threads = threading.active_count()
+        pool = SpiderPool.create(spiders, cfg, "worker-0")
+        self.addCleanup(pool.writer.close)
+        # a single writer thread for all the spiders
+        self.assertEqual(threading.active_count(), threads + 1)
+        for crawler in pool.crawlers:
+            self.assertIs(crawler.documentStore.writer, pool.writer)
+            self.assertIs(crawler.spider.robots.loader,
+                          pool.crawlers[0].spider.robots.loader)
+            # no filter of capacity urls for each spider
+            self.assertIsNone(crawler.queue.seen.filter)
+
+
+if __name__ == '__main__':
+    unittest.main()
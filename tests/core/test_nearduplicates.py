@@ -0,0 +1,62 @@
+import mock
+import unittest
+
+from mockredis import mock_strict_redis_client
+
+from core.near_duplicates import NearDuplicateIndex
+from tests.test_base import BaseTestClass
+
+FINGERPRINT = 0x0123456789abcdef
+
+
+class TestNearDuplicateIndex(BaseTestClass):
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    def test_blocks(self):
+        index = NearDuplicateIndex("test", "host", 0, 0, 3)
+        self.assertEqual([s for s, m in index.blocks], [0, 21, 42])
+        self.assertEqual(sum(bin(m).count("1") for s, m in index.blocks), 64)
+        # negative fingerprints use the same tables of unsigned ones
+        self.assertEqual(index._tables(-1), index._tables(2 ** 64 - 1))
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    def test_add(self):
+        index = NearDuplicateIndex("test", "host", 0, 0, 3)
+        self.assertEqual(index.add("www.url1.com", FINGERPRINT), [])
+        # the same page is not a duplicate of itself
+        self.assertEqual(index.add("www.url1.com", FINGERPRINT), [])
+
+        # two different bits (one in each of two blocks)
+        near = FINGERPRINT ^ (1 << 3) ^ (1 << 30)
+        self.assertEqual(index.add("www.url2.com", near), ["www.url1.com"])
+        # copies are not indexed
+        self.assertEqual(index.add("www.url3.com", near,
+                                   exclude=["www.url1.com"]), [])
+
+        # three different bits are too many
+        far = FINGERPRINT ^ 0b111
+        self.assertEqual(index.add("www.url4.com", far), [])
+
+        # when a page changes its old fingerprint is removed
+        index.add("www.url1.com", ~FINGERPRINT)
+        index.delete("www.url2.com")
+        self.assertEqual(index.add("www.url5.com", FINGERPRINT),
+                         ["www.url3.com"])
+
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    def test_refetch_original(self):
+        index = NearDuplicateIndex("test", "host", 0, 0, 3)
+        self.assertEqual(index.add("a.com/x", FINGERPRINT), [])
+        self.assertEqual(index.add("b.com/x", FINGERPRINT), ["a.com/x"])
+        # the original is not a duplicate of its mirror
+        self.assertEqual(index.add("a.com/x", FINGERPRINT), [])
+        self.assertEqual(index.add("b.com/x", FINGERPRINT), ["a.com/x"])
+
+        # a page indexed before becoming a copy leaves the index
+        index.add("c.com/x", ~FINGERPRINT)
+        self.assertEqual(index.add("c.com/x", FINGERPRINT), ["a.com/x"])
+        self.assertEqual(index.add("a.com/x", FINGERPRINT), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import mock
+import time
+import unittest
+import threading
+
+from core.politeness import DomainThrottle
+from tests.test_base import BaseTestClass
+from utils.signals_handlers import GracefulKiller
+
+
+class TestDomainThrottle(BaseTestClass):
+    def test_reserve_same_domain(self):
+        throttle = DomainThrottle(10)
+        # first fetch of a domain does not wait
+        self.assertEqual(throttle.reserve("www.a.com", now=100), 0)
+        # the following ones are spaced by delay
+        self.assertEqual(throttle.reserve("www.a.com", now=100), 10)
+        self.assertEqual(throttle.reserve("www.a.com", now=101), 19)
+        # after the reserved slots the domain is free again
+        self.assertEqual(throttle.reserve("www.a.com", now=200), 0)
+
+    def test_reserve_different_domains(self):
+        throttle = DomainThrottle(10)
+        domains = ["www.a.com", "www.b.com", "www.c.com"]
+        for d in domains:
+            self.assertEqual(throttle.reserve(d, now=100), 0)
+        for d in domains:
+            self.assertEqual(throttle.reserve(d, now=100), 10)
+
+    def test_forget(self):
+        throttle = DomainThrottle(10)
+        throttle.reserve("www.a.com", now=100)
+        throttle.reserve("www.b.com", now=100)
+        throttle.reserve("www.b.com", now=100)
+        throttle._forget(115)
+        self.assertEqual(list(throttle._next_slot), ["www.b.com"])
+
+    def tearDown(self):
+        GracefulKiller.kill_now = False
+
+    def test_wait(self):
+        throttle = DomainThrottle(0.05)
+        self.assertTrue(throttle.wait("www.a.com"))
+        self.assertTrue(throttle.wait("www.a.com"))
+
+    @mock.patch("core.politeness.MAX_SLEEP", 0.01)
+    def test_wait_stopped(self):
+        # the crawler is stopped while waiting the slot
+        throttle = DomainThrottle(60)
+        throttle.wait("www.a.com")
+        timer = threading.Timer(0.05, setattr,
+                                (GracefulKiller, "kill_now", True))
+        timer.start()
+        start = time.time()
+        self.assertFalse(throttle.wait("www.a.com"))
+        self.assertLess(time.time() - start, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
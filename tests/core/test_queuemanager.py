@@ -1,4 +1,5 @@
 import mock
+import json
 import time
 import unittest
 import mongomock
@@ -8,7 +9,9 @@ from mockredis import mock_strict_redis_client
 from freezegun import freeze_time
 
 from core.queue_manager import QueueManager
+from schedulers.change_rate_scheduler import MAX_DELAY
 from core.metadata import DocumentMetadata, Source
+from fetcher.fetcher import Status
 from tests.test_base import BaseTestClass
 from utils.helpers import TWO_HOURS
 
@@ -39,6 +42,27 @@ CONFIGURATION_NEWS = {
     "mongodb": REDISMONGOCONF
 }
 
+CONFIGURATION_CHANGE_RATE = {
+    'queues': {'refetching-delay': 3, 'refetching-strategy': 'change-rate'},
+    "realtime": False,
+    "redis": REDISMONGOCONF,
+    "mongodb": REDISMONGOCONF
+}
+
+CONFIGURATION_HOSTS = {
+    'queues': {'refetching-delay': 3, 'frontier': 'host', 'host-delay': 60},
+    "realtime": False,
+    "redis": REDISMONGOCONF,
+    "mongodb": REDISMONGOCONF
+}
+
+CONFIGURATION_LEASES = {
+    'queues': {'refetching-delay': 3, 'lease-timeout': 600},
+    "realtime": False,
+    "redis": REDISMONGOCONF,
+    "mongodb": REDISMONGOCONF
+}
+
 START_DELAY = 2
 
 
@@ -323,6 +347,220 @@ class TestQueueManager(BaseTestClass):
             # third from refetching
             self.assertEqual(doc.source, Source.refetch)
 
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    @mock.patch('pymongo.MongoClient')
+    @freeze_time(CURRENT_TIME)
+    def test_pop_host_frontier(self, mc):
+        '''Urls of different hosts are popped in turns'''
+        mc.return_value = mongomock.MongoClient()
+        qm = QueueManager("queues-names", START_DELAY, CONFIGURATION_HOSTS)
+        dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.links = ["http://www.randomurl1.it/%d" % i for i in range(5)]
+        dm.links.append("http://www.randomurl2.it/")
+        qm.add_normal_urls(dm)
+
+        urls = [qm.pop().url, qm.pop().url]
+        self.assertEqual(sorted(u[:24] for u in urls),
+                         ["http://www.randomurl1.it", "http://www.randomurl2.it"])
+        # both hosts wait host-delay
+        self.assertFalse(qm.pop().url)
+        with mock.patch("time.time", mock_time):
+            self.assertTrue(qm.pop().url.startswith("http://www.randomurl1.it/"))
+
+    @mock.patch('redis.StrictRedis')
+    @mock.patch('pymongo.MongoClient')
+    @freeze_time(CURRENT_TIME)
+    def test_pop_leases(self, mc, rc):
+        '''Urls not acknowledged are popped again after lease-timeout'''
+        mc.return_value = mongomock.MongoClient()
+        # leases and queues share the same redis
+        rc.return_value = mock_strict_redis_client()
+        qm = QueueManager("queues-names", START_DELAY, CONFIGURATION_LEASES)
+        qm.init_priority_list(["http://www.randomurl1.it"])
+        dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.links = ["http://www.randomurl2.it"]
+        qm.add_normal_urls(dm)
+
+        doc = qm.pop()
+        self.assertEqual(doc.source, Source.priority)
+        doc.alternatives = [doc.url]
+        qm.add_seen_and_reschedule(doc)
+        qm.ack(doc)
+        self.assertIsNone(doc.lease)
+
+        # the worker dies while fetching
+        doc = qm.pop()
+        self.assertEqual(doc.url, "http://www.randomurl2.it")
+        self.assertEqual(len(qm.leases), 1)
+        self.assertFalse(qm.pop().url)
+
+        # the lease expires and the url is back (after the priority url)
+        with mock.patch("time.time", mock_time):
+            self.assertEqual(qm.pop().source, Source.priority)
+            doc = qm.pop()
+        self.assertEqual(doc.url, "http://www.randomurl2.it")
+        self.assertEqual(doc.source, Source.normal)
+
+    @mock.patch('redis.StrictRedis')
+    @mock.patch('pymongo.MongoClient')
+    def test_init_priority_leases(self, mc, rc):
+        '''Many crawlers of the same spider start: no duplicated urls'''
+        mc.return_value = mongomock.MongoClient()
+        rc.return_value = mock_strict_redis_client()
+        config = dict(CONFIGURATION_LEASES,
+                      **{"seen-filter": {"capacity": 1000}})
+        urls = ["http://www.randomurl1.it", "http://www.randomurl2.it"]
+        qm = QueueManager("queues-names", START_DELAY, config)
+        qm.init_priority_list(urls)
+        doc = qm.pop()
+        self.assertEqual(doc.source, Source.priority)
+
+        # the url leased by the first crawler is not pushed again
+        other = QueueManager("queues-names", START_DELAY, config)
+        other.init_priority_list(urls)
+        self.assertEqual(len(other.priority_store), 1)
+        self.assertNotEqual(other.pop().url, doc.url)
+        self.assertFalse(other.pop().url)
+
+        # the filter would know only the urls of its own crawler
+        self.assertIsNone(qm.seen.filter)
+
+    @mock.patch('redis.StrictRedis')
+    @mock.patch('pymongo.MongoClient')
+    def test_keys_hash_tag(self, mc, rc):
+        '''The redis keys of a spider are in the same cluster slot'''
+        mc.return_value = mongomock.MongoClient()
+        rc.return_value = mock_strict_redis_client()
+        config = dict(CONFIGURATION_HOSTS,
+                      queues=dict(CONFIGURATION_HOSTS['queues'],
+                                  **{'lease-timeout': 600}))
+        qm = QueueManager("queues-names", START_DELAY, config)
+        qm.init_priority_list(["http://www.randomurl1.it"])
+        dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.links = ["http://www.randomurl2.it"]
+        qm.add_normal_urls(dm)
+        qm.pop()
+        qm.pop()
+
+        # the scripts touch also the queue and the ready set of the leases
+        keys = rc.return_value.keys("*")
+        for lease in rc.return_value.zrange("{queues-names}-inflight", 0, -1):
+            lease = json.loads(lease)
+            keys += [lease[0]] + lease[3:4]
+        self.assertIn("{queues-names}-normal:www.randomurl2.it", keys)
+        for key in keys:
+            self.assertTrue(key.startswith("{queues-names}-"), key)
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    @mock.patch('pymongo.MongoClient')
+    def test_near_duplicates_empty_pages(self, mc):
+        '''Pages without text are not near duplicates of each other'''
+        mc.return_value = mongomock.MongoClient()
+        qm = QueueManager("queues-names", START_DELAY, CONFIGURATION)
+
+        def page(url, dhash, shingles):
+            dm = DocumentMetadata(url)
+            dm.alternatives = [url]
+            dm.dhash, dm.shingles = dhash, shingles
+            return dm
+        self.assertEqual(qm.find_near_duplicates(
+            page("http://www.randomurl1.it", 0, 0)), [])
+        self.assertEqual(qm.find_near_duplicates(
+            page("http://www.randomurl2.it", 0, 0)), [])
+        # a few words are not enough either
+        self.assertEqual(qm.find_near_duplicates(
+            page("http://www.randomurl3.it", 121212, 2)), [])
+        self.assertEqual(qm.find_near_duplicates(
+            page("http://www.randomurl4.it", 121212, 2)), [])
+
+        self.assertEqual(qm.find_near_duplicates(
+            page("http://www.randomurl5.it", 121212, 50)), [])
+        self.assertEqual(qm.find_near_duplicates(
+            page("http://www.randomurl6.it", 121212, 50)),
+            ["www.randomurl5.it"])
+        # the page is emptied: it is removed from the index
+        qm.find_near_duplicates(page("http://www.randomurl5.it", 0, 0))
+        self.assertEqual(qm.find_near_duplicates(
+            page("http://www.randomurl7.it", 121212, 50)), [])
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    @mock.patch('pymongo.MongoClient')
+    @freeze_time(CURRENT_TIME)
+    def test_add_retry(self, mc):
+        '''
+        Test failed urls are retried later with a growing delay
+        and follow the refetching workflow after max-retries
+        '''
+        mc.return_value = mongomock.MongoClient()
+        qm = QueueManager("queues-names", START_DELAY, CONFIGURATION)
+        now = int(time.time())
+
+        dm = DocumentMetadata("http://www.randomurl1.it/page")
+        dm.depth = 2
+        dm.source = Source.normal
+        qm.add_retry(dm)
+
+        # the url is not ready yet
+        self.assertFalse(qm.pop().url)
+
+        retries = qm.retry_store.getall()
+        self.assertEqual(len(retries), 1)
+        self.assertEqual(retries[0][0], now + qm.retry_delay)
+
+        # a second failure on the same host doubles the delay
+        dm2 = DocumentMetadata("http://www.randomurl1.it/other")
+        qm.add_retry(dm2)
+        retries = qm.retry_store.getall()
+        self.assertEqual(retries[1][0], now + qm.retry_delay * 2)
+
+        with mock.patch("time.time", mock_time):
+            doc = qm.pop()
+        self.assertEqual(doc.url, dm.url)
+        self.assertEqual(doc.depth, dm.depth)
+        self.assertEqual(doc.source, Source.normal)
+        self.assertEqual(doc.retries, 1)
+
+        # after max-retries the url is not retried anymore
+        doc.retries = qm.max_retries
+        doc.alternatives = [doc.url]
+        qm.add_retry(doc)
+        self.assertEqual(len(qm.retry_store.getall()), 1)
+        self.assertFalse(qm.seen.is_new(doc.url))
+        self.assertEqual(len(qm.refetch_store.getall()), 1)
+
+        # a known page is rescheduled without overwriting its fingerprint
+        dm3 = DocumentMetadata("http://www.randomurl2.it")
+        dm3.alternatives = [dm3.url]
+        dm3.dhash = 121212
+        dm3.source = Source.refetch
+        dm3.delay = 500
+        qm.add_seen_and_reschedule(dm3)
+        dm3.dhash = 0
+        dm3.retries = qm.max_retries
+        qm.add_retry(dm3)
+        self.assertEqual(qm.seen.get(dm3.url)["page_hash"], 121212)
+        refetch = [r for r in qm.refetch_store.getall() if r[1] == dm3.url]
+        self.assertEqual(refetch[-1][2], 1000)
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    @mock.patch('pymongo.MongoClient')
+    def test_host_failures(self, mc):
+        '''Test the failures of the hosts are forgotten'''
+        mc.return_value = mongomock.MongoClient()
+        qm = QueueManager("queues-names", START_DELAY, CONFIGURATION)
+        with freeze_time("2018-05-01 10:00"):
+            self.assertEqual(qm._host_failed("www.a.com"), 1)
+            self.assertEqual(qm._host_failed("www.a.com"), 2)
+        # the urls of the host are already retried: start again
+        with freeze_time("2018-05-01 12:01"):
+            self.assertEqual(qm._host_failed("www.a.com"), 1)
+
+        with mock.patch("core.queue_manager.MAX_FAILING_HOSTS", 2):
+            qm._host_failed("www.b.com")
+            qm._host_failed("www.a.com")
+            qm._host_failed("www.c.com")
+        self.assertEqual(list(qm.host_failures), ["www.a.com", "www.c.com"])
+
 
 class TestQueueRescheduling(BaseTestClass):
     @mock.patch('redis.StrictRedis', mock_strict_redis_client)
@@ -361,6 +599,7 @@ class TestQueueRescheduling(BaseTestClass):
         # not taken from priority queue
         # I expect: doublig the delay and set seen counter to 1
         dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.response = mock.Mock(status_code=200)
         dm.depth = 1
         dm.dhash = 12345
         dm.source = Source.normal
@@ -400,6 +639,7 @@ class TestQueueRescheduling(BaseTestClass):
         # not taken from priority queue
         # I expect: halfing the delay and set seen counter to 1
         dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.response = mock.Mock(status_code=200)
         dm.depth = 1
         dm.dhash = 1936
         dm.source = Source.normal
@@ -420,12 +660,43 @@ class TestQueueRescheduling(BaseTestClass):
         self.assertEqual(refetching_data.delay, dm.delay/2)
         self.assertEqual(refetching_data.source, Source.refetch)
 
+    @freeze_time(CURRENT_TIME)
+    def test_reschedule_not_modified(self):
+        ############################################
+        # the server answered 304 to a conditional refetch
+        # I expect: doubling the delay, the fetch counted in the history
+        #           of the seen entry and validators kept for the next refetch
+        dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.depth = 1
+        dm.source = Source.refetch
+        dm.delay = 5000
+        dm.etag = '"abc"'
+        dm.response = mock.Mock(status_code=304)
+        before = self.qm.seen.get(dm.url)
+
+        self.qm.add_seen_and_reschedule(dm)
+
+        after = self.qm.seen.get(dm.url)
+        self.assertEqual(after["page_hash"], before["page_hash"])
+        self.assertEqual(after["history"]["fetches"],
+                         before["history"]["fetches"] + 1)
+        self.assertEqual(after["history"]["changes"],
+                         before["history"]["changes"])
+        self.assertEqual(dm.history, after["history"])
+        with mock.patch("time.time", mock_time):
+            refetching_data = self.qm.pop()
+        self.assertEqual(refetching_data.url, dm.url)
+        self.assertEqual(refetching_data.delay, dm.delay*2)
+        self.assertEqual(refetching_data.etag, '"abc"')
+        self.assertIsNone(refetching_data.last_modified)
+
     @freeze_time(CURRENT_TIME)
     def test_reschedule3(self):
         ############################################
         # as before but with a small delay.
         # cheking delay not changing
         dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.response = mock.Mock(status_code=200)
         dm.depth = 1
         dm.dhash = 121212
         dm.source = Source.normal
@@ -539,6 +810,7 @@ class TestNewsQueueRescheduling(BaseTestClass):
         # not taken from priority queue
         # I expect: doublig the delay and set seen counter to 1
         dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.response = mock.Mock(status_code=200)
         dm.depth = 1
         dm.dhash = 12345
         dm.source = Source.normal
@@ -579,6 +851,7 @@ class TestNewsQueueRescheduling(BaseTestClass):
         # not taken from priority queue
         # I expect: doublig the delay and set seen counter to 1
         dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.response = mock.Mock(status_code=200)
         dm.depth = 1
         dm.dhash = 12345
         dm.source = Source.normal
@@ -618,6 +891,7 @@ class TestNewsQueueRescheduling(BaseTestClass):
         # not taken from priority queue
         # I expect: halving the delay and set seen counter to 1
         dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.response = mock.Mock(status_code=200)
         dm.depth = 1
         dm.dhash = 1936
         dm.source = Source.normal
@@ -690,5 +964,85 @@ class TestNewsQueueRescheduling(BaseTestClass):
         self.assertEqual(refetching_data.source, Source.priority)
 
 
+
+class TestChangeRateQueueRescheduling(BaseTestClass):
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    @mock.patch('pymongo.MongoClient')
+    def setUp(self, mc):
+        super(TestChangeRateQueueRescheduling, self).setUp()
+        mc.return_value = mongomock.MongoClient()
+        self.qm = QueueManager("queues-names", START_DELAY,
+                               CONFIGURATION_CHANGE_RATE)
+
+    def test_reschedule_never_changed(self):
+        ############################################
+        # a page fetched three times, one day apart, without changes
+        # I expect: base strategy until the change rate is known, then
+        #           refetching after the max delay
+        dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.response = mock.Mock(status_code=200)
+        dm.alternatives = ["http://www.randomurl1.it"]
+        dm.dhash = 121212
+        dm.source = Source.refetch
+        delays = []
+        for day in ["2018-05-01", "2018-05-02", "2018-05-03"]:
+            with freeze_time(day):
+                self.qm.add_seen_and_reschedule(dm)
+            dm.delay = self.qm.refetch_store.pop()[2]
+            delays.append(dm.delay)
+
+        self.assertEqual(delays, [3, 6, MAX_DELAY])
+        history = self.qm.seen.get(dm.url)["history"]
+        self.assertEqual(history["fetches"], 3)
+        self.assertEqual(history["changes"], 0)
+
+    def test_reschedule_failed_fetch(self):
+        ############################################
+        # a page fetched twice without changes, with an error in between
+        # I expect: the error is neither a fetch nor a change
+        dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.response = mock.Mock(status_code=200)
+        dm.alternatives = ["http://www.randomurl1.it"]
+        dm.dhash = 121212
+        dm.source = Source.refetch
+        self.qm.add_seen_and_reschedule(dm)
+
+        failed = DocumentMetadata("http://www.randomurl1.it")
+        failed.alternatives = ["http://www.randomurl1.it"]
+        failed.source = Source.refetch
+        failed.status = Status.ConnectionError
+        failed.response = mock.Mock(status_code=503)
+        self.qm.add_seen_and_reschedule(failed)
+
+        dm.status = Status.Success
+        self.qm.add_seen_and_reschedule(dm)
+
+        entry = self.qm.seen.get(dm.url)
+        self.assertEqual(entry["page_hash"], 121212)
+        self.assertEqual(entry["history"]["fetches"], 2)
+        self.assertEqual(entry["history"]["changes"], 0)
+
+    def test_reschedule_not_requested(self):
+        ############################################
+        # a url never requested: robots.txt was unavailable until the
+        # retries ran out
+        # I expect: no fetch in the history, the first real fetch is
+        #           not a change
+        dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.alternatives = ["http://www.randomurl1.it"]
+        dm.source = Source.refetch
+        self.qm.add_seen_and_reschedule(dm)
+        self.assertNotIn("history", self.qm.seen.get(dm.url) or {})
+
+        dm.dhash = 121212
+        dm.status = Status.Success
+        dm.response = mock.Mock(status_code=200)
+        self.qm.add_seen_and_reschedule(dm)
+
+        history = self.qm.seen.get(dm.url)["history"]
+        self.assertEqual(history["fetches"], 1)
+        self.assertEqual(history["changes"], 0)
+
+
 if __name__ == "__main__":
     unittest.main()
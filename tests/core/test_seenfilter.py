@@ -0,0 +1,132 @@
+import mock
+import unittest
+import mongomock
+
+from core.seen_filter import CountingBloomFilter, SeenFilter
+from core.seen_manager import canonize, SeenManager
+from core.metadata import DocumentMetadata
+from databases.mongodb_datastore import MongoDBPageHash
+from tests.test_base import BaseTestClass
+
+
+class TestSeenFilter(BaseTestClass):
+    def test_bloom_add_and_remove(self):
+        bf = CountingBloomFilter(1000, 0.01)
+        keys = ["www.url%d.com" % i for i in range(500)]
+        for k in keys:
+            bf.add(k)
+
+        for k in keys:
+            self.assertTrue(k in bf)
+        false_positives = sum(1 for i in range(1000)
+                              if "www.other%d.com" % i in bf)
+        self.assertTrue(false_positives < 50)
+
+        for k in keys[:250]:
+            bf.remove(k)
+        # removing keys never breaks the others
+        for k in keys[250:]:
+            self.assertTrue(k in bf)
+
+    def test_bloom_save_and_load(self):
+        bf = CountingBloomFilter(100)
+        bf.add(u"www.url.com/\xe8")
+        bf.save(self.tmp_file, keys=1)
+
+        loaded, info = CountingBloomFilter.load(self.tmp_file)
+        self.assertEqual(info, {"keys": 1})
+        self.assertEqual(loaded.counters, bf.counters)
+        self.assertTrue(u"www.url.com/\xe8" in loaded)
+
+    @mock.patch('pymongo.MongoClient')
+    def test_snapshot(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        store = MongoDBPageHash("test", "host", 0, "db")
+        store.add("www.url1.com", 1)
+        cfg = {"capacity": 100, "snapshot-path": self._tmp_path}
+
+        # the first filter is built from the store
+        sf = SeenFilter("test", store, cfg)
+        self.assertTrue("www.url1.com" in sf)
+        sf.add("www.url2.com")
+        store.add("www.url2.com", 1)
+        sf.snapshot()
+
+        # the snapshot is used when it is up to date
+        with mock.patch.object(SeenFilter, "_build") as build:
+            sf = SeenFilter("test", store, cfg)
+            self.assertFalse(build.called)
+        self.assertTrue("www.url2.com" in sf)
+
+        # without a clean close the filter is built again: the snapshot
+        # would miss the keys added meanwhile (with the same count)
+        sf.add("www.url3.com")
+        store.add("www.url3.com", 1)
+        store.delete("www.url1.com")
+        with mock.patch.object(SeenFilter, "_build") as build:
+            SeenFilter("test", store, cfg)
+            self.assertTrue(build.called)
+
+        # also when the store changed after the snapshot
+        sf.snapshot()
+        store.add("www.url4.com", 1)
+        sf = SeenFilter("test", store, cfg)
+        self.assertTrue("www.url4.com" in sf)
+
+    @mock.patch('pymongo.MongoClient')
+    def test_seenmanager_with_filter(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        sm = SeenManager("test", "host", 0, "db", {"capacity": 100})
+
+        dmeta = DocumentMetadata("http://www.google.com")
+        dmeta.alternatives = ["http://www.google.com",
+                              "http://www.google2.com/",
+        ]
+        dmeta.dhash = 2413242
+        sm.add(dmeta)
+
+        for u in dmeta.alternatives:
+            self.assertTrue(canonize(u) in sm.filter)
+            self.assertFalse(sm.is_new(u))
+
+        # new urls do not reach the store
+        with mock.patch.object(MongoDBPageHash, "__contains__") as contains:
+            self.assertTrue(sm.is_new("http://www.test.com"))
+            self.assertFalse(contains.called)
+
+        # refetches add only the new alternatives
+        counters = sum(sm.filter.filter.counters)
+        sm.observe(dmeta)
+        sm.observe(dmeta)
+        self.assertEqual(sum(sm.filter.filter.counters), counters)
+        dmeta.alternatives.append("http://www.google3.com")
+        sm.observe(dmeta)
+        self.assertTrue(canonize("http://www.google3.com") in sm.filter)
+
+        # so removed urls leave the filter
+        sm.delete(dmeta.url)
+        self.assertEqual(sum(sm.filter.filter.counters), 0)
+        for u in dmeta.alternatives:
+            self.assertTrue(sm.is_new(u))
+
+    @mock.patch('pymongo.MongoClient')
+    def test_snapshot_errors(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        store = MongoDBPageHash("test", "host", 0, "db")
+        cfg = {"capacity": 100, "snapshot-path": self._tmp_path}
+        sf = SeenFilter("test", store, cfg)
+        sf.logger = mock.Mock()
+
+        # adding keys never saves the filter
+        with mock.patch.object(sf.filter, "save") as save:
+            sf.add("www.url1.com")
+            self.assertFalse(save.called)
+
+        # a failed snapshot does not stop the crawler
+        with mock.patch("os.rename", side_effect=OSError("no such file")):
+            sf.snapshot()
+        self.assertEqual(sf.logger.warning.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -136,6 +136,30 @@ class TestSeenManager(BaseTestClass):
         for u in other_urls:
             self.assertTrue(sm.is_new(canonize(u)))
 
+    @mock.patch('pymongo.MongoClient')
+    def test_split_new(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        sm = SeenManager("test", "host", 0, "db")
+
+        dmeta = DocumentMetadata("http://www.google.com")
+        dmeta.alternatives = ["http://www.google.com",
+                              "http://www.google2.com/",
+        ]
+        dmeta.dhash = 2413242
+        sm.add(dmeta)
+
+        urls = ["https://www.google.com/", "http://www.test.com",
+                "http://www.google2.com", "http://www.other.com"]
+        new, seen = sm.split_new(urls)
+        self.assertEqual(new, ["http://www.test.com", "http://www.other.com"])
+        self.assertEqual([d["_id"] for d in seen],
+                         ["www.google.com", "www.google2.com"])
+
+        # each seen url increases the counters of all its alternatives
+        sm.incr_n_many(seen)
+        for i in dmeta.alternatives:
+            self.assertEqual(sm.get(i)["count"], 3)
+
     @mock.patch('pymongo.MongoClient')
     def test_incr_n(self, mc):
         mc.return_value = mongomock.MongoClient()
@@ -182,6 +206,81 @@ class TestSeenManager(BaseTestClass):
         for u in dmeta.alternatives:
             self.assertTrue(sm.is_changed(u, dmeta.dhash+3))
 
+    @mock.patch('pymongo.MongoClient')
+    def test_observe(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        sm = SeenManager("test", "host", 0, "db")
+
+        dmeta = DocumentMetadata("http://www.google.com")
+        dmeta.alternatives = ["http://www.google.com",
+                              "http://www.google2.com/",
+        ]
+        dmeta.dhash = 2413242
+
+        is_new, is_changed, prev_alt = sm.observe(dmeta)
+        self.assertTrue(is_new)
+        self.assertTrue(is_changed)
+        self.assertEqual(prev_alt, [])
+
+        # same page with a new alternative
+        dmeta.alternatives = ["http://www.google.com",
+                              "https://www.google3.com",
+        ]
+        # two different bits
+        dmeta.dhash ^= 0b11
+        with mock.patch.object(sm.store, "get", wraps=sm.store.get) as get:
+            is_new, is_changed, prev_alt = sm.observe(dmeta)
+            self.assertEqual(get.call_count, 1)
+        self.assertFalse(is_new)
+        self.assertFalse(is_changed)
+        self.assertEqual(sorted(prev_alt), ["www.google.com", "www.google2.com"])
+
+        # all the alternatives are merged
+        for u in ["www.google.com", "www.google2.com", "www.google3.com"]:
+            data = sm.get(u)
+            self.assertEqual(len(data["alternatives"]), 3)
+            self.assertEqual(data["page_hash"], dmeta.dhash)
+
+        # three different bits
+        dmeta.dhash ^= 0b111
+        is_new, is_changed, _ = sm.observe(dmeta)
+        self.assertFalse(is_new)
+        self.assertTrue(is_changed)
+
+        # the cache validators are stored with the entry
+        dmeta.etag = '"abc"'
+        sm.observe(dmeta)
+        self.assertEqual(sm.get("www.google.com")["etag"], '"abc"')
+        self.assertNotIn("last_modified", sm.get("www.google.com"))
+
+        # fetches and changes are counted in the history
+        history = sm.get("www.google3.com")["history"]
+        self.assertEqual(history["fetches"], 4)
+        self.assertEqual(history["changes"], 1)
+        self.assertEqual(dmeta.history, history)
+
+        # also the fetches of a page not modified
+        sm.observe_not_modified(dmeta)
+        self.assertEqual(sm.get("www.google.com")["history"]["fetches"], 5)
+        self.assertEqual(dmeta.history["fetches"], 5)
+
+        # a failed fetch changes nothing
+        entry = sm.get("www.google.com")
+        failed = DocumentMetadata("http://www.google.com")
+        failed.alternatives = ["http://www.google.com"]
+        self.assertEqual(sm.observe(failed, fetched=False)[:2],
+                         (False, False))
+        self.assertEqual(sm.get("www.google.com"), entry)
+        self.assertEqual(failed.history, entry["history"])
+
+        # a new url is seen, without history
+        failed = DocumentMetadata("http://www.google4.com")
+        failed.alternatives = ["http://www.google4.com"]
+        self.assertEqual(sm.observe(failed, fetched=False)[:2], (True, True))
+        self.assertFalse(sm.is_new("www.google4.com"))
+        self.assertNotIn("history", sm.get("www.google4.com"))
+        self.assertIsNone(failed.history)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,100 @@
+import mock
+import unittest
+import threading
+
+from core.spider_pool import SpiderPool
+from tests.test_base import BaseTestClass
+from utils.signals_handlers import GracefulKiller
+
+
+class FakeCrawler(object):
+    def __init__(self, name, delay, steps):
+        self.spider = mock.Mock(delay=delay)
+        self.spider.name = name
+        self.steps = steps
+        self.stopped = False
+
+    def setup(self):
+        pass
+
+    def step(self):
+        self.steps.append(self.spider.name)
+        if self.spider.name == "broken":
+            raise ValueError("parsing error")
+        return self.spider.delay
+
+    def stop(self):
+        self.stopped = True
+
+
+class TestSpiderPool(BaseTestClass):
+    def setUp(self):
+        super(TestSpiderPool, self).setUp()
+        self.now = 1000.0
+        patcher = mock.patch("time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.now += seconds
+        if self.now >= 1020:
+            GracefulKiller.kill_now = True
+
+    def tearDown(self):
+        GracefulKiller.kill_now = False
+
+    def test_due_spider_first(self):
+        steps = []
+        crawlers = [FakeCrawler("slow", 10, steps),
+                    FakeCrawler("fast", 4, steps),
+                    FakeCrawler("broken", 15, steps)]
+        pool = SpiderPool(crawlers, threads=1)
+        pool._ready.wait = self.sleep
+        pool.logger = mock.Mock()
+        pool.start()
+
+        # fast is due at 1004, 1008, 1012, 1016; slow at 1010; broken at 1015
+        self.assertEqual(steps, ["slow", "fast", "broken",
+                                 "fast", "fast", "slow", "fast", "broken",
+                                 "fast"])
+        # a failing spider is rescheduled and does not stop the others
+        self.assertEqual(pool.logger.exception.call_count, 2)
+        self.assertTrue(all(c.stopped for c in crawlers))
+
+
+class TestSpiderPoolThreads(BaseTestClass):
+    def tearDown(self):
+        GracefulKiller.kill_now = False
+
+    def test_slow_host(self):
+        steps = []
+        released = threading.Event()
+
+        def slow_step():
+            # a fetch waiting a slow host
+            steps.append("slow")
+            released.wait(5)
+            steps.append("slow-done")
+            return 0
+
+        def fast_step():
+            steps.append("fast")
+            if steps.count("fast") == 3:
+                released.set()
+                GracefulKiller.kill_now = True
+            return 0
+
+        crawlers = [FakeCrawler("slow", 0, steps),
+                    FakeCrawler("fast", 0, steps)]
+        crawlers[0].step = slow_step
+        crawlers[1].step = fast_step
+        SpiderPool(crawlers, threads=2).start()
+
+        # the other spider is stepped meanwhile
+        self.assertEqual(steps.count("fast"), 3)
+        self.assertEqual(steps.count("slow"), 1)
+        self.assertEqual(steps[-1], "slow-done")
+
+
+if __name__ == '__main__':
+    unittest.main()
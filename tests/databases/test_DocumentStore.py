@@ -1,9 +1,15 @@
 import json
 import mock
+import threading
 import unittest
+import mongomock
+
+from mockredis import mock_strict_redis_client
 
 import databases.document_store as ds
+import utils.metrics as metrics
 from spiders.document import Document
+from utils.helpers import canonize
 from tests.test_base import BaseTestClass, ordered
 
 
@@ -29,103 +35,31 @@ class TestDocumentStore(BaseTestClass):
         output.close()
         self.assertEqualTemporary()
 
-    @mock.patch('redis.StrictRedis.hset')
-    @mock.patch('redis.StrictRedis.hget')
-    def test_redisstore(self, mock_redis_get, mock_redis_set):
-        data = {}
-
-        def setter(table, key, val):
-            data[key] = val
-
-        def getter(table, key):
-            return data.get(key)
-
-        mock_redis_set.side_effect = setter
-        mock_redis_get.side_effect = getter
-        
-        input = self.input_data()
-        output = ds.RedisStore("", None, 0, 0)
-        input_dict = {}
-        count = 0
-        for i in input:
-            i = Document(json.loads(i))
-            output.store(i)
-            d = i.info
-            input_dict[d["url"]] = json.dumps(d)
-            count += 1
-
-        self.assertEqual(len(input), len(input_dict))
-        self.assertEqual(len(input), count)
-
-        count_reads = 0
-        for i in data:
-            d = json.loads(data[i])
-            url = d["url"]
-            count_reads += 1
-            self.assertTrue(url in input_dict)
-
-            tmpd = json.loads(input_dict[url])
-            del tmpd["fetched_time"]
-            del tmpd["status"]
-            self.assertEqual(ordered(tmpd), ordered(d))
-
-        self.assertEqual(count, count_reads)
-
-    @mock.patch('databases.mongodb_datastore.MongoDB.add')
-    @mock.patch('databases.mongodb_datastore.MongoDB.get')
-    def test_mongodbstore(self, mock_mongo_get, mock_mongo_set):
-        data = {}
-
-        def setter(key, val):
-            data[key] = val
-
-        def getter(key):
-            return data.get(key)
-
-        mock_mongo_set.side_effect = setter
-        mock_mongo_get.side_effect = getter
-        
-        input = self.input_data()
-        output = ds.MongoDBStore("", None, 0, "void")
+    def check_store(self, output, writer=None, input_file=None):
+        if input_file:
+            input = open(self._test_base_dir + "/data/" + input_file).readlines()
+        else:
+            input = self.input_data()
         input_dict = {}
-        count = 0
+        writer = writer or output
         for i in input:
-            i = Document(json.loads(i))
-            output.store(i)
-            d = i.info
-            input_dict[d["url"]] = d
-            count += 1
+            entries = json.loads(i)
+            # INFO: data are exported from mongodb
+            entries["hash"] = int(entries["hash"]["$numberLong"])
+            i = Document(entries)
+            writer.store(i)
+            d = output.get_info(i)
+            d["history"] = [[d.pop("fetched_time"), d.pop("status")]]
+            input_dict[canonize(d["url"])] = d
+        writer.close()
 
         self.assertEqual(len(input), len(input_dict))
-        self.assertEqual(len(input), count)
-
-        count_reads = 0
-        for i in data:
-            d = data[i]
-            url = d["url"]
-            count_reads += 1
-            self.assertTrue(url in input_dict)
-            tmpd = input_dict[url]
-            del tmpd["fetched_time"]
-            del tmpd["status"]
-            self.assertEqual(tmpd, d)
-            
-        self.assertEqual(count, count_reads)
-
-    @mock.patch('databases.mongodb_datastore.MongoDB.add')
-    @mock.patch('databases.mongodb_datastore.MongoDB.get')
-    def test_mongodbstore2(self, mock_mongo_get, mock_mongo_set):
-        data = {}
-
-        def setter(key, val):
-            data[key] = val
-
-        def getter(key):
-            return data.get(key)
-
-        mock_mongo_set.side_effect = setter
-        mock_mongo_get.side_effect = getter
+        for key, d in input_dict.items():
+            stored = output.db.get(key)
+            stored.pop("_id", None)
+            self.assertEqual(ordered(d), ordered(stored))
 
+    def check_history(self, output):
         url = "www.daniele.it"
         d1 = Document(
             {"url": url,
@@ -145,23 +79,250 @@ class TestDocumentStore(BaseTestClass):
             {"url": url,
              "status": 200,
              "fetched_time": "2018-01-08T02:01",
-             "hash": 131313}
+             "hash": 2 ** 63 - 1}
         )
 
+        output.store(d1)
+        output.store(d2)
+
+        data = output.db.get(url)
+        self.assertEqual(data["hash"], 111111)
+        self.assertEqual(data["history"], [["2018-01-08T02:01", 300],
+                                           ["2018-01-07T02:01", 200]])
+
+        output.store(d3)
+        # storing twice is harmless
+        output.store(d3)
+
+        data = output.db.get(url)
+        self.assertEqual(data["hash"], 2 ** 63 - 1)
+        self.assertEqual(len(data["history"]), 3)
+
+        for day in range(10, 30):
+            d2.fetched_time = "2018-01-%dT02:01" % day
+            output.store(d2)
+        data = output.db.get(url)
+        self.assertEqual(data["hash"], 2 ** 63 - 1)
+        self.assertEqual(len(data["history"]), ds.HISTORY_SIZE)
+        self.assertEqual(data["history"][0], ["2018-01-29T02:01", 300])
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    def test_redisstore(self):
+        self.check_store(ds.RedisStore("", None, 0, 0))
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    def test_redisstore2(self):
+        self.check_history(ds.RedisStore("", None, 0, 0))
+
+    @mock.patch('pymongo.MongoClient')
+    def test_mongodbstore(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        self.check_store(ds.MongoDBStore("", None, 0, "void"))
+
+    @mock.patch('pymongo.MongoClient')
+    def test_mongodbstore2(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        self.check_history(ds.MongoDBStore("", None, 0, "void"))
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    def test_redisstore_batch(self):
+        output = ds.RedisStore("", None, 0, 0)
+        self.check_store(output, ds.BatchingStore(output, 3), "redisstore_input")
+
+    @mock.patch('pymongo.MongoClient')
+    def test_mongodbstore_batch(self, mc):
+        mc.return_value = mongomock.MongoClient()
         output = ds.MongoDBStore("", None, 0, "void")
+        self.check_store(output, ds.BatchingStore(output, 3),
+                         "mongodbstore_input")
+        # entries already in the history are skipped also in batches
+        doc = Document({"url": "www.url.com", "status": 200,
+                        "fetched_time": "2018-01-07T02:01"})
+        output.store_many([doc, doc])
+        self.assertEqual(len(output.db.get("www.url.com")["history"]), 1)
 
+    def check_same_minute(self, output):
+        url = "www.url.com"
+        d1 = Document({"url": url, "status": 200, "hash": 1,
+                       "fetched_time": "2018-01-07T02:01", "fetch_id": "a"})
+        d2 = Document({"url": url, "status": 200, "hash": 2,
+                       "fetched_time": "2018-01-07T02:01", "fetch_id": "b"})
         output.store(d1)
         output.store(d2)
-        
-        self.assertEqual(1, len(data))
-        self.assertEqual(data[url]["hash"], 111111)
-        self.assertEqual(len(data[url]["history"]), 2)
+        output.store(d2)
+        data = output.db.get(url)
+        self.assertEqual(data["hash"], 2)
+        self.assertEqual(data["history"], [["2018-01-07T02:01", 200, "b"],
+                                           ["2018-01-07T02:01", 200, "a"]])
+        self.assertEqual(Document(data).status, 200)
 
-        output.store(d3)
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    def test_redisstore_same_minute(self):
+        self.check_same_minute(ds.RedisStore("", None, 0, 0))
+
+    @mock.patch('pymongo.MongoClient')
+    def test_mongodbstore_same_minute(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        self.check_same_minute(ds.MongoDBStore("", None, 0, "void"))
+
+    def test_batchingstore(self):
+        output = mock.Mock()
+        writer = ds.BatchingStore(output, batch_size=100, max_delay=60)
+        for i in range(250):
+            writer.store(i)
+        writer.close()
+        self.assertEqual([len(c[0][0]) for c in output.store_many.call_args_list],
+                         [100, 100, 50])
+        self.assertTrue(output.close.called)
+        self.assertEqual(writer.stats["documents"], 250)
+        self.assertEqual(writer.stats["batches"], 3)
+
+        # documents wait at most max_delay seconds
+        output = mock.Mock()
+        writer = ds.BatchingStore(output, batch_size=100, max_delay=0.01)
+        writer.store(1)
+        writer.flush()
+        output.store_many.assert_called_once_with([1])
+
+    def test_batchedstore(self):
+        # one writer for the stores of many spiders
+        writer = ds.BatchingStore(None, batch_size=10, max_delay=0.01)
+        outputs = [mock.Mock(), mock.Mock()]
+        stores = [ds.BatchedStore(writer, o) for o in outputs]
+        for i in range(5):
+            stores[i % 2].store(i)
+        stores[0].close()
+        for output, docs in zip(outputs, [[0, 2, 4], [1, 3]]):
+            self.assertEqual(sum((c[0][0] for c in
+                                  output.store_many.call_args_list), []),
+                             docs)
+        self.assertTrue(outputs[0].close.called)
+        self.assertFalse(outputs[1].close.called)
+        writer.close()
+
+    @mock.patch("databases.document_store.RETRY_DELAY", 0)
+    def test_batchingstore_errors(self):
+        # failed batches are retried, nothing is lost
+        output = mock.Mock()
+        output.store_many.side_effect = [Exception("error"),
+                                         Exception("error"), None, None]
+        writer = ds.BatchingStore(output, batch_size=100, max_delay=0.01)
+        writer.store(1)
+        writer.flush()
+        writer.store(2)
+        writer.close()
+        self.assertEqual([c[0][0] for c in output.store_many.call_args_list],
+                         [[1], [1], [1], [2]])
+        self.assertEqual(writer.stats["errors"], 2)
+        self.assertEqual(writer.stats["documents"], 2)
+        self.assertEqual(writer.stats["lost"], 0)
+
+        # after close the batch is given up
+        output = mock.Mock()
+        output.store_many.side_effect = Exception("error")
+        writer = ds.BatchingStore(output, batch_size=100, max_delay=60)
+        writer.store(1)
+        writer.close()
+        self.assertEqual(output.store_many.call_count, ds.CLOSE_RETRIES)
+        self.assertEqual(writer.stats["lost"], 1)
+
+    def test_batchingstore_bytes(self):
+        output = mock.Mock()
+        writer = ds.BatchingStore(output, batch_size=2, max_delay=60,
+                                  max_bytes=10)
+        # a slow backend
+        written = threading.Event()
+        output.store_many.side_effect = lambda docs: written.wait(5)
+        docs = [Document({"url": "www.url%d.com" % i, "raw_html": u"12345"})
+                for i in range(3)]
+        writer.store(docs[0])
+        writer.store(docs[1])
+        self.assertEqual(writer.stats["queued_bytes"], 10)
+
+        # the third document waits the first two are written
+        t = threading.Thread(target=writer.store, args=(docs[2],))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        written.set()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        writer.close()
+        self.assertEqual([c[0][0] for c in output.store_many.call_args_list],
+                         [docs[:2], docs[2:]])
+        self.assertEqual(writer.stats["queued_bytes"], 0)
+
+    def test_batchingstore_metrics(self):
+        metrics.registry.clear()
+        writer = ds.BatchingStore(mock.Mock(), batch_size=2, max_delay=60)
+        for i in range(3):
+            writer.store(i)
+        writer.close()
+        rendered = metrics.registry.render()
+        self.assertIn('crawleb_stage_seconds_count{stage="store"} 2', rendered)
+        self.assertIn('crawleb_store_batch_size_sum 3', rendered)
+
+    @mock.patch("databases.document_store.STATS_INTERVAL", -1)
+    def test_batchingstore_report(self):
+        writer = ds.BatchingStore(mock.Mock(), batch_size=1)
+        writer.logger = mock.Mock()
+        writer.store(1)
+        writer.flush()
+        # stats are logged while running, not only at close
+        self.assertIn("output stats", writer.logger.info.call_args[0][0])
+        writer.close()
+
+    def check_compression(self, output, read):
+        for i in open(self._test_base_dir + "/data/redisstore_input"):
+            entries = json.loads(i)
+            entries["hash"] = int(entries["hash"]["$numberLong"])
+            output.store(Document(entries))
+            stored = read(canonize(entries["url"]))
+            self.assertTrue(len(stored["raw_html"]) * 3 <
+                            len(entries["raw_html"]))
+            doc = Document(stored)
+            self.assertEqual(doc.raw_html, entries["raw_html"])
+            self.assertEqual(doc.info["raw_html"], entries["raw_html"])
+
+    def test_compression(self):
+        output = ds.JsonStore(self.tmp_file, "zlib")
+
+        def read_json(key):
+            output.fd.flush()
+            return json.loads(open(self.tmp_file).readlines()[-1])
+        self.check_compression(output, read_json)
+
+        with mock.patch('redis.StrictRedis', mock_strict_redis_client):
+            output = ds.RedisStore("", None, 0, 0, "zlib")
+            self.check_compression(output, output.db.get)
+
+        with mock.patch('pymongo.MongoClient') as mc:
+            mc.return_value = mongomock.MongoClient()
+            output = ds.MongoDBStore("", None, 0, "void", "zlib")
+            self.check_compression(output, output.db.get)
+
+            # compression turned off: the page is readable again
+            output = ds.MongoDBStore("", None, 0, "void")
+            doc = Document({"url": "www.url.com", "status": 200,
+                            "fetch_id": "a", "raw_html": u"<p>new</p>"})
+            output.store(doc)
+            stored = output.db.get("www.url.com")
+            self.assertIsNone(stored["raw_html_codec"])
+            self.assertEqual(Document(stored).raw_html, u"<p>new</p>")
+
+        with self.assertRaises(ValueError):
+            ds.MongoDBStore("", None, 0, "void", "gzip")
 
-        self.assertEqual(1, len(data))
-        self.assertEqual(data[url]["hash"], 131313)
-        self.assertEqual(len(data[url]["history"]), 3)
+    def test_compressed_document(self):
+        doc = Document({"url": "www.url.com", "raw_html": u"<p>\xe8</p>"})
+        info = doc.compressed_info("zlib", text=True)
+        self.assertEqual(info["raw_html_codec"], "zlib+base64")
+        compressed = Document(info)
+        # already compressed data is not compressed again
+        self.assertEqual(compressed.compressed_info("zlib", text=True), info)
+        self.assertEqual(compressed.raw_html, u"<p>\xe8</p>")
+        self.assertIsNone(compressed.raw_html_codec)
+        self.assertEqual(compressed.info, doc.info)
 
 
 if __name__ == '__main__':
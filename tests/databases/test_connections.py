@@ -0,0 +1,59 @@
+import mock
+import unittest
+
+import redis
+from redis.connection import PythonParser
+
+from databases import connections
+from databases.redis_queues import RedisPriorityQueue, RedisHash
+from tests.test_base import BaseTestClass
+
+
+class TestConnections(BaseTestClass):
+    def tearDown(self):
+        connections.configure({})
+        connections.reset()
+
+    def test_shared_redis_client(self):
+        q1 = RedisPriorityQueue("q1", "localhost", 6379, 0)
+        q2 = RedisHash("q2", "localhost", 6379, 0)
+        q3 = RedisHash("q3", "localhost", 6379, 1)
+        self.assertIs(q1._r, q2._r)
+        self.assertIsNot(q1._r, q3._r)
+
+        connections.reset()
+        self.assertIsNot(connections.redis_client("localhost", 6379, 0), q1._r)
+
+    def test_redis_options(self):
+        connections.configure({"redis": {"max-connections": 7,
+                                         "socket-keepalive": True,
+                                         "hiredis": False}})
+        pool = connections.redis_client("localhost", 6379, 0).connection_pool
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 7)
+        self.assertTrue(pool.connection_kwargs["socket_keepalive"])
+        self.assertIs(pool.connection_kwargs["parser_class"], PythonParser)
+
+        connections.configure({})
+        pool = connections.redis_client("localhost", 6379, 1).connection_pool
+        self.assertNotIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertNotIn("parser_class", pool.connection_kwargs)
+
+    @mock.patch('pymongo.MongoClient')
+    def test_shared_mongodb_client(self, mc):
+        connections.configure({"mongodb": {"max-pool-size": 5,
+                                           "socket-keepalive": True}})
+        c1 = connections.mongodb_client("localhost", 27017)
+        c2 = connections.mongodb_client("localhost", 27017)
+        self.assertIs(c1, c2)
+        mc.assert_called_once_with("localhost", 27017, maxPoolSize=5,
+                                   socketKeepAlive=True)
+
+        # a forked process creates its own clients
+        with mock.patch("os.getpid", return_value=-1):
+            connections.mongodb_client("localhost", 27017)
+        self.assertEqual(mc.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
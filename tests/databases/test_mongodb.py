@@ -62,6 +62,21 @@ class TestMongodb(BaseTestClass):
             self.assertEqual(result["count"], data_dict[i][1] + 1)
             self.assertEqual(result["alternatives"], data_dict[i][2])
 
+    @mock.patch('pymongo.MongoClient')
+    def test_mongohash_many(self, mc):
+        mc.return_value = mongomock.MongoClient()
+        database = mongo.MongoDBPageHash("tes", "test", 111, "test")
+        database.add("k1", 1234, 1, ["k1"])
+        database.add("k2", 1235, 3, ["k2"])
+
+        stored = database.get_many(["k1", "k2", "k3"])
+        self.assertEqual(sorted(stored), ["k1", "k2"])
+        self.assertEqual(stored["k2"]["page_hash"], 1235)
+
+        database.incr_many({"k1": 2, "k2": 1})
+        self.assertEqual(database.get("k1")["count"], 3)
+        self.assertEqual(database.get("k2")["count"], 4)
+
 
 if __name__ == '__main__':
     unittest.main()
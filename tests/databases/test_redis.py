@@ -1,5 +1,6 @@
 import json
 import mock
+import time
 import unittest
 
 from mockredis import mock_strict_redis_client
@@ -41,6 +42,26 @@ class TestRedisPriority(BaseTestClass):
             self.assertEqual(self.redis_client.pop(self.max_prio + 1), tmp_obj)
         self.assertIsNone(self.redis_client.pop(self.max_prio + 1))
 
+    def test_redis_pop_many(self):
+        # only the items ready at the given time are returned, in order
+        results = self.redis_client.pop_many(10, 150)
+        expected = [i for i in self.sorted_input if i[0] <= 150]
+        self.assertEqual(results, json.loads(json.dumps(expected)))
+
+        # the remaining items are still there
+        results = self.redis_client.pop_many(1)
+        self.assertEqual(results, json.loads(json.dumps(self.sorted_input[2:3])))
+        results = self.redis_client.pop_many(10)
+        self.assertEqual(results, json.loads(json.dumps(self.sorted_input[3:])))
+        self.assertEqual(self.redis_client.pop_many(10), [])
+
+    def test_redis_push_many(self):
+        self.redis_client.clear()
+        self.redis_client.push_many([(i, i[0]) for i in self.input_data])
+        results = self.redis_client.getall()
+        self.assertEqual(results, json.loads(json.dumps(self.sorted_input)))
+        self.assertEqual(self.redis_client.push_many([]), 0)
+
     def test_redis_getall(self):
         results = self.redis_client.getall()
         self.assertEqual(len(results), len(self.input_data))
@@ -59,6 +80,119 @@ class TestRedisPriority(BaseTestClass):
         self.assertIsNone(self.redis_client.pop(self.max_prio + 1))
 
 
+class TestRedisHostQueue(BaseTestClass):
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    def setUp(self):
+        super(TestRedisHostQueue, self).setUp()
+        self.redis_client = rq.RedisHostQueue("test", None, 0, 5, 10,
+                                              lambda item: item[1])
+        # (depth, host, path)
+        self.input_data = [
+            (1, "a.com", "/1"),
+            (2, "a.com", "/2"),
+            (3, "a.com", "/3"),
+            (2, u"b.com", "/1"),
+            (1, "b.com", "/2"),
+        ]
+        self.redis_client.push_many([(i, i[0]) for i in self.input_data[:3]])
+        self.redis_client.push_many([(i, i[0]) for i in self.input_data[3:]])
+
+    def test_pop_hosts_take_turns(self):
+        self.assertEqual(len(self.redis_client.getall()), 5)
+        now = int(time.time())
+        # a.com was ready first, then b.com
+        self.assertEqual(self.redis_client.pop(now), [1, "a.com", "/1"])
+        self.assertEqual(self.redis_client.pop(now), [1, "b.com", "/2"])
+        # both hosts wait the delay
+        self.assertIsNone(self.redis_client.pop(now + 5))
+        self.assertEqual(self.redis_client.pop(now + 10), [2, "a.com", "/2"])
+        self.assertEqual(self.redis_client.pop(now + 10), [2, "b.com", "/1"])
+        self.assertEqual(self.redis_client.pop(now + 20), [3, "a.com", "/3"])
+
+        # empty hosts are removed
+        self.assertIsNone(self.redis_client.pop(now + 100))
+        self.assertEqual(self.redis_client.hosts(), [])
+
+    def test_delete_and_clear(self):
+        self.redis_client.delete(self.input_data[0])
+        self.assertEqual(len(self.redis_client.getall()), 4)
+        self.redis_client.clear()
+        self.assertEqual(self.redis_client.getall(), [])
+        self.assertIsNone(self.redis_client.pop(int(time.time()) + 100))
+
+
+class TestRedisLeases(BaseTestClass):
+    def setUp(self):
+        super(TestRedisLeases, self).setUp()
+        # leases and queues share the same redis
+        patcher = mock.patch('redis.StrictRedis',
+                             return_value=mock_strict_redis_client())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_leased_pop(self):
+        leases = rq.RedisLeases("test-inflight", None, 0, 5)
+        queue = rq.RedisPriorityQueue("test", None, 0, 5)
+        queue.push(["a"], 10)
+        queue.push(["b"], 20)
+
+        self.assertIsNone(queue.pop_leased(leases, 100, 5))
+        item, lease = queue.pop_leased(leases, 100, 15)
+        self.assertEqual(item, ["a"])
+        self.assertEqual(len(leases), 1)
+        # a leased item is not popped again
+        self.assertEqual(queue.pop_leased(leases, 100)[0], ["b"])
+        self.assertIsNone(queue.pop_leased(leases, 100))
+
+        # acknowledged leases are not reaped
+        self.assertEqual(leases.ack(lease), 1)
+        self.assertEqual(leases.reap(99), 0)
+        self.assertEqual(leases.reap(100), 1)
+        self.assertEqual(len(leases), 0)
+        self.assertEqual(queue.getall(), [["b"]])
+        # with the same priority
+        self.assertIsNone(queue.pop(15))
+
+    def test_leased_host_pop(self):
+        leases = rq.RedisLeases("test-inflight", None, 0, 5)
+        queue = rq.RedisHostQueue("test", None, 0, 5, 10, lambda item: item[1])
+        now = int(time.time())
+        queue.push((1, "a.com"), 1)
+
+        item, lease = queue.pop_leased(leases, now + 100, now)
+        self.assertEqual(item, [1, "a.com"])
+        self.assertIsNone(queue.pop(now + 50))
+        # the host has no items and it is removed
+        self.assertEqual(queue.hosts(), [])
+
+        # back in its host queue, and the host is ready
+        self.assertEqual(leases.reap(now + 100), 1)
+        self.assertEqual(queue.pop(now + 100), [1, "a.com"])
+
+    def test_sync(self):
+        leases = rq.RedisLeases("test-inflight", None, 0, 5)
+        queue = rq.RedisPriorityQueue("test", None, 0, 5)
+        items = [((1, "a"), 1), ((1, "b"), 1), ((1, "c"), 1)]
+        self.assertEqual(queue.sync(items, 1, leases), 3)
+        # another crawler starts: nothing is added again
+        self.assertEqual(queue.sync(items, 1, leases), 0)
+        self.assertEqual(len(queue), 3)
+
+        # leased or rescheduled items are not pushed
+        self.assertEqual(queue.pop_leased(leases, 100, 1)[0], [1, "a"])
+        self.assertEqual(queue.pop(1), [1, "b"])
+        queue.push((50, "b"), 50)
+        self.assertEqual(queue.sync(items, 1, leases), 0)
+        self.assertEqual(sorted(i[1] for i in queue.getall()), ["b", "c"])
+
+        # items no longer in the list are removed (duplicates too)
+        queue.push((2, "c"), 2)
+        self.assertEqual(queue.sync(items[1:], 1), 0)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.sync(items[1:2], 1), 0)
+        self.assertEqual(queue.getall(), [[50, "b"]])
+
+
 class TestRedisNormal(BaseTestClass):
     @mock.patch('redis.StrictRedis', mock_strict_redis_client)
     def setUp(self):
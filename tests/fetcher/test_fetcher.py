@@ -1,3 +1,4 @@
+import io
 import mock
 import unittest
 import requests
@@ -11,13 +12,21 @@ class DataResponse():
     def __init__(self, content, status):
         self.content = content
         self.status = status
+        self.status_code = status
+        self.headers = {}
+
+    def iter_content(self, size):
+        yield self.content
+
+    def close(self):
+        pass
 
 
 class MockResponse():
     def __init__(self, c, s):
         self.dr = DataResponse(c, s)
 
-    def get(self, url):
+    def get(self, url, **kwargs):
         if self.dr.status == 301:
             raise requests.exceptions.TooManyRedirects
         elif self.dr.status == 500:
@@ -34,7 +43,7 @@ class MockResponse():
 
 
 class TestFetcher(BaseTestClass):
-    @mock.patch("utils.requests_wrapper.requests_retry_session")
+    @mock.patch("utils.requests_wrapper.get_session")
     def test_fetcher(self, session):
         for i in self.input_data():
             url, content, status = i.split("\t")
@@ -42,7 +51,7 @@ class TestFetcher(BaseTestClass):
             dm = DocumentMetadata(url)
             mr = MockResponse(content, status)
             session.return_value = mr
-            new_dm = fetcher.fetch({}, dm, 1)
+            new_dm = fetcher.fetch({}, dm)
             self.assertEqual(dm.url, url)
             if status == 200:
                 self.assertEqual(dm.status, 0)
@@ -50,13 +59,93 @@ class TestFetcher(BaseTestClass):
                 self.assertEqual(new_dm.response.content, content)
             elif status == 301:
                 self.assertEqual(dm.status, fetcher.Status.SkipUrl)
-            elif status == 0:
+            elif status in (0, 501):
+                # network errors and timeouts are retried
                 self.assertEqual(dm.status, fetcher.Status.ConnectionError)
             elif status >= 500 and status < 510:
                 self.assertEqual(dm.status, fetcher.Status.SkipUrl)
             else:
                 self.assertEqual(dm.status, fetcher.Status.GenericError)
 
+    @mock.patch("utils.requests_wrapper.get_session")
+    def test_timeouts(self, session):
+        for error in [requests.exceptions.ConnectTimeout,
+                      requests.exceptions.ReadTimeout]:
+            session.return_value.get.side_effect = error("timed out")
+            dm = fetcher.fetch({}, DocumentMetadata("http://www.slow.com"),
+                               timeout=(10, 60))
+            self.assertEqual(dm.status, fetcher.Status.ConnectionError)
+            self.assertIsNone(dm.response)
+
+    @mock.patch("utils.requests_wrapper.get_session")
+    def test_conditional_fetch(self, session):
+        response = DataResponse("content", 200)
+        response.headers = {"ETag": '"abc"',
+                            "Last-Modified": "Wed, 30 May 2018 10:00:00 GMT"}
+        session.return_value.get.return_value = response
+
+        # first fetch: no validators to send
+        dm = fetcher.fetch({}, DocumentMetadata("http://www.randomurl1.it"))
+        self.assertEqual(session.return_value.get.call_args[1]["headers"], {})
+        self.assertEqual(dm.etag, '"abc"')
+        self.assertEqual(dm.last_modified, "Wed, 30 May 2018 10:00:00 GMT")
+
+        # refetch: the page is not changed
+        response = DataResponse("", fetcher.NOT_MODIFIED)
+        session.return_value.get.return_value = response
+        dm = fetcher.fetch({}, dm)
+        self.assertEqual(session.return_value.get.call_args[1]["headers"],
+                         {"If-None-Match": '"abc"',
+                          "If-Modified-Since": "Wed, 30 May 2018 10:00:00 GMT"})
+        self.assertEqual(dm.status, fetcher.Status.Success)
+        self.assertEqual(dm.etag, '"abc"')
+
+        # the page changed and the server does not send validators anymore
+        session.return_value.get.return_value = DataResponse("new", 200)
+        dm = fetcher.fetch({}, dm)
+        self.assertIsNone(dm.etag)
+        self.assertIsNone(dm.last_modified)
+
+    @mock.patch("utils.requests_wrapper.get_session")
+    def test_streaming_fetch(self, session):
+        def response(body, headers):
+            r = requests.Response()
+            r.status_code = 200
+            r.raw = io.BytesIO(body)
+            r.headers.update(headers)
+            return r
+        html = "<html>" + "a" * 1000 + "</html>"
+        types = ["text/html"]
+
+        session.return_value.get.return_value = response(
+            html, {"Content-Type": "text/html; charset=utf-8"})
+        dm = fetcher.fetch({}, DocumentMetadata("http://www.randomurl1.it"),
+                           (1, 2), 2000, types)
+        self.assertEqual(dm.status, fetcher.Status.Success)
+        self.assertEqual(dm.response.content, html)
+        session.return_value.get.assert_called_with(
+            dm.url, headers={}, stream=True, timeout=(1, 2))
+
+        # not html
+        session.return_value.get.return_value = response(
+            html, {"Content-Type": "application/pdf"})
+        dm = fetcher.fetch({}, DocumentMetadata("http://www.randomurl1.it"),
+                           None, 2000, types)
+        self.assertEqual(dm.status, fetcher.Status.SkipUrl)
+        self.assertIsNone(dm.response)
+
+        # too big, declared by the server or not
+        for headers in ({"Content-Length": str(len(html))}, {}):
+            r = response(html, headers)
+            session.return_value.get.return_value = r
+            with mock.patch.object(fetcher, "CHUNK_SIZE", 100):
+                dm = fetcher.fetch({}, DocumentMetadata("http://www.randomurl1.it"),
+                                   None, 500, types)
+            self.assertEqual(dm.status, fetcher.Status.SkipUrl)
+            self.assertIsNone(dm.response)
+            # the body is not read to the end
+            self.assertTrue(r.raw.closed or r.raw.tell() <= 600)
+
 
 if __name__ == '__main__':
     unittest.main()
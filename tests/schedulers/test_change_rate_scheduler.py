@@ -0,0 +1,92 @@
+import math
+import mock
+import unittest
+
+from core.metadata import DocumentMetadata, Source
+from schedulers.change_rate_scheduler import (
+    ChangeRateRefetchingStrategy, change_rate, optimal_frequency,
+    DAY, MIN_DELAY, MAX_DELAY)
+from tests.test_base import BaseTestClass
+
+
+def history(fetches, changes, days):
+    return {"fetches": fetches, "changes": changes, "first_fetch": 0,
+            "last_fetch": days * DAY, "last_change": 0}
+
+
+class TestChangeRate(BaseTestClass):
+    def test_change_rate(self):
+        # not enough fetches
+        self.assertIsNone(change_rate(history(2, 1, 1)))
+        self.assertEqual(change_rate(history(11, 0, 10)), 0)
+
+        # a change every two intervals: more than one change in two days
+        rate = change_rate(history(11, 5, 10))
+        self.assertAlmostEqual(rate * DAY, 0.647, places=3)
+
+        # a change at each fetch: the missed changes are estimated too
+        self.assertGreater(change_rate(history(11, 10, 10)) * DAY, 2)
+
+    def test_optimal_frequency(self):
+        multiplier = DAY
+        # dF/df is the multiplier at the optimal frequency
+        for rate in [0.01 / DAY, 0.1 / DAY, 0.5 / DAY]:
+            f = optimal_frequency(rate, multiplier)
+            x = rate / f
+            derivative = (1 - (1 + x) * math.exp(-x)) / rate
+            self.assertAlmostEqual(derivative / multiplier, 1, places=3)
+
+        # pages that never change or change too often are not refetched
+        self.assertEqual(optimal_frequency(0, multiplier), 0)
+        self.assertEqual(optimal_frequency(2.0 / DAY, multiplier), 0)
+
+    def compute(self, strategy, h):
+        dm = DocumentMetadata("http://www.randomurl1.it")
+        dm.source = Source.refetch
+        dm.delay = 5000
+        dm.history = h
+        return strategy.compute(dm, False, True)[1]
+
+    def test_compute(self):
+        strategy = ChangeRateRefetchingStrategy(0, 3600)
+        # without enough fetches the base strategy is used
+        self.assertEqual(self.compute(strategy, history(2, 1, 1)), 2500)
+        self.assertEqual(self.compute(strategy, None), 2500)
+
+        # refetched once per expected change, within the bounds
+        delay = self.compute(strategy, history(11, 5, 10))
+        self.assertAlmostEqual(delay / float(DAY), 1 / 0.647, places=2)
+        self.assertEqual(self.compute(strategy, history(11, 0, 10)),
+                         MAX_DELAY)
+        self.assertEqual(self.compute(strategy, history(1001, 1000, 1)),
+                         MIN_DELAY)
+
+    def test_budget(self):
+        # 1000 urls: 90% never change, the others change every few days
+        scheduled = mock.Mock(return_value=1000)
+        strategy = ChangeRateRefetchingStrategy(0, 3600, budget=100,
+                                                scheduled=scheduled)
+        histories = [history(11, 0, 10)] * 90 + \
+                    [history(11, 1 + i % 5, 10) for i in range(10)]
+        for h in histories:
+            self.compute(strategy, h)
+        # allocated after 1, 2, 4... urls
+        self.assertEqual(scheduled.call_count, 7)
+        multiplier = strategy.allocate()
+        self.assertAlmostEqual(strategy.fetches_per_day(multiplier, 1000),
+                               100, places=1)
+
+        # the budget is spent on the urls that change
+        with mock.patch.object(strategy, "allocate"):
+            delays = [self.compute(strategy, h) for h in histories]
+        self.assertEqual(set(delays[:90]), set([MAX_DELAY]))
+        self.assertTrue(all(d < MAX_DELAY for d in delays[90:]))
+        fetches = sum(DAY / float(d) for d in delays) * 10
+        self.assertAlmostEqual(fetches / 100, 1, places=2)
+
+        # urls changing more often are refetched sooner
+        self.assertEqual(delays[90:95], sorted(delays[90:95], reverse=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
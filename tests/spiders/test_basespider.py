@@ -6,20 +6,10 @@ from bs4 import BeautifulSoup
 from freezegun import freeze_time
 
 import spiders.base_spider as cs
+from spiders.extractor import extract_page
 from tests.test_base import BaseTestClass
 
 
-class FileObject():
-    data = ["User-agent: *", "Allow: /"]
-
-    def __iter__(self):
-        for i in self.data:
-            yield i
-
-    def close(self):
-        pass
-
-
 class TestCrawlSpider(BaseTestClass):
     def test_basenormalize(self):
         output = self.output_data()
@@ -51,9 +41,8 @@ class TestCrawlSpider(BaseTestClass):
             domain = spider.get_domain(url)
             self.assertEqual(domain, output[c])
 
-    @mock.patch('robotparser.URLopener.open')
-    def test_basegetlinks(self, opener):
-        opener.return_value = FileObject()
+    @mock.patch('spiders.robots.RobotsCache._schedule')
+    def test_basegetlinks(self, schedule):
         input = self.input_data()
         spider = cs.BaseSpider()
         spider.allowed_domains = ["www.ilsole24ore.com"]
@@ -65,6 +54,34 @@ class TestCrawlSpider(BaseTestClass):
             self.store_temporary(links)
         self.assertEqualTemporary()
 
+    @mock.patch('spiders.robots.RobotsCache._schedule')
+    def test_extract_page(self, schedule):
+        spider = cs.BaseSpider()
+        spider.allowed_domains = ["www.ilsole24ore.com"]
+        # the single pass extraction gives the same results of BeautifulSoup
+        with open(self._test_base_dir + "/data/basegetlinks_input") as f:
+            for i in f:
+                i = json.loads(i)
+                soup = BeautifulSoup(i["raw_html"], "lxml")
+                page = extract_page(i["raw_html"])
+                self.assertEqual(sorted(spider.get_links(page, i["url"])),
+                                 sorted(spider.get_links(soup, i["url"])))
+                self.assertEqual(spider.get_canonical(page),
+                                 spider.get_canonical(soup))
+                # only the whitespaces between the tags can differ
+                self.assertEqual(spider.get_text(page).split(),
+                                 soup.get_text().split())
+                for name in ["description", "og:title", "Content-Type"]:
+                    self.assertEqual(spider.get_meta(page, name),
+                                     spider.get_meta(soup, name))
+
+        page = extract_page('<base href="/a/"><a href="1" rel="x nofollow">'
+                            '<a href="2"><!-- comment -->text</a></a>')
+        self.assertEqual(page.base, "/a/")
+        self.assertEqual(page.anchors, [("1", "x nofollow"), ("2", "")])
+        self.assertEqual(page.text, "text")
+        self.assertEqual(extract_page("").text, "")
+
     def test_setconfig(self):
         spider = cs.BaseSpider()
         spider.urllist_filename = self.input_data_file
@@ -77,7 +94,8 @@ class TestCrawlSpider(BaseTestClass):
             else:
                 self.assertTrue(json_obj in spider.urllist)
 
-    def test_check_and_normalize(self):
+    @mock.patch('spiders.robots.RobotsCache._schedule')
+    def test_check_and_normalize(self, schedule):
         spider = cs.BaseSpider()
         spider.allowed_domains = ["www.url.com"]
         spider.exclude_pages = [".*/1.*"]
@@ -88,6 +106,33 @@ class TestCrawlSpider(BaseTestClass):
             nurl, toremove = spider.check_and_normalize(i.strip())
             onurl, otoremove = output[n].strip().split("\t")
             self.assertEqual((onurl, otoremove), (nurl, str(toremove)))
+        # the missing robots.txt rules are loaded for the next urls
+        schedule.assert_any_call("http", "www.url.com")
+
+    def test_compiled_filters(self):
+        spider = cs.BaseSpider()
+        # empty allowed_domains allows everything
+        self.assertTrue(spider.is_allowed_domain("www.any.com"))
+        self.assertFalse(spider.is_excluded("http://www.any.com/1"))
+
+        spider.allowed_domains = ["www.url.com", "*.sub.com", ".dot.com"]
+        spider.exclude_pages = [".*/1.*", "http://www\\.url\\.com/foto/"]
+        spider.compile_filters()
+
+        allowed = ["www.url.com", "a.sub.com", "a.b.sub.com",
+                   "dot.com", "www.dot.com"]
+        not_allowed = ["url.com", "sub.com", "www.url.com.it",
+                       "notdot.com", "www.other.com", ""]
+        for d in allowed:
+            self.assertTrue(spider.is_allowed_domain(d), d)
+        for d in not_allowed:
+            self.assertFalse(spider.is_allowed_domain(d), d)
+
+        self.assertTrue(spider.is_excluded("http://www.url.com/1/a"))
+        self.assertTrue(spider.is_excluded("http://www.url.com/foto/a"))
+        self.assertFalse(spider.is_excluded("http://www.url.com/video/a"))
+        # as for re.match, rules match from the beginning of the url
+        self.assertFalse(spider.is_excluded("www.url.com/foto/"))
 
     def test_getmeta(self):
         spider = cs.BaseSpider()
@@ -98,10 +143,9 @@ class TestCrawlSpider(BaseTestClass):
             self.store_temporary(data)
         self.assertEqualTemporary()
 
-    @mock.patch('robotparser.URLopener.open')
+    @mock.patch('spiders.robots.RobotsCache._schedule')
     @freeze_time('2018-05-15')
-    def test_parse(self, opener):
-        opener.return_value = FileObject()
+    def test_parse(self, schedule):
         import pickle
         spider = cs.BaseSpider()
         spider.allowed_domains = ["http://www.mediagol.it"]
@@ -0,0 +1,111 @@
+import mock
+import time
+import unittest
+
+from mockredis import mock_strict_redis_client
+
+from spiders.robots import RobotsCache, RobotsLoader
+from databases.redis_queues import RedisHash
+from tests.test_base import BaseTestClass
+
+ROBOTS = u"User-agent: *\nDisallow: /private/\n"
+
+
+class TestRobotsCache(BaseTestClass):
+    @mock.patch.object(RobotsCache, "_download")
+    def test_allowed(self, download):
+        download.return_value = (200, ROBOTS)
+        robots = RobotsCache("test")
+        with mock.patch.object(RobotsCache, "_schedule") as schedule:
+            # unknown rules never block the caller
+            self.assertTrue(robots.allowed("http://www.url.com/private/1"))
+            schedule.assert_called_once_with("http", "www.url.com")
+            self.assertTrue(robots.allowed("http://www.url.com/private/1",
+                                           fetch=False))
+            self.assertEqual(schedule.call_count, 1)
+
+        robots.load("http", "www.url.com")
+        self.assertFalse(robots.allowed("http://www.url.com/private/1"))
+        self.assertTrue(robots.allowed("http://www.url.com/public/1"))
+
+        # 401, 403 and 5xx disallow everything, other statuses allow everything
+        for status, allowed in [(403, False), (404, True), (None, True),
+                                (503, False)]:
+            download.return_value = (status, "")
+            robots.load("http", "www.url%s.com" % status)
+            self.assertEqual(
+                robots.allowed("http://www.url%s.com/a" % status), allowed)
+
+        # only server errors are temporary
+        self.assertTrue(robots.unavailable("http://www.url503.com/a"))
+        self.assertFalse(robots.unavailable("http://www.url403.com/a"))
+        self.assertFalse(robots.unavailable("http://www.other.com/a"))
+
+    @mock.patch.object(RobotsCache, "_download")
+    def test_unavailable_ttl(self, download):
+        download.return_value = (503, "")
+        robots = RobotsCache("test", error_ttl=3600, unavailable_ttl=60)
+        robots.load("http", "www.url.com")
+        expire = robots._rules["www.url.com"][1]
+        self.assertAlmostEqual(expire, time.time() + 60, delta=2)
+
+    @mock.patch.object(RobotsCache, "_download")
+    def test_background_load(self, download):
+        download.return_value = (200, ROBOTS)
+        robots = RobotsCache("test")
+        robots.allowed("http://www.url.com/private/1")
+        for _ in range(100):
+            if robots._get("www.url.com") is not None:
+                break
+            time.sleep(0.01)
+        self.assertFalse(robots.allowed("http://www.url.com/private/1"))
+        self.assertEqual(download.call_count, 1)
+
+    @mock.patch.object(RobotsCache, "_download")
+    def test_shared_loader(self, download):
+        download.return_value = (200, ROBOTS)
+        loader = RobotsLoader("test-robots")
+        caches = [RobotsCache("test%d" % i, loader=loader) for i in range(3)]
+        for robots in caches:
+            robots.allowed("http://www.url.com/private/1")
+        for _ in range(100):
+            if all(r._get("www.url.com") for r in caches):
+                break
+            time.sleep(0.01)
+        # each spider gets its rules from the same thread
+        for robots in caches:
+            self.assertFalse(robots.allowed("http://www.url.com/private/1"))
+            self.assertEqual(robots._pending, set())
+        self.assertEqual(download.call_count, 3)
+
+    @mock.patch.object(RobotsCache, "_download")
+    def test_expire_and_evict(self, download):
+        download.return_value = (None, "")
+        robots = RobotsCache("test", ttl=100, error_ttl=-1, max_domains=2)
+        # unreachable robots.txt expire after error_ttl
+        robots.load("http", "www.url1.com")
+        self.assertIsNone(robots._get("www.url1.com"))
+
+        download.return_value = (200, ROBOTS)
+        for i in range(3):
+            robots.load("http", "www.url%d.com" % i)
+        # least recently used domains are evicted
+        self.assertEqual(list(robots._rules),
+                         ["www.url1.com", "www.url2.com"])
+
+    @mock.patch('redis.StrictRedis', mock_strict_redis_client)
+    @mock.patch.object(RobotsCache, "_download")
+    def test_store(self, download):
+        download.return_value = (200, ROBOTS)
+        store = RedisHash("robots", "host", 0, 0)
+        RobotsCache("test1", store=store).load("http", "www.url.com")
+
+        # a second spider finds the rules in the store
+        robots = RobotsCache("test2", store=store)
+        robots.load("http", "www.url.com")
+        self.assertEqual(download.call_count, 1)
+        self.assertFalse(robots.allowed("http://www.url.com/private/1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+from __future__ import absolute_import
+
 import os
 import sys
 import json
@@ -7,6 +9,8 @@ import unittest
 from StringIO import StringIO
 from contextlib import contextmanager
 
+from databases import connections
+
 
 def ordered(obj):
     if isinstance(obj, str):
@@ -29,6 +33,8 @@ class BaseTestClass(unittest.TestCase):
     _temp_fd = None
     
     def setUp(self):
+        # clients of the previous test can be mocks
+        connections.reset()
         # create a new temporary directory
         try:
             shutil.rmtree(self._tmp_path)
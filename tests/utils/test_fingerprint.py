@@ -0,0 +1,48 @@
+import mock
+import unittest
+
+import utils.fingerprint as fp
+from tests.test_base import BaseTestClass
+
+TEXT = (u"Il Napoli vince in trasferta e resta in testa alla classifica. "
+        u"Decide una rete nel secondo tempo, poi la squadra difende il "
+        u"risultato fino al fischio finale. Prossima partita domenica.")
+
+
+class TestFingerprint(BaseTestClass):
+    def test_tokenize_and_shingles(self):
+        tokens = fp.tokenize(u"Citt\xe0 e  PAESE, citt\xe0!")
+        self.assertEqual(tokens, [u"citt\xe0", u"e", u"paese", u"citt\xe0"])
+        self.assertEqual(fp.shingles(tokens, 3),
+                         [u"citt\xe0 e paese", u"e paese citt\xe0"])
+        self.assertEqual(fp.shingles(tokens[:2], 3), [u"citt\xe0 e"])
+        self.assertEqual(fp.shingles([], 3), [])
+
+    def test_fingerprint(self):
+        # the value does not depend on the process
+        self.assertEqual(fp.fingerprint(TEXT), 6643234048559165184)
+        self.assertEqual(fp.fingerprint(u""), 0)
+
+        # similar texts have similar fingerprints
+        changed = TEXT.replace(u"domenica", u"sabato")
+        dist = fp.hamming_distance(fp.fingerprint(TEXT), fp.fingerprint(changed))
+        self.assertTrue(0 < dist < 16)
+        other = fp.fingerprint(u"Un testo completamente diverso dal primo, "
+                               u"che parla di tutt'altro argomento.")
+        self.assertTrue(fp.hamming_distance(fp.fingerprint(TEXT), other) > dist)
+
+    def test_numpy_and_python(self):
+        for size in (1, 3, 5):
+            features = fp.shingles(fp.tokenize(TEXT), size)
+            value = fp.simhash(features)
+            self.assertTrue(-2 ** 63 <= value < 2 ** 63)
+            with mock.patch("utils.fingerprint.numpy", None):
+                self.assertEqual(fp.simhash(features), value)
+
+    def test_hamming_distance(self):
+        self.assertEqual(fp.hamming_distance(0, 0b1011), 3)
+        self.assertEqual(fp.hamming_distance(-1, 2 ** 63 - 1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
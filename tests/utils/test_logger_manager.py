@@ -0,0 +1,149 @@
+import mock
+import time
+import Queue
+import logging
+import threading
+import unittest
+
+from utils.logger_manager import QueueHandler, RateLimitFilter, logger_configurer
+from tests.test_base import BaseTestClass
+
+
+class TestLoggerManager(BaseTestClass):
+    def setUp(self):
+        super(TestLoggerManager, self).setUp()
+        self.queue = Queue.Queue()
+        self.logger = logging.getLogger("test-logger")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        for h in list(self.logger.handlers):
+            self.logger.removeHandler(h)
+
+    def test_batches(self):
+        h = QueueHandler(self.queue, batch_size=3, flush_interval=0)
+        self.logger.addHandler(h)
+        for i in range(4):
+            self.logger.info("message %d of %s", i, "test")
+        batch = self.queue.get_nowait()
+        self.assertEqual([r.getMessage() for r in batch],
+                         ["message 0 of test", "message 1 of test",
+                          "message 2 of test"])
+        # arguments are formatted before crossing the process boundary
+        self.assertIsNone(batch[0].args)
+        self.assertTrue(self.queue.empty())
+
+        h.flush()
+        self.assertEqual(len(self.queue.get_nowait()), 1)
+        h.flush()
+        self.assertTrue(self.queue.empty())
+
+    def test_exceptions(self):
+        h = QueueHandler(self.queue, batch_size=1, flush_interval=0)
+        self.logger.addHandler(h)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception("failed")
+        record = self.queue.get_nowait()[0]
+        self.assertIsNone(record.exc_info)
+        self.assertIn("ZeroDivisionError", record.exc_text)
+
+    def test_rate_limit(self):
+        h = QueueHandler(self.queue, batch_size=1, flush_interval=0)
+        h.addFilter(RateLimitFilter(60))
+        self.logger.addHandler(h)
+        for url in ["www.a.com", "www.b.com", "www.c.com"]:
+            self.logger.warning("discarded: %s", url)
+            self.logger.debug("debug: %s", url)
+        self.logger.error("discarded: %s", "www.d.com")
+
+        messages = []
+        while not self.queue.empty():
+            messages += [r.getMessage() for r in self.queue.get_nowait()]
+        self.assertEqual(messages, ["discarded: www.a.com",
+                                    "debug: www.a.com",
+                                    "debug: www.b.com",
+                                    "debug: www.c.com",
+                                    "discarded: www.d.com"])
+
+        # after the interval the message passes with the dropped count
+        f = h.filters[0]
+        for entry in f._messages.values():
+            entry[0] = 0
+        self.logger.warning("discarded: %s", "www.e.com")
+        self.assertEqual(self.queue.get_nowait()[0].getMessage(),
+                         "discarded: www.e.com [2 similar messages dropped]")
+
+        # errors are never dropped
+        for url in ["www.a.com", "www.b.com"]:
+            self.logger.error("crawling error: %s", url)
+        self.assertEqual(self.queue.get_nowait()[0].getMessage(),
+                         "crawling error: www.a.com")
+        self.assertEqual(self.queue.get_nowait()[0].getMessage(),
+                         "crawling error: www.b.com")
+
+    def test_rate_limit_pending(self):
+        h = QueueHandler(self.queue, batch_size=1, flush_interval=0)
+        h.addFilter(RateLimitFilter(60))
+        self.logger.addHandler(h)
+        for url in ["www.a.com", "www.b.com", "www.c.com"]:
+            self.logger.warning("discarded: %s", url)
+        self.logger.info("stopped")
+        self.logger.info("stopped")
+        self.assertEqual(self.queue.get_nowait()[0].getMessage(),
+                         "discarded: www.a.com")
+        self.assertEqual(self.queue.get_nowait()[0].getMessage(), "stopped")
+
+        # the dropped messages are reported once the interval is over
+        now = time.time()
+        h.flush_filters(now)
+        self.assertTrue(self.queue.empty())
+        h.flush_filters(now + 60)
+        messages = sorted(r.getMessage() for b in [self.queue.get_nowait(),
+                                                   self.queue.get_nowait()]
+                          for r in b)
+        self.assertEqual(messages, [
+            "discarded: www.c.com [1 similar messages dropped]", "stopped"])
+        self.assertEqual(h.filters[0]._messages, {})
+
+    def test_fork(self):
+        h = QueueHandler(self.queue, batch_size=1, flush_interval=0)
+        self.logger.addHandler(h)
+        self.logger.info("message of the parent")
+        self.queue.get_nowait()
+
+        # the lock is held by the flusher of the parent at the fork
+        locked, released = threading.Event(), threading.Event()
+
+        def flusher(lock):
+            with lock:
+                locked.set()
+                released.wait(5)
+        threading.Thread(target=flusher, args=(h.lock,)).start()
+        locked.wait(5)
+        child = threading.Thread(target=self.logger.info,
+                                 args=("first message of the child",))
+        with mock.patch("os.getpid", return_value=-1):
+            child.start()
+            child.join(5)
+        released.set()
+        self.assertFalse(child.is_alive())
+        self.assertEqual(self.queue.get_nowait()[0].getMessage(),
+                         "first message of the child")
+
+    def test_level(self):
+        root = logging.getLogger()
+        level, handlers = root.level, list(root.handlers)
+        try:
+            h = logger_configurer(self.queue, {"level": "WARNING"})
+            self.assertEqual(root.level, logging.WARNING)
+            self.assertEqual(len(h.filters), 1)
+        finally:
+            root.setLevel(level)
+            root.handlers = handlers
+
+
+if __name__ == '__main__':
+    unittest.main()
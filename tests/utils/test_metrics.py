@@ -0,0 +1,76 @@
+import mock
+import urllib2
+import unittest
+
+import utils.metrics as metrics
+from tests.test_base import BaseTestClass
+
+
+class TestMetrics(BaseTestClass):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.registry = metrics.Registry()
+
+    def test_render(self):
+        self.registry.labels["spider"] = "test"
+        c = self.registry.counter("pages_total", "Pages")
+        c.inc()
+        c.inc(2)
+        c.inc(code=404)
+        self.assertEqual(c.value(), 3)
+        g = self.registry.gauge("queue_size", "Queue")
+        g.set(5, queue="normal")
+        g.set(7, queue="normal")
+        # the same metric is returned for the same name
+        self.assertIs(self.registry.counter("pages_total"), c)
+
+        text = self.registry.render().splitlines()
+        self.assertEqual(text[:2], ["# HELP pages_total Pages",
+                                    "# TYPE pages_total counter"])
+        self.assertIn('pages_total{code="404",spider="test"} 1', text)
+        self.assertIn('pages_total{spider="test"} 3', text)
+        self.assertIn('queue_size{queue="normal",spider="test"} 7', text)
+
+    def test_histogram(self):
+        h = self.registry.histogram("fetch_seconds", "Fetch", buckets=(0.1, 1))
+        for v in (0.05, 0.1, 0.5, 3):
+            h.observe(v, stage="fetch")
+        with mock.patch("time.time", side_effect=[10, 10.2]):
+            with h.time(stage="parse"):
+                pass
+
+        text = self.registry.render().splitlines()
+        for line in ['fetch_seconds_bucket{le="0.1",stage="fetch"} 2',
+                     'fetch_seconds_bucket{le="1",stage="fetch"} 3',
+                     'fetch_seconds_bucket{le="+Inf",stage="fetch"} 4',
+                     'fetch_seconds_sum{stage="fetch"} 3.65',
+                     'fetch_seconds_count{stage="fetch"} 4',
+                     'fetch_seconds_bucket{le="1",stage="parse"} 1']:
+            self.assertIn(line, text)
+
+    def test_collectors(self):
+        g = self.registry.gauge("queue_size")
+        self.registry.add_collector(lambda: g.set(3))
+        self.registry.add_collector(lambda: 1 / 0)
+        self.assertIn("queue_size 3", self.registry.render().splitlines())
+        self.registry.clear()
+        self.assertNotIn("queue_size 3", self.registry.render())
+
+    def test_exports(self):
+        metrics.pages.inc()
+        server = metrics.serve(0)
+        try:
+            url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+            body = urllib2.urlopen(url).read()
+        finally:
+            server.shutdown()
+        self.assertIn("crawleb_pages_total", body)
+
+        path = self._tmp_path + "metrics.prom"
+        metrics.write_file(path)
+        with open(path) as f:
+            self.assertIn("crawleb_pages_total", f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Compute the simhash fingerprint of a text.
+
+Fingerprints are used to understand if a page changed since the last
+fetch (see SeenManager). They must be the same whichever process computed
+them, so tokens are hashed with md5 instead of the builtin `hash`, which
+depends on the interpreter and on the platform.
+
+The text is split in words and the words in shingles (sequences of
+`shingle_size` consecutive words). The fingerprint bit i is set if the
+bit i is set in the majority of the shingle hashes.
+If numpy is installed the bits are counted for all the hashes at once,
+otherwise a slower pure python version is used: the result is the same.
+"""
+import re
+import struct
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_SHINGLE_SIZE = 3
+
+WORDS = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lowercase words of a text."""
+    return WORDS.findall(text.lower())
+
+
+def shingles(tokens, size=DEFAULT_SHINGLE_SIZE):
+    """Return the sequences of `size` consecutive tokens (as strings)."""
+    if len(tokens) <= size:
+        return [u" ".join(tokens)] if tokens else []
+    return [u" ".join(tokens[i:i + size])
+            for i in xrange(len(tokens) - size + 1)]
+
+
+def hash_digests(features):
+    """Return the 64 bit hashes of the features as a single string."""
+    return "".join(hashlib.md5(f.encode("utf-8")).digest()[:8]
+                   for f in features)
+
+
+def _simhash_numpy(digests, n):
+    bits = numpy.unpackbits(
+        numpy.frombuffer(digests, dtype=numpy.uint8).reshape(n, 8), axis=1)
+    majority = bits.sum(axis=0) * 2 > n
+    return struct.unpack("<Q", numpy.packbits(majority).tobytes())[0]
+
+
+def _simhash_python(digests, n):
+    counts = [0] * 64
+    for h in struct.unpack("<%dQ" % n, digests):
+        i = 0
+        while h:
+            if h & 1:
+                counts[i] += 1
+            h >>= 1
+            i += 1
+    majority = 0
+    for i, c in enumerate(counts):
+        if c * 2 > n:
+            majority |= 1 << i
+    return majority
+
+
+def simhash(features):
+    """
+    Return the 64 bit simhash of a list of features (strings).
+
+    The value is signed, so it can be stored as a mongodb long.
+    """
+    if not features:
+        return 0
+    digests = hash_digests(features)
+    if numpy is not None:
+        value = _simhash_numpy(digests, len(features))
+    else:
+        value = _simhash_python(digests, len(features))
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def fingerprint(text, shingle_size=DEFAULT_SHINGLE_SIZE):
+    """Return the fingerprint of a text."""
+    return simhash(shingles(tokenize(text), shingle_size))
+
+
+def hamming_distance(a, b):
+    """Return the number of different bits of two fingerprints."""
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
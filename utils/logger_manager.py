@@ -1,6 +1,19 @@
 """Logging utility"""
+import os
+import time
 import logging
 import logging.handlers
+import threading
+
+# records sent together to the listener
+BATCH_SIZE = 100
+# max seconds a record waits before being sent to the listener
+FLUSH_INTERVAL = 1
+# seconds during which the same message is logged only once
+RATE_LIMIT = 60
+# max number of different messages tracked by the rate limit
+MAX_MESSAGES = 10000
+
 
 class QueueHandler(logging.Handler):
     """
@@ -8,23 +21,161 @@ class QueueHandler(logging.Handler):
 
     Since we have multiple process we organize the logs
     in a queue. A process will store the queue afterwards.
+
+    Records are sent in lists of `batch_size`, so the queue is used
+    (and the data pickled) once for many records. A background thread
+    sends the records waiting for more than `flush_interval` seconds,
+    and the messages held by the filters (see RateLimitFilter.pending).
     """
-    def __init__(self, queue):
+    def __init__(self, queue, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
         logging.Handler.__init__(self)
         self.queue = queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._batch = []
+        self._pid = None
+
+    def _start_flusher(self):
+        # INFO: spider processes are forked after the configuration,
+        #       so each process needs its own thread. Records of the
+        #       parent process are not sent twice.
+        #       The lock could be held by the flusher of the parent at
+        #       the fork, and python2 does not release it in the child.
+        self.createLock()
+        self._pid = os.getpid()
+        self._batch = []
+        if self.flush_interval:
+            t = threading.Thread(target=self._flush_loop, name="log-flusher")
+            t.daemon = True
+            t.start()
+
+    def _flush_loop(self):
+        sleep = threading.Event()
+        while True:
+            sleep.wait(self.flush_interval)
+            self.flush_filters(time.time())
+            self.flush()
+
+    def flush_filters(self, now):
+        """Emit the records held by the filters until `now`."""
+        for f in self.filters:
+            pending = getattr(f, "pending", None)
+            if pending is not None:
+                for record in pending(now):
+                    # INFO: as in `handle`, the filters are already passed
+                    self.acquire()
+                    try:
+                        self.emit(record)
+                    finally:
+                        self.release()
+
+    def prepare(self, record):
+        """
+        Format the message, so the arguments are not pickled.
+
+        The formatting happens only for records that passed levels and filters.
+        """
+        if record.exc_info:
+            # the traceback is kept as text (record.exc_text)
+            self.format(record)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def handle(self, record):
+        # INFO: before taking the lock, it can be the one of the parent
+        if self._pid != os.getpid():
+            self._start_flusher()
+        return logging.Handler.handle(self, record)
 
     def emit(self, record):
         try:
-            ei = record.exc_info
-            if ei:
-                dummy = self.format(record)
-                record.exc_info = None
-            self.queue.put_nowait(record)
+            self._batch.append(self.prepare(record))
+            if len(self._batch) >= self.batch_size:
+                self.flush()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
 
+    def flush(self):
+        """Send the records waiting in the batch."""
+        self.acquire()
+        try:
+            batch, self._batch = self._batch, []
+            if batch:
+                self.queue.put_nowait(batch)
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush_filters(float("inf"))
+        self.flush()
+        logging.Handler.close(self)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let the same message pass at most once every `interval` seconds.
+
+    Messages are the same if they have the same logger, level and format
+    string (arguments can change). When a message passes again, the number
+    of repetitions dropped meanwhile is added to it. If it does not, the
+    last repetition is returned by `pending` once the interval is over.
+    DEBUG messages, errors and the more severe ones are never dropped.
+    """
+    def __init__(self, interval=RATE_LIMIT, max_messages=MAX_MESSAGES):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.max_messages = max_messages
+        self._messages = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG or record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        with self._lock:
+            entry = self._messages.get(key)
+            if entry and record.created < entry[0]:
+                # the last repetition is kept for `pending`
+                entry[1] += 1
+                entry[2] = record
+                return False
+            if len(self._messages) >= self.max_messages:
+                self._messages.clear()
+            self._messages[key] = [record.created + self.interval, 0, None]
+        if entry and entry[1]:
+            self._add_dropped(record, entry[1])
+        return True
+
+    @staticmethod
+    def _add_dropped(record, dropped):
+        record.msg = "%s [%d similar messages dropped]" % (
+            record.getMessage(), dropped)
+        record.args = None
+
+    def pending(self, now):
+        """
+        Return the last repetition of the messages dropped whose interval
+        is over at `now`, and forget them.
+        """
+        records = []
+        with self._lock:
+            for key, entry in self._messages.items():
+                if entry[0] > now:
+                    continue
+                del self._messages[key]
+                if entry[1]:
+                    record = entry[2]
+                    if entry[1] > 1:
+                        self._add_dropped(record, entry[1] - 1)
+                    records.append(record)
+        return records
+
+
 def log_listener(queue, filename):
     """
     Setting up the logger.
@@ -40,12 +191,15 @@ def log_listener(queue, filename):
 
     while True:
         try:
-            record = queue.get()
-            if record is None:
+            records = queue.get()
+            if records is None:
                 print "None detected. Program is shutting down."
                 break
-            logger = logging.getLogger(record.name)
-            logger.handle(record)
+            if not isinstance(records, list):
+                records = [records]
+            for record in records:
+                logger = logging.getLogger(record.name)
+                logger.handle(record)
         except (KeyboardInterrupt, SystemExit):
             #raise
             logger.info("Exit signal detected - shutting down.")
@@ -55,9 +209,19 @@ def log_listener(queue, filename):
             print >> sys.stderr, 'Whoops! Problem:'
             traceback.print_exc(file=sys.stderr)
 
-def logger_configurer(queue):
-    """Helper function for setting up the logger."""
-    h = QueueHandler(queue)
+
+def logger_configurer(queue, cfg={}):
+    """
+    Helper function for setting up the logger.
+
+    cfg is the logging configuration (level, batch-size, rate-limit).
+    Records under the level are discarded by the process creating them.
+    """
+    h = QueueHandler(queue, cfg.get("batch-size", BATCH_SIZE))
+    rate_limit = cfg.get("rate-limit", RATE_LIMIT)
+    if rate_limit:
+        h.addFilter(RateLimitFilter(rate_limit))
     root = logging.getLogger()
     root.addHandler(h)
-    root.setLevel(logging.DEBUG)
+    root.setLevel(cfg.get("level", "INFO"))
+    return h
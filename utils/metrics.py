@@ -0,0 +1,292 @@
+"""
+Metrics of a crawling process, exposed in the prometheus text format.
+
+Each spider runs in its own process with its own registry. The metrics
+can be read from a local http endpoint (`port`) or from a file written
+every `interval` seconds (`path`), see `start`.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+
+# seconds. Suitable for both fetches and database round trips
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return unicode(value).replace(u"\\", u"\\\\").replace(
+        u"\n", u"\\n").replace(u'"', u'\\"')
+
+
+def _labels(labels):
+    # the labels of the sample win over the labels of the registry
+    labels = dict(labels)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v))
+                             for k, v in sorted(labels.items()))
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """A metric with a value for each set of labels."""
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self, const_labels=()):
+        """Return the (name, labels, value) of the metric."""
+        with self._lock:
+            values = self._values.items()
+        return [(self.name, const_labels + k, v) for k, v in values]
+
+
+class Counter(Metric):
+    """A value that only grows (e.g. pages fetched)."""
+    type = "counter"
+
+    def inc(self, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+
+class Gauge(Metric):
+    """A value that goes up and down (e.g. queue size)."""
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    """The distribution of a value (e.g. fetch latency) in buckets."""
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                # counts of each bucket (not cumulative), sum
+                data = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            data[0][bisect.bisect_left(self.buckets, value)] += 1
+            data[1] += value
+
+    def time(self, **labels):
+        """Context manager observing the seconds spent in its block."""
+        return _Timer(self, labels)
+
+    def samples(self, const_labels=()):
+        with self._lock:
+            values = [(k, list(counts), total)
+                      for k, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            labels = const_labels + key
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket",
+                                labels + (("le", _number(bound)),), cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+
+class Registry(object):
+    """
+    All the metrics of a process.
+
+    `labels` are added to every sample (e.g. the spider name).
+    Collectors are functions called before each export, to update
+    metrics that are expensive to keep updated (e.g. queue sizes).
+    """
+    def __init__(self):
+        self.labels = {}
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+        return metric
+
+    def counter(self, name, help=""):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=""):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def clear(self):
+        """Forget the values of all the metrics and the collectors."""
+        with self._lock:
+            for m in self._metrics.values():
+                with m._lock:
+                    m._values.clear()
+            del self._collectors[:]
+
+    def render(self):
+        """Return all the metrics in the prometheus text format."""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logging.getLogger("metrics").warning(
+                    "metrics collector failed: %s", e)
+        const_labels = tuple(sorted(self.labels.items()))
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for m in metrics:
+            lines.append("# HELP %s %s" % (m.name, m.help))
+            lines.append("# TYPE %s %s" % (m.name, m.type))
+            for name, labels, value in m.samples(const_labels):
+                lines.append("%s%s %s" % (name, _labels(labels), _number(value)))
+        return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+
+# the registry of the current process
+registry = Registry()
+
+# metrics of the crawling loop, shared by the modules
+stage_seconds = registry.histogram(
+    "crawleb_stage_seconds",
+    "Seconds spent in each stage of the crawling loop")
+responses = registry.counter(
+    "crawleb_responses_total", "Http responses by status code")
+downloaded_bytes = registry.counter(
+    "crawleb_downloaded_bytes_total", "Bytes of the bodies downloaded")
+fetch_errors = registry.counter(
+    "crawleb_fetch_errors_total", "Fetches without a usable response")
+pages = registry.counter(
+    "crawleb_pages_total", "Urls processed by the crawler")
+pages_per_second = registry.gauge(
+    "crawleb_pages_per_second", "Urls processed per second since the last export")
+queue_size = registry.gauge(
+    "crawleb_queue_size", "Urls in each queue")
+store_batch_size = registry.histogram(
+    "crawleb_store_batch_size", "Documents written by each batch",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+class _PagesRate(object):
+    """Collector of the pages per second since the previous export."""
+    def __init__(self):
+        self.last = None
+
+    def __call__(self):
+        now, count = time.time(), pages.value()
+        if self.last and now > self.last[0]:
+            pages_per_second.set((count - self.last[1]) / (now - self.last[0]))
+        self.last = now, count
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """Expose the metrics over http in a background thread."""
+    server = BaseHTTPServer.HTTPServer((host, port), _Handler)
+    t = threading.Thread(target=server.serve_forever, name="metrics-http")
+    t.daemon = True
+    t.start()
+    return server
+
+
+def write_file(path):
+    """Write the metrics in a file, atomically."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(registry.render())
+    os.rename(tmp, path)
+
+
+def write_periodically(path, interval):
+    """Write the metrics in a file every `interval` seconds, in background."""
+    def loop():
+        sleep = threading.Event()
+        while True:
+            sleep.wait(interval)
+            try:
+                write_file(path)
+            except (IOError, OSError) as e:
+                logging.getLogger("metrics").warning(
+                    "cannot write metrics: %s", e)
+    t = threading.Thread(target=loop, name="metrics-file")
+    t.daemon = True
+    t.start()
+    return t
+
+
+def start(cfg, name, n=0):
+    """
+    Expose the metrics of the spider (or worker) `name` as configured.
+
+    cfg -- the metrics configuration (port, host, path, interval)
+    n   -- index of the process: the http port is `port` + n,
+           `path` can contain %(spider)s
+    """
+    registry.labels["spider"] = name
+    registry.add_collector(_PagesRate())
+    if not cfg:
+        return
+    if cfg.get("port"):
+        serve(cfg["port"] + n, cfg.get("host", "127.0.0.1"))
+    if cfg.get("path"):
+        write_periodically(cfg["path"] % {"spider": name},
+                           cfg.get("interval", 15))
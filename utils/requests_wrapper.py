@@ -1,17 +1,39 @@
 """Request wrapper function."""
+import threading
+
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+# number of hosts for which a session keeps a connection pool
+POOL_CONNECTIONS = 20
+# number of connections kept alive for each host
+POOL_MAXSIZE = 10
+# number of hosts of a session shared by many spiders (see share_sessions)
+SHARED_POOL_CONNECTIONS = 200
+
+# sessions are shared by all the fetches of a spider with the same headers
+_sessions = {}
+_sessions_lock = threading.Lock()
+# hosts of a shared session, 0 if sessions are not shared among spiders
+_shared = 0
+
 
 def requests_retry_session(
         headers = {},
-        retries=10,
+        retries=0,
         backoff_factor=0.3,
-        status_forcelist=(500, 502, 504),
+        status_forcelist=(),
         session=None,
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
 ):
-    """Helper function to open a session."""
+    """
+    Helper function to open a session.
+
+    By default the session does not retry: failed urls are retried by the
+    QueueManager, which has the only retry budget (`max-retries`).
+    """
     session = session or requests.Session()
     # todo: these should be spider config
     session.headers.update(headers)
@@ -22,12 +44,58 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry,
+                          pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
+def share_sessions(pool_connections=SHARED_POOL_CONNECTIONS):
+    """
+    Share the sessions among all the spiders of the process.
+
+    Spiders with the same headers use the same session, keeping
+    connections for `pool_connections` hosts: the connections of a
+    process do not grow with its spiders (see SpiderPool).
+    """
+    global _shared
+    _shared = pool_connections
+
+
+def get_session(name, headers={}, pool_maxsize=POOL_MAXSIZE):
+    """
+    Return the session of the spider `name` for the given headers.
+
+    The session is created at the first call and reused afterwards,
+    so connections to the same host are kept alive between fetches.
+    """
+    key = (None if _shared else name, tuple(sorted(headers.items())))
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests_retry_session(
+                    headers, pool_maxsize=pool_maxsize,
+                    pool_connections=_shared or POOL_CONNECTIONS)
+                _sessions[key] = session
+    return session
+
+
+def close_sessions(name=None):
+    """
+    Close the sessions of the spider `name` (all sessions if None).
+
+    Shared sessions are closed only with all the others.
+    """
+    with _sessions_lock:
+        for key in list(_sessions):
+            if name is None or key[0] == name:
+                _sessions.pop(key).close()
+
+
 def quote(url):
     """Quote urls. usefull before requests."""
     return requests.utils.quote(url)